@@ -0,0 +1,71 @@
+"""
+async_transport_bench.py
+
+Benchmark for: Pipe.pipe() w/ & w/o async transport
+
+N concurrent streaming rounds against a local stand-in Dify server;
+w/ async transport they finish in about the time of one round,
+w/o they are served one after another.
+
+usage::
+
+    python -m benchmarks.async_transport_bench [N]
+"""
+
+import asyncio
+import sys
+import time
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import Pipe
+from tests import EXAMPLE_BODY1, EXAMPLE_CHATFLOW_CONFIG
+from tests.stand_in_dify_server import StandInDifyServer
+
+EVENT_DELAY = 0.05
+CHUNKS = ["chunk "] * 10
+
+
+async def _collect(opt):
+    if isinstance(opt, str):
+        return opt
+    if hasattr(opt, "__aiter__"):
+        return "".join([chunk async for chunk in opt])
+    return "".join(opt)
+
+
+async def _run_rounds(pipe, n):
+    async def one_round(i):
+        opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "c{}".format(i)})
+        return await _collect(opt)
+
+    await asyncio.gather(*(one_round(i) for i in range(n)))
+
+
+def main(n):
+    with StandInDifyServer(chunks=CHUNKS, event_delay=EVENT_DELAY) as server:
+        pipe = Pipe(
+            app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+            base_url_override=server.base_url,
+        )
+
+        print(
+            "{} concurrent rounds, each ~{:.2f}s".format(
+                n, EVENT_DELAY * len(CHUNKS)
+            )
+        )
+        for enables in (True, False):
+            dify_open_webui_adapter.ENABLES_ASYNC_TRANSPORT = enables
+
+            start = time.perf_counter()
+            asyncio.run(_run_rounds(pipe, n))
+            elapsed = time.perf_counter() - start
+
+            print(
+                "  async transport {:<5}  {:7.3f}s".format(
+                    str(enables), elapsed
+                )
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16)
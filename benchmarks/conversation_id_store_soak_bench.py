@@ -0,0 +1,58 @@
+"""
+conversation_id_store_soak_bench.py
+
+Soak benchmark for: _ConversationIdStore
+
+feed millions of distinct OWU chats through a single Chatflow model,
+peak RSS of the process stays flat once ``max_entries`` is reached.
+
+usage::
+
+    python -m benchmarks.conversation_id_store_soak_bench [CHATS]
+"""
+
+import resource
+import sys
+import time
+
+from dify_open_webui_adapter import OWUModel, DifyAppType
+from tests import EXAMPLE_BASE_URL, EXAMPLE_CHATFLOW_CONFIG
+
+REPORTS = 10
+
+
+def main(chats):
+    model = OWUModel(
+        EXAMPLE_BASE_URL,
+        EXAMPLE_CHATFLOW_CONFIG,
+        disable_get_app_type_and_name=True,
+        app_type_override=DifyAppType.CHATFLOW,
+    )
+    app = model.app
+
+    start = time.perf_counter()
+
+    print("{:>10}  {:>8}  {:>10}".format("chats", "entries", "peak RSS"))
+    for i in range(chats):
+        context = app.create_round_context(
+            {}, {"chat_id": "chat-{:08d}".format(i)}, True
+        )
+        if not context.conversation_id:  # 1st round, as if responded by Dify
+            app.set_conversation_id(context, "conv-{:08d}".format(i))
+
+        if (i + 1) % (chats // REPORTS) == 0:
+            print(
+                "{:>10}  {:>8}  {:>8.1f}MB".format(
+                    i + 1,
+                    len(app.chat2conversation_ids),
+                    # in KB on Linux
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+                )
+            )
+
+    print("{:.1f}s".format(time.perf_counter() - start))
+    print(app.chat2conversation_ids.snapshot())
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000)
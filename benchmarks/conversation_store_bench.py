@@ -0,0 +1,69 @@
+"""
+conversation_store_bench.py
+
+Benchmark for: ``conversation_id`` lookup per round,
+w/ "memory" & "sqlite" CONVERSATION_STORE_BACKEND
+
+usage::
+
+    python -m benchmarks.conversation_store_bench [ROUNDS]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from dify_open_webui_adapter import (
+    _ConversationIdStore,
+    _SQLiteConversationDatabase,
+    _SQLiteConversationIdStore,
+)
+
+CHATS = 1000
+
+
+def _measure(store, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        chat_id = "chat-{}".format(i % CHATS)
+        if not store.get(chat_id):
+            store[chat_id] = "conv-{}".format(i)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main(rounds):
+    with tempfile.TemporaryDirectory() as directory:
+        database = _SQLiteConversationDatabase(
+            os.path.join(directory, "conversations.sqlite3")
+        )
+
+        print("per-round lookup, {} chats".format(CHATS))
+        print(
+            "  memory              {:6.2f}us".format(
+                _measure(_ConversationIdStore(), rounds)
+            )
+        )
+        print(
+            "  sqlite              {:6.2f}us".format(
+                _measure(_SQLiteConversationIdStore(database, "app"), rounds)
+            )
+        )
+
+        # cold read cache, e.g. chats started on another worker
+        database.flush()
+        cold_store = _SQLiteConversationIdStore(database, "app")
+        start = time.perf_counter()
+        for i in range(CHATS):
+            cold_store.get("chat-{}".format(i))
+        print(
+            "  sqlite, cold cache  {:6.2f}us".format(
+                (time.perf_counter() - start) / CHATS * 1e6
+            )
+        )
+
+        database.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
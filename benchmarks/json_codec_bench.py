@@ -0,0 +1,110 @@
+"""
+json_codec_bench.py
+
+Benchmark for: JSON codecs (JSON_CODEC) decoding the SSE fixtures of
+``tests/testee_conversation_round.py`` & encoding request payloads
+
+usage::
+
+    python -m benchmarks.json_codec_bench [EVENTS]
+"""
+
+import json
+import sys
+import time
+
+from dify_open_webui_adapter import (
+    _StdlibJSONCodec,
+    _OrjsonJSONCodec,
+    orjson,
+)
+from tests.testee_conversation_round import (
+    WORKFLOW_DATA1,
+    WORKFLOW_DATA2,
+    WORKFLOW_DATA3,
+    WORKFLOW_DATA4,
+    CHATFLOW_DATA1,
+    CHATFLOW_DATA2,
+    CHATFLOW_DATA3,
+)
+
+REPEATS = 5
+
+
+def _create_events(n):
+    """
+    :return: data of ``n`` SSE fixtures, as received from Dify
+    """
+    events = [
+        json.dumps(data).encode("utf-8")
+        for data_dicts in (
+            WORKFLOW_DATA1,
+            WORKFLOW_DATA2,
+            WORKFLOW_DATA3,
+            WORKFLOW_DATA4,
+            CHATFLOW_DATA1,
+            CHATFLOW_DATA2,
+            CHATFLOW_DATA3,
+        )
+        for data in data_dicts
+    ]
+    return (events * (n // len(events) + 1))[:n]
+
+
+def _create_payloads(n):
+    return [
+        {
+            "query": "question #{}: 这个文档讲了什么？".format(i),
+            "response_mode": "streaming",
+            "user": "user",
+            "conversation_id": "c0cf-{}".format(i),
+            "auto_generate_name": False,
+            "inputs": {},
+        }
+        for i in range(n)
+    ]
+
+
+def _measure(fx, items):
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.process_time()
+        for item in items:
+            fx(item)
+        best = min(best, time.process_time() - start)
+    return best
+
+
+def main(n):
+    codecs = [_StdlibJSONCodec()]
+    if orjson:
+        codecs.append(_OrjsonJSONCodec())
+    else:
+        print("orjson not installed, measure stdlib json only")
+
+    events = _create_events(n)
+    payloads = _create_payloads(n)
+    print(
+        "{} events, {:.1f}MB; {} payloads".format(
+            n, sum(map(len, events)) / 2**20, n
+        )
+    )
+
+    for title, fx_name, items in (
+        ("loads SSE data", "loads", events),
+        ("dumps payload", "dumps", payloads),
+    ):
+        print(title)
+        baseline = None
+        for codec in codecs:
+            elapsed = _measure(getattr(codec, fx_name), items)
+            baseline = baseline or elapsed
+            print(
+                "  {:<8} {:7.3f}s  {:9.0f} /s  x{:.2f}".format(
+                    codec.name, elapsed, n / elapsed, baseline / elapsed
+                )
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,188 @@
+"""
+sse_parse_bench.py
+
+Microbenchmark for: parsing text/event-stream in _ConversationRound
+
+replay events of ``tests/testee_conversation_round.py`` fixtures,
+scaled to N events, through _ConversationRound; compared w/ the former
+``iter_lines()`` + ``decode()`` + ``json.loads()`` per line.
+
+usage::
+
+    python -m benchmarks.sse_parse_bench [EVENTS]
+"""
+
+import json
+import sys
+import time
+
+import requests
+
+from dify_open_webui_adapter import _SSE, _ConversationRound, _SSEParser
+from tests.testee_conversation_round import (
+    WORKFLOW_DATA1,
+    WORKFLOW_DATA2,
+    WORKFLOW_DATA3,
+    WORKFLOW_DATA4,
+    CHATFLOW_DATA1,
+    CHATFLOW_DATA2,
+    CHATFLOW_DATA3,
+)
+
+REPEATS = 7
+
+
+def _create_stream(n):
+    """
+    :return: SSE bytes of ``n`` events, w/ a single end event at the end,
+        one item per event
+    """
+    events = [
+        data
+        for data_dicts in (
+            WORKFLOW_DATA1,
+            WORKFLOW_DATA2,
+            WORKFLOW_DATA3,
+            WORKFLOW_DATA4,
+            CHATFLOW_DATA1,
+            CHATFLOW_DATA2,
+            CHATFLOW_DATA3,
+        )
+        for data in data_dicts
+        if data["event"] not in ("workflow_finished", "message_end")
+        and "conversation_id" not in data  # replay as Workflow
+    ]
+    events = (events * (n // len(events) + 1))[: n - 1]
+    events.append({"event": "workflow_finished", "data": {}})
+
+    return [
+        "data: {}\n\n".format(json.dumps(data)).encode("utf-8")
+        for data in events
+    ]
+
+
+class _SimulatedResponse(requests.Response):
+    """
+    replay ``stream`` as Dify does: one event per chunk of chunked
+    transfer encoding, which ``iter_content(chunk_size=None)`` yields as is
+    """
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+        self._content_consumed = True
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        if chunk_size is None:
+            yield from self.events
+            return
+        stream = b"".join(self.events)
+        for i in range(0, len(stream), chunk_size):
+            yield stream[i : i + chunk_size]
+
+
+class _SimulatedApp:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _open_reply_response(self, *_):
+        return _SimulatedResponse(self.stream)
+
+
+class _FormerConversationRound(_ConversationRound):
+    """
+    ``_ConversationRound`` as before, i.e. ``iter_lines()`` + ``decode()``
+    + ``json.loads()`` per line; w/o debug mode & Chatflow handling
+    """
+
+    def __init__(self, app, newest_msg, context=None):
+        super().__init__(app, newest_msg, context)
+        self.iter_lines = self.response.iter_lines()
+
+    def _next_chunk(self):
+        text = None
+        event = _SSE.IRRELEVANT  # default
+
+        while not event:
+            line = next(self.iter_lines).decode(self.TEXT_STREAM_ENCODING)
+            if not line.startswith("data: "):
+                continue
+            data = json.loads(line[len("data: ") :])
+            try:
+                event = _SSE[data["event"]]
+            except KeyError:
+                continue
+            if event is _SSE.message:
+                text = data["answer"]
+            elif event is _SSE.text_chunk:
+                text = data["data"]["text"]
+
+        if event in _SSE.IS_END:
+            self.response.close()
+            raise StopIteration
+        return text
+
+
+def _frame_per_line(stream):  # framing & decoding only, former
+    return [
+        line[len("data: ") :]
+        for line in (
+            raw.decode(_ConversationRound.TEXT_STREAM_ENCODING)
+            for raw in _SimulatedResponse(stream).iter_lines()
+        )
+        if line.startswith("data: ")
+    ]
+
+
+def _frame_sse_parser(stream):  # framing & decoding only
+    parser = _SSEParser()
+    return [
+        data.decode(_ConversationRound.TEXT_STREAM_ENCODING)
+        for chunk in _SimulatedResponse(stream).iter_content(None)
+        for event_type, data in parser.feed(chunk)
+        if event_type == b"message"
+    ]
+
+
+def _parse_per_line(stream):
+    return list(_FormerConversationRound(_SimulatedApp(stream), None))
+
+
+def _parse_conversation_round(stream):
+    return list(_ConversationRound(_SimulatedApp(stream), None))
+
+
+def _measure(fx, stream):
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.process_time()
+        opt = fx(stream)
+        best = min(best, time.process_time() - start)
+    return best, opt
+
+
+def main(n):
+    stream = _create_stream(n)
+    print("{} events, {:.1f}MB".format(n, sum(map(len, stream)) / 2**20))
+
+    for title, former, latter in (
+        ("framing & decoding", _frame_per_line, _frame_sse_parser),
+        ("whole round", _parse_per_line, _parse_conversation_round),
+    ):
+        print(title)
+        baseline, expected = _measure(former, stream)
+        for label, fx in (
+            ("per line (former)", former),
+            ("SSE parser", latter),
+        ):
+            elapsed, opt = _measure(fx, stream)
+            assert opt == expected
+            print(
+                "  {:<20} {:7.3f}s  {:9.0f} events/s  x{:.2f}".format(
+                    label, elapsed, n / elapsed, baseline / elapsed
+                )
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
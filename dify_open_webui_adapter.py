@@ -11,7 +11,7 @@ Q.v. ``https://github.com/kami-lel/dify-open-webui-adapter``
 # todo support file uploads
 
 # adapter version
-__version__ = "2.2.0"
+__version__ = "3.0.0"
 __author__ = "kamiLeL"
 
 
@@ -23,18 +23,41 @@ APP_MODEL_CONFIGS = []
 # end of config  ###############################################################
 
 # pylint: disable=wrong-import-position
-import uuid
+import asyncio
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import AsyncGenerator
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import math
+import os
+import queue
+import re
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
 from enum import Enum, Flag, auto
 import json
 from json import JSONDecodeError
 
 from pydantic import BaseModel
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ReadTimeoutError
+
+try:  # optional, faster JSON codec, q.v. JSON_CODEC
+    import orjson
+except ImportError:
+    orjson = None
 
 # constants  ===================================================================
 OWU_USER_ROLE = "user"
 REQUEST_TIMEOUT = 30
-STREAM_REQUEST_TIMEOUT = 300
 DEFINED_APP_MODEL_CONFIG_KEYS = (
     "key",
     "model_id",
@@ -42,7 +65,159 @@ DEFINED_APP_MODEL_CONFIG_KEYS = (
     "query_input_field_identifier",
     "reply_output_variable_identifier",
     "disallows_streaming",
+    "coalesce_max_chars",
+    "coalesce_max_delay",
+    "result_cache_ttl",
+    "shares_inflight_rounds",
+    "task_policy",
+    "max_inflight_rounds",
+    "max_queued_rounds",
+    "max_queue_wait",
+    "max_inflight_rounds_per_user",
+)
+
+# streaming  *******************************************************************
+# limits of a streaming round, a round exceeding them fails w/ TimeoutError
+STREAM_CONNECT_TIMEOUT = 10  # seconds to connect to Dify
+# max seconds between SSE events, incl. Dify's pings sent every 10 seconds
+STREAM_IDLE_TIMEOUT = 60
+STREAM_TOTAL_DEADLINE = 1800  # max seconds of a whole round, None to disable
+# reply rounds w/o streaming (OWU's "stream": False, or "disallows_streaming")
+# by streaming from Dify & concatenating text in the adapter, such that they're
+# bounded by limits above instead of REQUEST_TIMEOUT
+AGGREGATES_BLOCKING_ROUNDS = False
+
+# admission  *******************************************************************
+# bound rounds of a model requesting Dify at once by "max_inflight_rounds",
+# & rounds of each OWU user by "max_inflight_rounds_per_user",
+# excess rounds wait in a queue of up to "max_queued_rounds" rounds, for
+# up to "max_queue_wait" seconds, otherwise they're replied BUSY_REPLY at once;
+# waiting rounds are admitted by priority lane, then fairly by user in round
+# robin, such that a user w/ many parallel rounds only slows down itself;
+# defaults of models w/o them
+DEFAULT_MAX_INFLIGHT_ROUNDS = 0  # 0 for unlimited
+DEFAULT_MAX_QUEUED_ROUNDS = 32
+DEFAULT_MAX_QUEUE_WAIT = 10  # seconds
+DEFAULT_MAX_INFLIGHT_ROUNDS_PER_USER = 0  # 0 for unlimited
+# most recently throttled users of each model reported in metrics
+THROTTLED_USERS_MAX_REPORTED = 100
+BUSY_REPLY = "{name} is busy, please retry in a moment."
+
+# priority lanes  **************************************************************
+# rounds waiting for "max_inflight_rounds" are admitted by lane, in order:
+# "interactive": rounds of OWU chats
+# "api": rounds w/o OWU chat (e.g. OpenAI-compatible API) or of service accounts
+# "background": rounds of OWU background tasks, e.g. title generation;
+# a round waiting for PRIORITY_AGING_WAIT seconds is admitted before rounds of
+# higher lanes, such that lower lanes are never starved
+PRIORITY_LANES = ("interactive", "api", "background")
+PRIORITY_AGING_WAIT = 2  # seconds
+AUTOMATION_USER_IDS = ()  # OWU user id or email of service accounts
+LANE_LATENCY_WINDOW = 1000  # latest rounds of each lane in latency percentiles
+
+# adaptive concurrency  ********************************************************
+# adapt max rounds in flight of each Dify App (base URL & key) to its latency,
+# by AIMD: the limit is raised while latency to 1st byte of replies stays
+# within tolerance x its baseline, & cut by backoff once latency exceeds it, or
+# requests fail by 5xx, 429 or network errors; rounds beyond the limit wait,
+# & fail w/ ConnectionError after max wait
+ENABLES_ADAPTIVE_CONCURRENCY = False
+ADAPTIVE_CONCURRENCY_INITIAL_LIMIT = 16
+ADAPTIVE_CONCURRENCY_MIN_LIMIT = 1
+ADAPTIVE_CONCURRENCY_MAX_LIMIT = 256
+ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE = 2.0  # x baseline latency
+ADAPTIVE_CONCURRENCY_BACKOFF = 0.7  # ratio the limit is multiplied on cut
+ADAPTIVE_CONCURRENCY_MAX_WAIT = 30  # seconds
+ADAPTIVE_CONCURRENCY_HISTORY_SIZE = 100  # latest limit changes in metrics
+
+# transport  *******************************************************************
+# run blocking Dify requests in transport threads when replying via Pipe.pipe(),
+# such that OWU's event loop is never stalled by a round in flight;
+# set to False to fall back to serve rounds directly in OWU's event loop
+ENABLES_ASYNC_TRANSPORT = True
+ASYNC_TRANSPORT_MAX_WORKERS = 64
+# read ahead each streaming round in a background thread, which drains Dify's
+# stream into a buffer of up to this many parsed chunks, blocking while full;
+# 0 to disable, i.e. Dify's stream is read only as OWU pulls chunks
+STREAM_PREFETCH_MAX_CHUNKS = 0
+# ask Dify to stop the task of a streaming round abandoned before its end,
+# e.g. stop pressed in OWU, freeing Dify's worker & tokens at once
+STOPS_ABANDONED_TASKS = True
+
+# HTTP connection pool  ********************************************************
+# one pooled session per Dify base URL, shared by all models
+HTTP_POOL_MAXSIZE = 64  # max kept-alive connections per base URL
+HTTP_POOL_ENABLES_TCP_KEEPALIVE = True  # send TCP keep-alive probes
+HTTP_POOL_IDLE_TIMEOUT = 300  # seconds; close session unused for longer
+
+# startup  *********************************************************************
+STARTUP_DISCOVERY_MAX_WORKERS = 8  # concurrent GET /info probes at startup
+# resolve App type & name of a model on its first use, instead of at startup
+DEFERS_APP_TYPE_DISCOVERY = False
+# file caching App type & name from GET /info across restarts, None to disable;
+# a cached model starts w/o network, & is revalidated in background;
+# opt-in, as App names & modes are private to the deployment, so prefer a
+# directory only OWU's user can access, e.g. under OWU's DATA_DIR
+APP_INFO_CACHE_PATH = None
+
+# conversation  ****************************************************************
+# bound Dify conversation_id remembered per OWU chat_id, per Chatflow model;
+# an evicted chat simply starts a new Dify conversation
+CONVERSATION_ID_STORE_MAX_ENTRIES = 10000
+CONVERSATION_ID_STORE_IDLE_TTL = 7 * 24 * 3600  # seconds since last round
+# where conversation_id are stored, either:
+# "memory": per process, lost on restart
+# "sqlite": SQLite file shared by all workers & across restarts,
+#           w/ in-memory read cache & batched write-behind
+CONVERSATION_STORE_BACKEND = "memory"
+CONVERSATION_STORE_SQLITE_PATH = os.path.join(
+    tempfile.gettempdir(), "dify_open_webui_adapter_conversations.sqlite3"
 )
+CONVERSATION_STORE_FLUSH_INTERVAL = 0.2  # seconds between write-behind batches
+# max seconds a round of a new chat waits for Dify conversation being created
+# by a concurrent 1st round of the same chat, before creating its own
+FIRST_ROUND_WAIT_TIMEOUT = 30
+
+# text coalescing  *************************************************************
+# merge consecutive text chunks of a streaming round into a single OWU chunk,
+# until the merged text reaches max chars or its 1st chunk waited max delay;
+# the 1st chunk of a round is always passed on immediately;
+# defaults of per-model "coalesce_max_chars" & "coalesce_max_delay"
+DEFAULT_COALESCE_MAX_CHARS = 0  # 0 to disable coalescing
+DEFAULT_COALESCE_MAX_DELAY = 0.05  # seconds
+
+# Workflow result cache  *******************************************************
+# cache replies of deterministic Workflow models, opted in per model by
+# "result_cache_ttl", keyed by hash of request payload; bounds of each model
+WORKFLOW_RESULT_CACHE_MAX_ENTRIES = 1000
+WORKFLOW_RESULT_CACHE_MAX_BYTES = 16 * 1024 * 1024  # UTF-8 size of cached text
+
+# sharing Workflow rounds in flight  *******************************************
+# identical rounds of a Workflow model opted in by "shares_inflight_rounds"
+# are served by a single Dify request, whose reply is fanned out to all;
+# beyond these bounds of each model, a round requests Dify on its own
+SHARED_ROUND_MAX_FLIGHTS = 1000  # max distinct rounds in flight
+SHARED_ROUND_MAX_SUBSCRIBERS = 100  # max rounds sharing a single one
+
+# Open WebUI tasks  ************************************************************
+# how rounds of OWU background tasks, e.g. title & tags generation, are served,
+# by per-model "task_policy"; a policy is either:
+# "pass": request Dify as user rounds, w/o continuing Chatflow conversation
+# "local": reply a cheap local answer, w/o Dify
+# "cache": as "pass", but identical task rounds are replied from cache
+# "low_priority": as "pass", bounded by TASK_ROUNDS_MAX_CONCURRENCY
+# "route:<model_id>": request Dify App of another (lightweight) model
+DEFAULT_TASK_POLICY = "pass"  # of models, or tasks, w/o "task_policy"
+TASK_REPLY_CACHE_TTL = 3600  # seconds a "cache" task reply is served
+TASK_REPLY_CACHE_MAX_ENTRIES = 1000
+TASK_ROUNDS_MAX_CONCURRENCY = 2  # "low_priority" task rounds at once
+
+# JSON codec  ******************************************************************
+# codec of request payloads & replies of Dify, selected once at import, either:
+# "auto": orjson if installed, otherwise stdlib json
+# "orjson": orjson, which must be installed
+# "json": stdlib json
+JSON_CODEC = "auto"
 
 # Dify constants  **************************************************************
 DIFY_USER_ROLE = "user"
@@ -66,6 +241,25 @@ class DifyAppType(Enum):
     CHATFLOW = "advanced-chat"  # multi-turn chats
 
 
+# an entry of APP_MODEL_CONFIGS, as parsed by OWUModel
+_ParsedAppModelConfig = namedtuple(
+    "_ParsedAppModelConfig",
+    (
+        "key",
+        "model_id",
+        "name",
+        "disallows_streaming",
+        "coalesce_max_chars",
+        "coalesce_max_delay",
+        "task_policies",
+        "max_inflight_rounds",
+        "max_queued_rounds",
+        "max_queue_wait",
+        "max_inflight_rounds_per_user",
+    ),
+)
+
+
 # Open WebUI side  #############################################################
 class OWUModel:
     """
@@ -77,6 +271,9 @@ class OWUModel:
     :type base_url: str
     :param config: an entry of APP_MODEL_CONFIGS
     :type config: dict
+    :param defer_get_app_type_and_name: postpone GET /info & creating app
+            until first access of ``.app``
+    :type defer_get_app_type_and_name: bool
     :raises ValueError:
     :raises TypeError:
     """
@@ -88,27 +285,68 @@ class OWUModel:
         *,
         disable_get_app_type_and_name=False,
         app_type_override=None,
+        defer_get_app_type_and_name=False,
     ):
         self.base_url = base_url
-
-        self.key, self.model_id, provided_name, self.disallows_streaming = (
-            self._parse_app_model_config_arg(app_model_config)
+        self.app_model_config = app_model_config
+
+        parsed = self._parse_app_model_config_arg(app_model_config)
+        self.key = parsed.key
+        self.model_id = parsed.model_id
+        self.provided_name = parsed.name
+        self.disallows_streaming = parsed.disallows_streaming
+        self.coalesce_max_chars = parsed.coalesce_max_chars
+        self.coalesce_max_delay = parsed.coalesce_max_delay
+        self.task_policies = parsed.task_policies
+
+        # bound rounds requesting Dify at once, if limited
+        self.admission_gate = (
+            _AdmissionGate(
+                parsed.max_inflight_rounds,
+                parsed.max_queued_rounds,
+                parsed.max_queue_wait,
+                max_inflight_per_user=parsed.max_inflight_rounds_per_user,
+            )
+            if parsed.max_inflight_rounds
+            or parsed.max_inflight_rounds_per_user
+            else None
         )
 
-        app_type, response_name = self._get_app_type_and_name_by_dify_get_info(
-            disable=disable_get_app_type_and_name
-        )
-        if app_type_override is not None:  # for unit test w/o network
-            app_type = app_type_override
+        self._disable_get_app_type_and_name = disable_get_app_type_and_name
+        self._app_type_override = app_type_override
 
-        # set self.name
-        self.name = provided_name or response_name or self.model_id
+        # set self.name, may be updated by name responded from Dify
+        self.name = self.provided_name or self.model_id
 
         # create app
-        if app_type == DifyAppType.WORKFLOW:
-            self.app = WorkflowDifyApp(self, app_model_config)
-        else:
-            self.app = ChatflowDifyApp(self)
+        self._app = None
+        self._app_lock = threading.Lock()
+        self._app_info_revalidation = None  # Future, if revalidating
+        if not defer_get_app_type_and_name:
+            self._create_app()
+
+    @property
+    def app(self):
+        """
+        :return: Dify App of this model, created on first access if deferred
+        :rtype: BaseDifyApp
+        :raises ConnectionError:
+        :raises ValueError:
+        """
+        if self._app is None:
+            return self._create_app()
+        return self._app
+
+    def get_task_policy(self, task):
+        """
+        :param task: OWU background task, e.g. ``"title_generation"``
+        :type task: str
+        :return: policy serving rounds of ``task``, q.v. DEFAULT_TASK_POLICY
+        :rtype: str
+        """
+        return self.task_policies.get(
+            task, self.task_policies.get(None, DEFAULT_TASK_POLICY)
+        )
 
     def get_model_id_and_name(self):
         """
@@ -118,7 +356,7 @@ class OWUModel:
         """
         return {"id": self.model_id, "name": self.name}
 
-    def reply(self, body, user, metadata):
+    def reply(self, body, user, metadata, concurrency_permit=None):
         """
         handle OWU side of processing per-round response of conversation
 
@@ -129,6 +367,10 @@ class OWUModel:
         :type user: dict
         :param metadata: `__metadata__` given by Pipe.pipes(body, __user__)
         :type metadata: dict
+        :param concurrency_permit: slot of adaptive concurrency acquired
+                by ``acquire_concurrency_permit()``, released by this round;
+                None to acquire it blocking, if enabled
+        :type concurrency_permit: _LimiterPermit
         :raises ConnectionError:
         :raises ValueError:
         :raises KeyError:
@@ -142,11 +384,73 @@ class OWUModel:
         enable_stream = "stream" in body and bool(body["stream"])
 
         # call DifyApp  --------------------------------------------------------
-        self.app.update(user, metadata)
-        opt = self.app.reply(newest_msg, enable_stream)
+        context = self.app.create_round_context(user, metadata, enable_stream)
+        context.pending_concurrency_permit = concurrency_permit
+        try:
+            opt = self.app.reply(newest_msg, context)
+        finally:
+            self._release_pending_concurrency_permit(context)
+
+        return opt
+
+    async def reply_async(self, body, user, metadata):
+        """
+        asyncio counterpart of ``reply()``,
+        blocking network I/O is run in transport threads
+
+
+        :raises ConnectionError:
+        :raises ValueError:
+        :raises KeyError:
+        :return: the response
+        :rtype: str or AsyncGenerator
+        """
+        newest_msg = self._get_newest_user_message_from_body(body)
+        enable_stream = "stream" in body and bool(body["stream"])
+
+        if self._app is None:  # deferred, GET /info in transport threads
+            await _run_in_transport_thread(self._create_app)
+
+        # may wait for concurrent 1st round of the same chat
+        context = await self.app.create_round_context_async(
+            user, metadata, enable_stream
+        )
+        # wait for adaptive concurrency here, never in transport threads,
+        # which are needed by rounds in flight to read their replies
+        try:
+            context.pending_concurrency_permit = (
+                await self.acquire_concurrency_permit()
+            )
+        except BaseException:  # incl. cancelled, never requests Dify
+            self.app.release_first_round(context)
+            raise
+        try:
+            opt = await self.app.reply_async(newest_msg, context)
+        finally:
+            self._release_pending_concurrency_permit(context)
 
         return opt
 
+    async def acquire_concurrency_permit(self):
+        """
+        :return: a slot of adaptive concurrency of this Dify App, waited for
+                w/o blocking OWU's event loop; None if disabled
+        :rtype: _LimiterPermit or None
+        :raises ConnectionError: no slot within its max wait
+        """
+        if not ENABLES_ADAPTIVE_CONCURRENCY:
+            return None
+        return await _get_adaptive_limiter(
+            self.base_url, self.key
+        ).acquire_async()
+
+    @staticmethod
+    def _release_pending_concurrency_permit(context):
+        # never requested Dify, e.g. served by result cache or shared round
+        if context.pending_concurrency_permit is not None:
+            context.pending_concurrency_permit.release()
+            context.pending_concurrency_permit = None
+
     def http_header(self, enable_stream=False):
         """
         :return: HTTP header (including authorization info)
@@ -163,15 +467,26 @@ class OWUModel:
 
         return header_dict
 
+    @property
+    def http_session(self):
+        """
+        :return: pooled HTTP session to access Dify Backend API,
+                shared by all models of the same base URL
+        :rtype: requests.Session
+        """
+        return _http_session_pool.session(self.base_url)
+
     def _parse_app_model_config_arg(self, config):
         """
-        test & parse ``app_model_config`` arg, then set:
+        test & parse ``app_model_config`` arg
 
         helper method used in __init__()
 
 
         :param config: app_model_config arg
         :type config: dict
+        :return: parsed values, incl. defaults of absent keys
+        :rtype: _ParsedAppModelConfig
         :raises ValueError:
         :raises TypeError:
         """
@@ -228,14 +543,222 @@ class OWUModel:
                     )
                 )
 
-        return key, model_id, name, disallows_streaming
+        # coalescing  ----------------------------------------------------------
+        coalesce_max_chars = config.get(
+            "coalesce_max_chars", DEFAULT_COALESCE_MAX_CHARS
+        )
+        if (
+            not isinstance(coalesce_max_chars, int)
+            or isinstance(coalesce_max_chars, bool)
+            or coalesce_max_chars < 0
+        ):
+            raise TypeError(
+                "entry in APP_MODEL_CONFIGS, "
+                + "value of 'coalesce_max_chars' must be "
+                + "non-negative int: {}".format(coalesce_max_chars)
+            )
+
+        coalesce_max_delay = config.get(
+            "coalesce_max_delay", DEFAULT_COALESCE_MAX_DELAY
+        )
+        if (
+            not isinstance(coalesce_max_delay, (int, float))
+            or isinstance(coalesce_max_delay, bool)
+            or coalesce_max_delay < 0
+        ):
+            raise TypeError(
+                "entry in APP_MODEL_CONFIGS, "
+                + "value of 'coalesce_max_delay' must be "
+                + "non-negative number: {}".format(coalesce_max_delay)
+            )
+
+        # result cache & sharing rounds in flight  -----------------------------
+        # used by Workflow apps, validated here, as apps may be created later
+        result_cache_ttl = config.get("result_cache_ttl", 0)
+        if (
+            not isinstance(result_cache_ttl, (int, float))
+            or isinstance(result_cache_ttl, bool)
+            or result_cache_ttl < 0
+        ):
+            raise TypeError(
+                "entry in APP_MODEL_CONFIGS, "
+                + "value of 'result_cache_ttl' must be "
+                + "non-negative number: {}".format(result_cache_ttl)
+            )
+
+        shares_inflight_rounds = config.get("shares_inflight_rounds", False)
+        if not isinstance(shares_inflight_rounds, bool):
+            raise TypeError(
+                "entry in APP_MODEL_CONFIGS, "
+                + "value of 'shares_inflight_rounds' must be bool: {}".format(
+                    shares_inflight_rounds
+                )
+            )
+
+        # task policy  ---------------------------------------------------------
+        # either a policy of all tasks, or policies by task
+        task_policy = config.get("task_policy", DEFAULT_TASK_POLICY)
+        if isinstance(task_policy, str):
+            task_policies = {None: task_policy}
+        elif isinstance(task_policy, dict) and all(
+            isinstance(task, str) for task in task_policy
+        ):
+            task_policies = dict(task_policy)
+        else:
+            raise TypeError(
+                "entry in APP_MODEL_CONFIGS, "
+                + "value of 'task_policy' must be str "
+                + "or dict of str: {}".format(task_policy)
+            )
+
+        for policy in task_policies.values():
+            if not _is_valid_task_policy(policy):
+                raise ValueError(
+                    "entry in APP_MODEL_CONFIGS, "
+                    + "invalid 'task_policy': {}".format(policy)
+                )
+
+        # admission  -----------------------------------------------------------
+        max_inflight_rounds = config.get(
+            "max_inflight_rounds", DEFAULT_MAX_INFLIGHT_ROUNDS
+        )
+        max_queued_rounds = config.get(
+            "max_queued_rounds", DEFAULT_MAX_QUEUED_ROUNDS
+        )
+        max_inflight_rounds_per_user = config.get(
+            "max_inflight_rounds_per_user",
+            DEFAULT_MAX_INFLIGHT_ROUNDS_PER_USER,
+        )
+        for config_key, value in (
+            ("max_inflight_rounds", max_inflight_rounds),
+            ("max_queued_rounds", max_queued_rounds),
+            ("max_inflight_rounds_per_user", max_inflight_rounds_per_user),
+        ):
+            if (
+                not isinstance(value, int)
+                or isinstance(value, bool)
+                or value < 0
+            ):
+                raise TypeError(
+                    "entry in APP_MODEL_CONFIGS, "
+                    + "value of '{}' must be non-negative int: {}".format(
+                        config_key, value
+                    )
+                )
+
+        max_queue_wait = config.get("max_queue_wait", DEFAULT_MAX_QUEUE_WAIT)
+        if (
+            not isinstance(max_queue_wait, (int, float))
+            or isinstance(max_queue_wait, bool)
+            or max_queue_wait < 0
+        ):
+            raise TypeError(
+                "entry in APP_MODEL_CONFIGS, "
+                + "value of 'max_queue_wait' must be "
+                + "non-negative number: {}".format(max_queue_wait)
+            )
+
+        return _ParsedAppModelConfig(
+            key=key,
+            model_id=model_id,
+            name=name,
+            disallows_streaming=disallows_streaming,
+            coalesce_max_chars=coalesce_max_chars,
+            coalesce_max_delay=coalesce_max_delay,
+            task_policies=task_policies,
+            max_inflight_rounds=max_inflight_rounds,
+            max_queued_rounds=max_queued_rounds,
+            max_queue_wait=max_queue_wait,
+            max_inflight_rounds_per_user=max_inflight_rounds_per_user,
+        )
+
+    def _create_app(self):
+        """
+        get Dify App type & name, then create ``self.app``
+
+        helper method used in __init__() or at first access of ``.app``
+
+
+        :return: the created app
+        :rtype: BaseDifyApp
+        :raises ConnectionError:
+        :raises ValueError:
+        """
+        with self._app_lock:
+            if self._app is not None:  # created by another thread
+                return self._app
+
+            cached = None
+            if not self._disable_get_app_type_and_name:
+                cached = _app_info_cache.get(self.base_url, self.key)
+
+            if cached is None:
+                app_type, response_name = (
+                    self._get_app_type_and_name_by_dify_get_info(
+                        disable=self._disable_get_app_type_and_name
+                    )
+                )
+                if not self._disable_get_app_type_and_name:
+                    _app_info_cache.put(
+                        self.base_url, self.key, app_type, response_name
+                    )
+
+            else:  # stale-while-revalidate
+                app_type, response_name = cached
+                self._app_info_revalidation = _get_transport_executor().submit(
+                    self._revalidate_app_info
+                )
+
+            self._set_app(app_type, response_name)
+            return self._app
+
+    def _set_app(self, app_type, response_name):
+        """
+        (re)create ``self.app`` by App type, & update ``self.name``
+        """
+        if self._app_type_override is not None:  # for unit test w/o network
+            app_type = self._app_type_override
+
+        self.name = self.provided_name or response_name or self.model_id
+
+        if self._app is not None and self._app.app_type == app_type:
+            return  # unchanged
+
+        if app_type == DifyAppType.WORKFLOW:
+            self._app = WorkflowDifyApp(self, self.app_model_config)
+        else:
+            self._app = ChatflowDifyApp(self)
+
+    def _revalidate_app_info(self):
+        """
+        GET /info in background for a model created from cached App info,
+        then refresh cache & the model
+
+        :return: whether App info is changed
+        :rtype: bool
+        """
+        try:
+            app_type, response_name = (
+                self._get_app_type_and_name_by_dify_get_info()
+            )
+        except (ConnectionError, ValueError):
+            _app_info_cache.counters.incr("revalidation_failures")
+            return False  # keep using cached
+
+        changed = _app_info_cache.put(
+            self.base_url, self.key, app_type, response_name
+        )
+        if changed:
+            with self._app_lock:
+                self._set_app(app_type, response_name)
+        return changed
 
     def _get_app_type_and_name_by_dify_get_info(self, disable=False):
         """
         by GET /info endpoint of Dify Backend API,
         get Dify app type and its name
 
-        helper method used in __init__()
+        helper method used in _create_app()
 
 
         :raises ConnectionError:
@@ -250,7 +773,7 @@ class OWUModel:
 
         # GET /info  -----------------------------------------------------------
         try:
-            response_object = requests.get(
+            response_object = self.http_session.get(
                 info_url,
                 headers=self.http_header(),
                 timeout=REQUEST_TIMEOUT,
@@ -285,7 +808,7 @@ class OWUModel:
         )
 
     def __repr__(self):
-        return "OWUModel({}:{})".format(self.name, repr(self.app))
+        return "OWUModel({}:{})".format(self.name, repr(self._app))
 
 
 # Dify side  ###################################################################
@@ -300,6 +823,8 @@ class BaseDifyApp:
     :type model: OWUModel
     """
 
+    app_type = None  # DifyAppType
+
     def __init__(self, model):
         self.model = model
 
@@ -311,6 +836,13 @@ class BaseDifyApp:
         """
         raise NotImplementedError
 
+    def stop_endpoint_url(self, task_id):
+        """
+        :return: endpoint URL to stop a streaming task in Dify
+        :rtype: str
+        """
+        raise NotImplementedError
+
     @property
     def base_url(self):  # pylint: disable=missing-function-docstring
         return self.model.base_url
@@ -323,34 +855,91 @@ class BaseDifyApp:
     def name(self):  # pylint: disable=missing-function-docstring
         return self.model.name
 
-    def update(self, user, metadata):
+    def create_round_context(self, user, metadata, enable_stream):
         """
         parse ``__user__`` and ``__metadata__``
-        and extract/update relevant information from them
+        and extract relevant information of a single round from them
+
+        as an App serves concurrent rounds, per-round state lives only in
+        the returned context, never in the App
 
 
         :param user:
         :type user: dict
         :param metadata:
         :type metadata: dict
+        :param enable_stream: whether streaming is requested by OWU
+        :type enable_stream: bool
+        :rtype: _RoundContext
         """
-        return  # no op
+        return _RoundContext(
+            enable_stream=not self.model.disallows_streaming and enable_stream
+        )
+
+    async def create_round_context_async(self, user, metadata, enable_stream):
+        """
+        asyncio counterpart of ``create_round_context()``
 
-    def reply(self, newest_msg, enable_stream):
+
+        :rtype: _RoundContext
+        """
+        return self.create_round_context(user, metadata, enable_stream)
+
+    def reply(self, newest_msg, context):
         """
         handle Dify side of processing per-round response of conversation,
         by requesting Dify Backend API
 
 
+        :param context: context of this round
+        :type context: _RoundContext
         :raises ConnectionError:
         :raises KeyError:
         :return: the response
         :rtype: str or Iterable
         """
-        return (
-            self._reply_streaming(newest_msg)
-            if not self.model.disallows_streaming and enable_stream
-            else self._reply_blocking(newest_msg)
+        if not context.enable_stream:
+            if AGGREGATES_BLOCKING_ROUNDS:
+                return self._reply_aggregated(newest_msg, context)
+            return self._reply_blocking(newest_msg, context)
+
+        conversation_round = self._reply_streaming(newest_msg, context)
+        if self.model.coalesce_max_chars:
+            return _CoalescedConversationRound(
+                conversation_round,
+                self.model.coalesce_max_chars,
+                self.model.coalesce_max_delay,
+            )
+        return conversation_round
+
+    async def reply_async(self, newest_msg, context):
+        """
+        asyncio counterpart of ``reply()``
+
+
+        :raises ConnectionError:
+        :raises KeyError:
+        :return: the response
+        :rtype: str or AsyncGenerator
+        """
+        if context.enable_stream:
+            conversation_round = await _run_in_transport_thread(
+                self._reply_streaming, newest_msg, context
+            )
+            return _AsyncConversationRound(
+                conversation_round,
+                self.model.coalesce_max_chars,
+                self.model.coalesce_max_delay,
+            )
+
+        return await _run_in_transport_thread(
+            (
+                self._reply_aggregated
+                if AGGREGATES_BLOCKING_ROUNDS
+                else self._reply_blocking
+            ),
+            newest_msg,
+            context,
         )
 
     def http_header(
@@ -358,57 +947,138 @@ class BaseDifyApp:
     ):  # pylint: disable=missing-function-docstring
         return self.model.http_header(enable_stream=enable_stream)
 
-    def _reply_blocking(self, newest_msg):
+    @property
+    def http_session(self):  # pylint: disable=missing-function-docstring
+        return self.model.http_session
+
+    def release_first_round(self, context):
+        """
+        called once a round no longer creates a new Dify conversation,
+        either succeeded or failed
+        """
+        return  # no op
+
+    def stop_task(self, task_id):
+        """
+        ask Dify to stop streaming task ``task_id`` of an abandoned round;
+        best effort, failures are only counted
+
+
+        :param task_id:
+        :type task_id: str
+        """
+        _streaming_round_counters.incr("stop_requests")
+        try:
+            with self.http_session.post(
+                self.stop_endpoint_url(task_id),
+                headers=self.http_header(),
+                data=_json_codec.dumps({"user": DIFY_USER_ROLE}),
+                timeout=REQUEST_TIMEOUT,
+            ) as response_obj:
+                response_obj.raise_for_status()
+
+        except requests.exceptions.RequestException:
+            _streaming_round_counters.incr("stop_failures")
+
+    def _reply_blocking(self, newest_msg, context):
         """
         :return: the response
         :rtype: str
         """
         raise NotImplementedError
 
-    def _reply_streaming(self, newest_msg):
+    def _reply_aggregated(self, newest_msg, context):
+        """
+        reply a round w/o streaming, by streaming from Dify
+        & concatenating text chunks
+
+
+        :return: the response
+        :rtype: str
+        """
+        context.enable_stream = True  # towards Dify
+        with _ConversationRound(
+            self, newest_msg, context
+        ) as conversation_round:
+            return "".join(conversation_round)
+
+    def _reply_streaming(self, newest_msg, context):
         """
         :return: response
         :rtype: Iterable
         """
-        raise NotImplementedError
+        conversation_round = _ConversationRound(self, newest_msg, context)
+        if STREAM_PREFETCH_MAX_CHUNKS:
+            return _PrefetchedConversationRound(
+                conversation_round, STREAM_PREFETCH_MAX_CHUNKS
+            )
+        return conversation_round
 
-    def _create_post_request_payload(self, newest_msg, enable_stream=False):
+    def _create_post_request_payload(self, newest_msg, context):
         """
         :return: JSON-formatted request payload data,
-                e.g. it can be feed to ``requests.post(data=~)``
-        :rtype: str
+                e.g. it can be feed to ``requests.Session.post(data=~)``
+        :rtype: bytes
         """
         raise NotImplementedError
 
-    def _open_reply_response(self, newest_msg, enable_stream=False):
+    def _open_reply_response(self, newest_msg, context):
         """
         :return: per-round response connecting to Dify
         :rtype: requests.Response
         :raises ConnectionError:
         """
+        enable_stream = context.enable_stream
+        # acquired by OWUModel w/o blocking a thread, if any
+        permit = context.pending_concurrency_permit
+        context.pending_concurrency_permit = None
+        if permit is None and ENABLES_ADAPTIVE_CONCURRENCY:  # sync callers
+            permit = _get_adaptive_limiter(
+                self.base_url, self.model.key
+            ).acquire()
+        if permit is not None:
+            permit.sent_at = time.monotonic()
+
         try:
-            data = self._create_post_request_payload(newest_msg, enable_stream)
+            data = self._create_post_request_payload(newest_msg, context)
             headers = self.http_header(enable_stream)
-            response_obj = requests.post(
+            response_obj = self.http_session.post(
                 self.endpoint_url,
                 headers=headers,
                 data=data,
                 stream=enable_stream,
                 timeout=(
-                    STREAM_REQUEST_TIMEOUT
+                    (STREAM_CONNECT_TIMEOUT, STREAM_IDLE_TIMEOUT)
                     if enable_stream
                     else REQUEST_TIMEOUT
                 ),
             )
             response_obj.raise_for_status()
-            return response_obj
 
         # handle network errors
         except requests.exceptions.RequestException as err:
+            if permit is not None:
+                permit.sample(is_congested=_is_congestion_error(err))
+                permit.release()
             raise ConnectionError(
-                "fail request to Dify: {}\n{}".format(err.args[0], data)
+                "fail request to Dify: {}\n{}".format(
+                    err.args[0], data.decode("utf-8", "replace")
+                )
             ) from err
 
+        except BaseException:
+            if permit is not None:
+                permit.release()
+            raise
+
+        if permit is not None:
+            if enable_stream:  # sampled by 1st chunk, held until closed
+                context.concurrency_permit = permit
+            else:  # whole reply is read already
+                permit.sample()
+                permit.release()
+        return response_obj
+
     def __repr__(self):
         return "{}({})".format(type(self).__name__, self.name)
 
@@ -418,6 +1088,8 @@ class WorkflowDifyApp(BaseDifyApp):
     representing a Workflow App in Dify
     """
 
+    app_type = DifyAppType.WORKFLOW
+
     def __init__(self, model, config):
         super().__init__(model)
         # read from config  ----------------------------------------------------
@@ -436,20 +1108,155 @@ class WorkflowDifyApp(BaseDifyApp):
             if k not in DEFINED_APP_MODEL_CONFIG_KEYS
         }
 
+        # result cache, opt-in, validated by OWUModel  -----------------------
+        result_cache_ttl = config.get("result_cache_ttl", 0)
+        self.result_cache = (
+            _WorkflowResultCache(result_cache_ttl)
+            if result_cache_ttl
+            else None
+        )
+
+        # sharing identical rounds in flight, opt-in, validated by OWUModel  --
+        shares_inflight_rounds = config.get("shares_inflight_rounds", False)
+        self.shared_rounds = (
+            _SharedRoundTable() if shares_inflight_rounds else None
+        )
+
     @property
     def endpoint_url(self):
         return "{}/workflows/run".format(self.base_url)
 
-    def _reply_blocking(self, newest_msg):
+    def stop_endpoint_url(self, task_id):
+        return "{}/workflows/tasks/{}/stop".format(self.base_url, task_id)
+
+    def _reply_aggregated(self, newest_msg, context):
+        return self._reply_once(self._request_aggregated, newest_msg, context)
+
+    def _reply_blocking(self, newest_msg, context):
         """
         :raises ConnectionError:
         :raises KeyError:
         """
-        response_object = self._open_reply_response(newest_msg, False)
-        response = response_object.json()
+        return self._reply_once(self._request_blocking, newest_msg, context)
+
+    def _reply_streaming(self, newest_msg, context):
+        result_key = self._create_result_key(newest_msg, context)
+        cached = self._look_up_result_cache(result_key)
+        if cached is not None:
+            reply, chunks = cached
+            return _ReplayedConversationRound(chunks or (reply,))
+
+        subscriber, is_leader = self._join_shared_round(
+            result_key, "streaming"
+        )
+        if subscriber is None:
+            return self._request_streaming(newest_msg, context, result_key)
+
+        if is_leader:  # pump Dify's stream to all subscribers
+            try:
+                conversation_round = self._request_streaming(
+                    newest_msg, context, result_key
+                )
+            except BaseException as err:
+                subscriber.shared_round.finish(err)
+                subscriber.close()
+                raise
+            subscriber.shared_round.start_pump(conversation_round)
+
+        return subscriber
+
+    async def reply_async(self, newest_msg, context):
+        if context.enable_stream:
+            return await super().reply_async(newest_msg, context)
+
+        opt = await _run_in_transport_thread(
+            self._lead_once,
+            (
+                self._request_aggregated
+                if AGGREGATES_BLOCKING_ROUNDS
+                else self._request_blocking
+            ),
+            newest_msg,
+            context,
+        )
+        if not isinstance(opt, _SharedRoundSubscriber):
+            return opt
+
+        # wait for the leader's reply in event loop, holding no thread
+        with opt:
+            return await opt.next_async(None)
+
+    def _reply_once(self, request, newest_msg, context):
+        """
+        reply a round w/o streaming by ``request``, unless it's served by
+        result cache or by an identical round in flight
+
+
+        :param request: either ``_request_blocking()``
+                or ``_request_aggregated()``
+        :type request: Callable
+        :return: the response
+        :rtype: str
+        """
+        opt = self._lead_once(request, newest_msg, context)
+        if not isinstance(opt, _SharedRoundSubscriber):
+            return opt
+
+        with opt:  # wait for the leader's reply
+            return next(opt)
+
+    def _lead_once(self, request, newest_msg, context):
+        """
+        ``_reply_once()``, except that an identical round in flight
+        is never waited for
+
+
+        :return: the response, or subscriber of the identical round
+        :rtype: str or _SharedRoundSubscriber
+        """
+        result_key = self._create_result_key(newest_msg, context)
+        cached = self._look_up_result_cache(result_key)
+        if cached is not None:
+            return cached[0]
+
+        subscriber, is_leader = self._join_shared_round(result_key, "blocking")
+        if subscriber is None:
+            return request(newest_msg, context, result_key)
+        if not is_leader:
+            return subscriber
+
+        with subscriber:
+            try:
+                reply = request(newest_msg, context, result_key)
+            except BaseException as err:
+                subscriber.shared_round.finish(err)
+                raise
+            subscriber.shared_round.publish(reply)
+            subscriber.shared_round.finish()
+            return reply
+
+    def _request_aggregated(self, newest_msg, context, result_key):
+        text = super()._reply_aggregated(newest_msg, context)
+
+        # prefer the output variable, as blocking replies do, as it's also
+        # set by nodes which never stream text chunks
+        if (
+            isinstance(context.outputs, dict)
+            and self.reply_identifier in context.outputs
+        ):
+            self._store_result(result_key, context)
+            return context.outputs[self.reply_identifier]
+        return text
+
+    def _request_blocking(self, newest_msg, context, result_key):
+        response_object = self._open_reply_response(newest_msg, context)
 
         try:
-            return response["data"]["outputs"][self.reply_identifier]
+            response = _json_codec.loads(response_object.content)
+            context.outputs = response["data"]["outputs"]
+            reply = context.outputs[self.reply_identifier]
+            self._store_result(result_key, context)
+            return reply
 
         except KeyError as err:
             raise KeyError(
@@ -461,20 +1268,89 @@ class WorkflowDifyApp(BaseDifyApp):
         finally:
             response_object.close()
 
-    def _reply_streaming(self, newest_msg):
+    def _request_streaming(self, newest_msg, context, result_key):
+        conversation_round = super()._reply_streaming(newest_msg, context)
+        if self.result_cache is None or result_key is None:
+            return conversation_round
+        return _RecordedConversationRound(
+            conversation_round,
+            functools.partial(self._store_result, result_key, context),
+        )
+
+    def _create_result_key(self, newest_msg, context):
         """
-        :raises ValueError:
+        :return: canonical hash of request payload of this round,
+                regardless of response mode & order of input fields;
+                None if neither cached nor shared
+        :rtype: str or None
         """
-        return _ConversationRound(self, newest_msg)
+        if (
+            self.result_cache is None and self.shared_rounds is None
+        ) or DEBUG_CONVERSATION_ROUND_DIRECT_RESPONSE:
+            return None
 
-    def _create_post_request_payload(self, newest_msg, enable_stream=False):
-        payload_dict = {
+        payload_dict = self._create_post_request_payload_dict(
+            newest_msg, context
+        )
+        del payload_dict["response_mode"]
+        return hashlib.sha256(
+            json.dumps(
+                payload_dict,
+                sort_keys=True,
+                separators=(",", ":"),
+                default=str,
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def _look_up_result_cache(self, result_key):
+        """
+        :return: cached result, i.e. ``(reply, chunks)``, None if absent
+        :rtype: tuple or None
+        """
+        if self.result_cache is None or result_key is None:
+            return None
+        return self.result_cache.get(result_key)
+
+    def _join_shared_round(self, result_key, response_mode):
+        """
+        :return: subscriber of the identical round in flight,
+                & whether it's the leader requesting Dify;
+                ``(None, False)`` if not shared
+        :rtype: tuple(_SharedRoundSubscriber or None, bool)
+        """
+        if self.shared_rounds is None or result_key is None:
+            return None, False
+        return self.shared_rounds.join((result_key, response_mode))
+
+    def _store_result(self, result_key, context, chunks=None):
+        """
+        cache the result of a finished round, if its reply is text
+        """
+        if (
+            self.result_cache is None
+            or result_key is None
+            or not isinstance(context.outputs, dict)
+        ):
+            return
+        reply = context.outputs.get(self.reply_identifier)
+        if isinstance(reply, str):
+            self.result_cache.put(
+                result_key, reply, None if chunks is None else tuple(chunks)
+            )
+
+    def _create_post_request_payload_dict(self, newest_msg, context):
+        return {
             "inputs": {self.query_identifier: newest_msg, **self.input_fields},
-            "response_mode": "streaming" if enable_stream else "blocking",
+            "response_mode": (
+                "streaming" if context.enable_stream else "blocking"
+            ),
             "user": DIFY_USER_ROLE,
         }
 
-        return json.dumps(payload_dict)
+    def _create_post_request_payload(self, newest_msg, context):
+        return _json_codec.dumps(
+            self._create_post_request_payload_dict(newest_msg, context)
+        )
 
 
 class ChatflowDifyApp(BaseDifyApp):
@@ -482,50 +1358,128 @@ class ChatflowDifyApp(BaseDifyApp):
     representing a Chatflow App in Dify
     """
 
+    app_type = DifyAppType.CHATFLOW
+
     def __init__(self, model):
         super().__init__(model)
-        self.current_chat_id = ""
-        self.chat2conversation_ids = {}
+        self.chat2conversation_ids = _create_conversation_id_store(
+            self.base_url, self.model.key
+        )
+        self.first_rounds = _FirstRoundTable()
+        self.counters = _Counters("rounds", "ephemeral_rounds")
 
     @property
     def endpoint_url(self):
         return "{}/chat-messages".format(self.base_url)
 
-    @property
-    def conversation_id(self):
-        """
-        :return: correct Dify ``conversation_id``
-                (depends on OWU ``chat_id``);
-                empty if a new conversation is required
-        :rtype: str
+    def stop_endpoint_url(self, task_id):
+        return "{}/chat-messages/{}/stop".format(self.base_url, task_id)
+
+    def create_round_context(self, user, metadata, enable_stream):
+        context = self._create_chat_round_context(
+            user, metadata, enable_stream
+        )
+        if context.is_ephemeral:
+            return context
+
+        # correct Dify conversation_id (depends on OWU chat_id);
+        # empty if a new conversation is required
+        while True:
+            context.conversation_id = self.chat2conversation_ids.get(
+                context.chat_id, ""
+            )
+            if context.conversation_id:
+                break
+
+            # only a single 1st round creates the conversation,
+            # other rounds of the same chat wait for it
+            if self.first_rounds.claim(context.chat_id):
+                context.claims_first_round = True
+                break
+
+        return context
+
+    async def create_round_context_async(self, user, metadata, enable_stream):
+        context = self._create_chat_round_context(
+            user, metadata, enable_stream
+        )
+        if context.is_ephemeral:
+            return context
+
+        # as create_round_context(), but waits for the 1st round of the
+        # same chat in event loop, holding no transport thread
+        while True:
+            context.conversation_id = await _run_in_transport_thread(
+                self.chat2conversation_ids.get, context.chat_id, ""
+            )
+            if context.conversation_id:
+                break
+
+            if await self.first_rounds.claim_async(context.chat_id):
+                context.claims_first_round = True
+                break
+
+        return context
+
+    def _create_chat_round_context(self, user, metadata, enable_stream):
         """
-        if self.current_chat_id not in self.chat2conversation_ids:
-            # waiting to be set
-            self.chat2conversation_ids[self.current_chat_id] = ""
+        ``create_round_context()`` w/o looking up ``conversation_id``
 
-        return self.chat2conversation_ids[self.current_chat_id]
 
-    @conversation_id.setter
-    def conversation_id(self, value):
-        self.chat2conversation_ids[self.current_chat_id] = value
+        :rtype: _RoundContext
+        """
+        context = super().create_round_context(user, metadata, enable_stream)
+
+        self.counters.incr("rounds")
 
-    def update(self, user, metadata):
-        super().update(user, metadata)
         # get chat_id from metadata
-        # use a random chat_id if it is not provided by OWU
-        self.current_chat_id = metadata.get("chat_id", uuid.uuid4().hex)
+        context.chat_id = metadata.get("chat_id")
+        if not context.chat_id or metadata.get("task"):
+            # not provided by OWU, e.g. via OpenAI-compatible API,
+            # or OWU background task of the chat, e.g. title generation,
+            # such conversation is never continued, so never remembered
+            context.chat_id = None
+            context.is_ephemeral = True
+            self.counters.incr("ephemeral_rounds")
+
+        return context
+
+    def set_conversation_id(self, context, conversation_id):
+        """
+        remember ``conversation_id`` created by Dify
+        in 1st round of a conversation
+
 
-    def _reply_blocking(self, newest_msg):
+        :param context: context of the 1st round
+        :type context: _RoundContext
+        :param conversation_id:
+        :type conversation_id: str
+        """
+        context.conversation_id = conversation_id
+        if not context.is_ephemeral:
+            self.chat2conversation_ids[context.chat_id] = conversation_id
+        self.release_first_round(context)
+
+    def release_first_round(self, context):
+        if context.claims_first_round:
+            context.claims_first_round = False
+            self.first_rounds.release(context.chat_id)
+
+    def _reply_blocking(self, newest_msg, context):
         """
         :raises ConnectionError:
         :raises KeyError:
         """
-        response_object = self._open_reply_response(newest_msg, False)
-        response = response_object.json()
+        try:
+            response_object = self._open_reply_response(newest_msg, context)
+        except ConnectionError:
+            self.release_first_round(context)
+            raise
 
         try:
-            if not self.conversation_id:  # 1st round of this conversation
-                self.conversation_id = response["conversation_id"]
+            response = _json_codec.loads(response_object.content)
+            if not context.conversation_id:  # 1st round of this conversation
+                self.set_conversation_id(context, response["conversation_id"])
 
             return response["answer"]
 
@@ -538,34 +1492,149 @@ class ChatflowDifyApp(BaseDifyApp):
 
         finally:
             response_object.close()
+            self.release_first_round(context)
 
-    def _reply_streaming(self, newest_msg):
-        """
-        :raises ValueError:
-        """
-        return _ConversationRound(self, newest_msg)
-
-    def _create_post_request_payload(self, newest_msg, enable_stream=False):
+    def _create_post_request_payload(self, newest_msg, context):
         payload_dict = {
             "query": newest_msg,
-            "response_mode": "streaming" if enable_stream else "blocking",
+            "response_mode": (
+                "streaming" if context.enable_stream else "blocking"
+            ),
             "user": DIFY_USER_ROLE,
-            "conversation_id": self.conversation_id,
+            "conversation_id": context.conversation_id,
             "auto_generate_name": False,
             "inputs": {},
         }
-        return json.dumps(payload_dict)
+        return _json_codec.dumps(payload_dict)
 
 
 # helper class  ================================================================
-
-
-class _SSE(Flag):
+class _RoundContext:
     """
-    represent a single **relevant** SSE specified by Dify Backend API
+    per-round state, passed through a single conversation round,
+    such that concurrent rounds never share mutable state
+
+
+    :param enable_stream: whether this round is replied by streaming
+    :type enable_stream: bool
+    :param chat_id: OWU ``chat_id``, for Chatflow
+    :type chat_id: str or None
+    :param is_ephemeral: whether this round is w/o OWU ``chat_id``,
+            i.e. its Dify conversation is never continued
+    :type is_ephemeral: bool
+    :param conversation_id: Dify ``conversation_id``, for Chatflow;
+            empty if a new conversation is required
+    :type conversation_id: str
     """
 
-    # pylint: disable=invalid-name
+    def __init__(
+        self,
+        enable_stream=False,
+        chat_id=None,
+        is_ephemeral=False,
+        conversation_id="",
+    ):
+        self.enable_stream = enable_stream
+        self.chat_id = chat_id
+        self.is_ephemeral = is_ephemeral
+        self.conversation_id = conversation_id
+        # whether this round is the single one creating Dify conversation
+        self.claims_first_round = False
+        # Dify task_id of a streaming round, once any event is received
+        self.task_id = None
+        # outputs of a streaming Workflow round, once it's finished
+        self.outputs = None
+        # slot of adaptive concurrency held by a streaming round, if enabled
+        self.concurrency_permit = None
+        # slot of adaptive concurrency acquired ahead, until Dify is requested
+        self.pending_concurrency_permit = None
+
+    def __repr__(self):
+        return "_RoundContext({})".format(
+            ", ".join("{}={!r}".format(k, v) for k, v in vars(self).items())
+        )
+
+
+class _Counters:
+    """
+    thread-safe named counters, used as metrics
+
+
+    :param names: names of counters, each starting from 0
+    :type names: str
+    """
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(names, 0)
+
+    def incr(self, name, value=1):
+        """
+        increase counter ``name`` by ``value``
+        """
+        with self._lock:
+            self._counts[name] += value
+
+    def __getitem__(self, name):
+        return self._counts[name]
+
+    def snapshot(self):
+        """
+        :return: current value of all counters
+        :rtype: dict{str: int}
+        """
+        with self._lock:
+            return dict(self._counts)
+
+
+class _LatencyRecorder:
+    """
+    thread-safe percentiles of the latest ``window`` latencies, as metrics
+
+
+    :param window:
+    :type window: int
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, window):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self._count = 0
+
+    def record(self, latency):
+        """
+        record ``latency`` in seconds
+        """
+        with self._lock:
+            self._samples.append(latency)
+            self._count += 1
+
+    def snapshot(self):
+        """
+        :return: count of all latencies & percentiles of the latest ones,
+                e.g. ``{"count": 3, "p50": 0.1, "p90": 0.2, "p99": 0.2}``
+        :rtype: dict{str: int or float}
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+            opt = {"count": self._count}
+
+        for percentile in self.PERCENTILES:
+            rank = math.ceil(len(samples) * percentile / 100)  # nearest-rank
+            opt["p{}".format(percentile)] = (
+                samples[max(rank, 1) - 1] if samples else None
+            )
+        return opt
+
+
+class _SSE(Flag):
+    """
+    represent a single **relevant** SSE specified by Dify Backend API
+    """
+
+    # pylint: disable=invalid-name
 
     # events we don't care about
     IRRELEVANT = 0
@@ -580,6 +1649,99 @@ class _SSE(Flag):
     IS_END = workflow_finished | message_end
 
 
+class _SSEParser:
+    """
+    incremental parser of text/event-stream working on raw bytes,
+    q.v. ``https://html.spec.whatwg.org/multipage/server-sent-events.html``
+
+    handles ``data:`` (multi-line), ``event:`` & ``id:`` fields,
+    comments, and LF/CR/CRLF line endings split anywhere across chunks;
+    payloads are left undecoded
+    """
+
+    _DEFAULT_EVENT_TYPE = b"message"
+
+    def __init__(self):
+        self.last_event_id = b""
+        self._buffer = b""  # incomplete line
+        self._skips_lf = False  # last chunk ends w/ CR, maybe of CRLF
+        self._event_type = b""
+        self._data_lines = []
+        self._is_blank_block = True  # no line since last blank line
+        # received blocks, incl. those dispatching nothing, e.g. comments,
+        # or Dify's "event: ping" w/o data; i.e. liveness of the stream
+        self.blocks = 0
+
+    def feed(self, chunk):
+        """
+        :param chunk: raw bytes of text/event-stream
+        :type chunk: bytes
+        :return: dispatched events, as ``(event_type, data)``
+        :rtype: list(tuple(bytes, bytes))
+        """
+        if self._skips_lf and chunk[:1] == b"\n":
+            chunk = chunk[1:]
+        self._skips_lf = False
+
+        # fast path: a whole single-line data event per chunk, as Dify sends
+        if (
+            not self._buffer
+            and not self._data_lines
+            and not self._event_type
+            and chunk[:6] == b"data: "
+            and chunk.find(b"\n") == len(chunk) - 2
+            and chunk[-1:] == b"\n"
+            and b"\r" not in chunk
+        ):
+            self.blocks += 1
+            return [(self._DEFAULT_EVENT_TYPE, chunk[6:-2])]
+
+        buffer = self._buffer + chunk if self._buffer else chunk
+        if b"\r" in buffer:
+            self._skips_lf = buffer.endswith(b"\r")
+            buffer = buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        lines = buffer.split(b"\n")
+        self._buffer = lines.pop()  # incomplete line
+
+        events = []
+        for line in lines:
+            if not line:  # blank line, dispatch
+                if not self._is_blank_block:
+                    self.blocks += 1
+                    self._is_blank_block = True
+                if self._data_lines:
+                    events.append(
+                        (
+                            self._event_type or self._DEFAULT_EVENT_TYPE,
+                            b"\n".join(self._data_lines),
+                        )
+                    )
+                self._event_type = b""
+                self._data_lines = []
+                continue
+
+            self._is_blank_block = False
+            if line[:6] == b"data: ":  # fast path, as Dify sends
+                self._data_lines.append(line[6:])
+                continue
+
+            field, colon, value = line.partition(b":")
+            if colon and value[:1] == b" ":
+                value = value[1:]
+
+            if field == b"data":
+                self._data_lines.append(value)
+            elif field == b"event":
+                self._event_type = value
+            elif field == b"id":
+                if b"\0" not in value:
+                    self.last_event_id = value
+            # others, i.e. retry & unknown fields, are ignored, undecoded
+
+        return events
+
+
 class _ConversationRound:
     """
     represent a single conversation round with Dify
@@ -589,22 +1751,158 @@ class _ConversationRound:
     :raises UnicodeDecodeError:
     :raises json.JSONDecodeError:
     :raises KeyError:
+    :raises TimeoutError: exceeding ``STREAM_IDLE_TIMEOUT``
+            or ``STREAM_TOTAL_DEADLINE``
     """
 
-    _TEXT_STREAM_ENCODING = "utf-8"
-    _STREAM_PREFIX = "data: "
+    TEXT_STREAM_ENCODING = "utf-8"
     # enable debug mode such it returns text-stream directly
 
-    def __init__(self, app, newest_msg):
+    def __init__(self, app, newest_msg, context=None):
         self.app = app
-        self.response = self.app._open_reply_response(newest_msg, True)
-        self.iter_lines = self.response.iter_lines()
+        self.context = context or _RoundContext(enable_stream=True)
+        self._started_at = time.monotonic()
+        try:
+            self.response = self.app._open_reply_response(
+                newest_msg, self.context
+            )
+        except BaseException:
+            self._release_first_round()
+            raise
+        self.iter_chunks = self.response.iter_content(chunk_size=None)
+        self.sse_parser = _SSEParser()
+        self._pending_events = deque()
         self._debug_stop_on_next = False
+        self._is_ended = False
+        self._last_block_at = self._started_at
+        self._last_blocks = 0
+
+        # fallback, if abandoned w/o close(), e.g. dropped by the consumer
+        _streaming_round_counters.incr("opened")
+        self._finalizer = weakref.finalize(
+            self, self._reclaim, self.response, self.app, self.context
+        )
 
     def __iter__(self):
         return self  # make self an Iterator
 
     def __next__(self):
+        try:
+            return self._next_chunk()
+        except StopIteration:  # end of round
+            self._is_ended = True
+            self.close()
+            raise
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        release connection to Dify, e.g. once abandoned by the consumer;
+        no-op if closed already
+        """
+        if self._finalizer.detach() is None:
+            return  # closed already
+
+        if not self._is_ended:
+            _streaming_round_counters.incr("force_closed")
+            self._stop_task(self.app, self.context)
+        self._release_first_round()
+        self.response.close()
+        if self.context.concurrency_permit is not None:
+            self.context.concurrency_permit.release()
+
+    @classmethod
+    def _reclaim(cls, response, app, context):
+        # garbage-collected w/o close(), never refer to the round itself
+        _streaming_round_counters.incr("force_closed")
+        _streaming_round_counters.incr("leaked")
+        cls._stop_task(app, context)
+        if isinstance(app, ChatflowDifyApp):
+            app.release_first_round(context)
+        response.close()
+        if context.concurrency_permit is not None:
+            context.concurrency_permit.release()
+
+    @staticmethod
+    def _stop_task(app, context):
+        # stop Dify task in transport threads, w/o waiting for it
+        if (
+            STOPS_ABANDONED_TASKS
+            and context.task_id
+            and isinstance(app, BaseDifyApp)
+        ):
+            try:
+                _get_transport_executor().submit(
+                    app.stop_task, context.task_id
+                )
+            except RuntimeError:  # interpreter shutting down
+                pass
+
+    def _release_first_round(self):
+        if isinstance(self.app, ChatflowDifyApp):
+            self.app.release_first_round(self.context)
+
+    def _read_chunk(self):
+        """
+        :raises StopIteration:
+        :raises TimeoutError: no bytes for ``STREAM_IDLE_TIMEOUT``
+        """
+        permit = self.context.concurrency_permit
+        try:
+            chunk = next(self.iter_chunks)
+            if permit is not None:  # latency to 1st byte, sampled once
+                permit.sample()
+            return chunk
+
+        except requests.exceptions.ConnectionError as err:
+            if permit is not None:
+                permit.sample(is_congested=True)
+            if not (err.args and isinstance(err.args[0], ReadTimeoutError)):
+                raise
+            _streaming_round_counters.incr("idle_timeouts")
+            raise TimeoutError(
+                "text/event-stream stalls, no events for {}s".format(
+                    STREAM_IDLE_TIMEOUT
+                )
+            ) from err
+
+    def _check_liveness(self):
+        """
+        :raises TimeoutError: no events for ``STREAM_IDLE_TIMEOUT``,
+                or exceeding ``STREAM_TOTAL_DEADLINE``
+        """
+        now = time.monotonic()
+
+        # bytes w/o any complete event, e.g. trickling, aren't liveness
+        if self.sse_parser.blocks != self._last_blocks:
+            self._last_blocks = self.sse_parser.blocks
+            self._last_block_at = now
+        elif now - self._last_block_at > STREAM_IDLE_TIMEOUT:
+            _streaming_round_counters.incr("idle_timeouts")
+            raise TimeoutError(
+                "text/event-stream stalls, no events for {}s".format(
+                    STREAM_IDLE_TIMEOUT
+                )
+            )
+
+        if (
+            STREAM_TOTAL_DEADLINE is not None
+            and now - self._started_at > STREAM_TOTAL_DEADLINE
+        ):
+            _streaming_round_counters.incr("deadline_timeouts")
+            raise TimeoutError(
+                "round exceeds deadline of {}s".format(STREAM_TOTAL_DEADLINE)
+            )
+
+    def _next_chunk(self):
         if self._debug_stop_on_next:
             raise StopIteration
 
@@ -613,21 +1911,28 @@ class _ConversationRound:
         text = None
         event = _SSE.IRRELEVANT  # default
 
-        # consume self.iter_lines until find relevant events
+        # consume self.iter_chunks until find relevant events
         while not event:
             try:
-                raw = next(self.iter_lines)
-                line = raw.decode(self._TEXT_STREAM_ENCODING)
+                while not self._pending_events:
+                    self._pending_events.extend(
+                        self.sse_parser.feed(self._read_chunk())
+                    )
+                    self._check_liveness()
+                event_type, raw = self._pending_events.popleft()
                 if DEBUG_CONVERSATION_ROUND_DIRECT_RESPONSE:
-                    debug_lines.append(line)
+                    debug_lines.append(
+                        raw.decode(self.TEXT_STREAM_ENCODING, "replace")
+                    )
 
-                # deal with data: prefix
-                if not line.startswith(self._STREAM_PREFIX):
-                    continue  # not start w/ "data: ", skip
-                line = line[len(self._STREAM_PREFIX) :]
+                # Dify sends all events as data w/ default type, except ping
+                if event_type != b"message":
+                    continue
 
                 # parse data as JSON
-                data = json.loads(line)
+                data = _json_codec.loads(raw)
+                if self.context.task_id is None:
+                    self.context.task_id = data.get("task_id")
                 event_value = data["event"]
 
                 # deal with only relevant types of SSE
@@ -641,13 +1946,19 @@ class _ConversationRound:
                     text = data["answer"]
                 elif event is _SSE.text_chunk:
                     text = data["data"]["text"]
+                elif event is _SSE.workflow_finished:
+                    self.context.outputs = (data.get("data") or {}).get(
+                        "outputs"
+                    )
 
                 # extract conversation_id for Chatflow, if it's empty
                 if (
                     isinstance(self.app, ChatflowDifyApp)
-                    and not self.app.conversation_id
+                    and not self.context.conversation_id
                 ):
-                    self.app.conversation_id = data["conversation_id"]
+                    self.app.set_conversation_id(
+                        self.context, data["conversation_id"]
+                    )
 
             except StopIteration as err:
                 raise ValueError(
@@ -685,8 +1996,7 @@ class _ConversationRound:
                 debug_lines.insert(1, "# LAST PASS")
                 return "\n\n".join(debug_lines)
 
-            self.response.close()
-            raise StopIteration
+            raise StopIteration  # response is closed by __next__()
 
         if DEBUG_CONVERSATION_ROUND_DIRECT_RESPONSE:
             debug_lines.insert(1, "# PASS")
@@ -696,96 +2006,2722 @@ class _ConversationRound:
         return text
 
 
-# Pipe class required by OWU  ##################################################
-class Pipe:  # pylint: disable=missing-class-docstring
+class _PrefetchedConversationRound:
+    """
+    read ahead a conversation round in a background thread,
+    buffering up to ``max_chunks`` parsed chunks until the consumer pulls
+    them; the reader blocks while the buffer is full, i.e. backpressure
 
-    class Valves(BaseModel):
-        pass  # configuration via Python constants
 
-    def __init__(
-        self,
-        app_model_configs_override=None,
-        base_url_override=None,
-        disable_get_app_type_and_name=False,
-    ):
-        base_url = base_url_override or DIFY_BACKEND_API_BASE_URL
-        app_model_configs = app_model_configs_override or APP_MODEL_CONFIGS
+    :param conversation_round:
+    :type conversation_round: _ConversationRound
+    :param max_chunks:
+    :type max_chunks: int
+    """
 
-        _check_app_model_configs_structure(app_model_configs)
+    _END = object()
+
+    def __init__(self, conversation_round, max_chunks):
+        self.conversation_round = conversation_round
+        self._buffer = queue.Queue(maxsize=max_chunks)
+        self._stop = threading.Event()
+        self._is_ended = False
+
+        # the reader never refers to self, such that an abandoned self
+        # can be garbage-collected, stopping the reader
+        self._reader = threading.Thread(
+            target=self._read,
+            args=(conversation_round, self._buffer, self._stop),
+            name="dify-prefetch",
+            daemon=True,
+        )
+        self._reader.start()
+        self._finalizer = weakref.finalize(
+            self, self._reclaim, conversation_round, self._buffer, self._stop
+        )
 
-        # populate containers   ------------------------------------------------
-        self.model_containers = {}
-        for config in app_model_configs:
-            model = OWUModel(
-                base_url,
-                config,
-                disable_get_app_type_and_name=disable_get_app_type_and_name,
-            )
-            model_id = model.model_id
-            self.model_containers[model_id] = model
+    def __iter__(self):
+        return self  # make self an Iterator
 
-    def pipes(self):
+    def __next__(self):
+        if self._is_ended:
+            raise StopIteration
+
+        item = self._buffer.get()
+        if item is self._END:
+            self.close()  # never reclaimed as leaked once ended
+            raise StopIteration
+        if isinstance(item, Exception):  # raised by the reader
+            self.close()
+            raise item
+        return item
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
         """
-        :return: all models, e.g.::
+        release connection to Dify & stop the reader;
+        no-op if closed already
+        """
+        self._is_ended = True
+        if self._finalizer.detach() is not None:
+            self._stop_reader(
+                self.conversation_round, self._buffer, self._stop
+            )
 
-            [
-                {"id": "model_id_1", "name": "First Model"},
-                {"id": "model_id_2", "name": "Second Model"},
-                {"id": "model_id_3", "name": "Third Model"},
-            ]
+    @classmethod
+    def _read(cls, conversation_round, buffer, stop):
+        while not stop.is_set():
+            try:
+                item = next(conversation_round)
+            except StopIteration:
+                item = cls._END
+            except Exception as err:  # pylint: disable=broad-except
+                item = err  # handed over to the consumer
+
+            buffer.put(item)  # blocks while full
+            if item is cls._END or isinstance(item, Exception):
+                return
+
+    @staticmethod
+    def _stop_reader(conversation_round, buffer, stop):
+        stop.set()
+        conversation_round.close()
+
+        # make room for the reader, if it's blocked by a full buffer,
+        # it then sees it's stopped
+        while True:
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                break
 
-        :rtype: list(dict)
+    @classmethod
+    def _reclaim(cls, conversation_round, buffer, stop):
+        # garbage-collected w/o close()
+        _streaming_round_counters.incr("leaked")
+        cls._stop_reader(conversation_round, buffer, stop)
+
+
+class _ChunkCoalescer:
+    """
+    buffer of text chunks merged by ``_CoalescedConversationRound`` &
+    ``_AsyncConversationRound``, deciding when merged text is flushed:
+    once it reaches ``max_chars`` chars, or ``max_delay`` seconds passed
+    since its 1st chunk arrived; the 1st chunk of the round is flushed
+    immediately
+
+
+    :param max_chars:
+    :type max_chars: int
+    :param max_delay:
+    :type max_delay: float
+    """
+
+    def __init__(self, max_chars, max_delay):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self._is_first = True
+        self._parts = []
+        self._size = 0
+        self._deadline = None
+        # raised after flushing merged text, incl. end of round
+        self._pending_error = None
+
+    def raise_pending_error(self):
         """
-        return [
-            model.get_model_id_and_name()
-            for model in self.model_containers.values()
-        ]
+        :raises Exception: error of the round deferred by ``fail()``, if any
+        """
+        if self._pending_error is not None:
+            err, self._pending_error = self._pending_error, None
+            raise err
 
-    async def pipe(self, body, __user__, __metadata__):
+    def add(self, chunk, now):
         """
-        main pipe logic per round
+        :param now: current time, of the clock of ``timeout()``
+        :type now: float
+        :return: whether merged text is due to be flushed
+        :rtype: bool
+        """
+        self._parts.append(chunk)
+        self._size += len(chunk)
+        if self._is_first:
+            self._is_first = False
+            return True
+        if self._deadline is None:
+            self._deadline = now + self.max_delay
+        return self._size >= self.max_chars or now >= self._deadline
+
+    def timeout(self, now):
+        """
+        :return: seconds until merged text is due, None if it's empty
+        :rtype: float or None
+        """
+        return None if self._deadline is None else self._deadline - now
+
+    def flush(self):
+        """
+        :return: merged text, emptying the buffer
+        :rtype: str
+        """
+        text = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._deadline = None
+        return text
 
+    def fail(self, err):
+        """
+        end merging by ``err`` of the round, incl. its end, raised at once
+        if nothing is buffered, otherwise after flushing merged text, such
+        that an ended round is never pulled again
 
-        :param body: message body
-        :type body: dict
-        :param __user__: user information
-        :type __user__: dict
-        :raises KeyError: missing `"model"` in `body`
-        :return: replied message by the model
+        :return: merged text
         :rtype: str
+        :raises Exception: ``err``, if nothing is buffered
         """
-        if DEBUG_PIPE_DIRECT_RESPONSE:
-            return """## `body`
+        if not self._parts:
+            raise err
+        self._pending_error = err
+        return self.flush()
 
-{}
 
-## `__user__`
+class _CoalescedConversationRound:
+    """
+    merge consecutive text chunks of a conversation round,
+    until the merged text reaches ``max_chars`` chars,
+    or ``max_delay`` seconds passed since its 1st chunk arrived;
+    the 1st chunk of the round is passed on immediately
 
-{}
+    as chunks are pulled in the caller's thread, ``max_delay`` is checked
+    only as chunks arrive; q.v. ``_AsyncConversationRound`` for a strict bound
 
-## `__metadata__`
 
-{}
-""".format(body, __user__, __metadata__)
+    :param conversation_round:
+    :type conversation_round: Iterator[str]
+    :param max_chars:
+    :type max_chars: int
+    :param max_delay:
+    :type max_delay: float
+    """
 
-        if "model" not in body:
-            raise IndexError("missing entry 'model' in body")
+    def __init__(self, conversation_round, max_chars, max_delay):
+        self.conversation_round = conversation_round
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self._coalescer = _ChunkCoalescer(max_chars, max_delay)
 
-        # extract model_id from body
-        model_id = body["model"][body["model"].find(".") + 1 :]
-        opt = self.model_containers[model_id].reply(
-            body, __user__, __metadata__
-        )
+    def __iter__(self):
+        return self  # make self an Iterator
 
-        return opt
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *_):
+        self.close()
 
-# helper methods  ==============================================================
-def _check_app_model_configs_structure(app_model_configs):
-    if len(app_model_configs) == 0:
-        raise ValueError(
-            "APP_MODEL_CONFIGS must contains at least one App/Model"
-        )
+    def close(self):
+        """
+        close the wrapped round
+        """
+        self.conversation_round.close()
 
-    if any(not isinstance(config, dict) for config in app_model_configs):
-        raise ValueError("APP_MODEL_CONFIGS must contains only dicts")
+    def __next__(self):
+        self._coalescer.raise_pending_error()
+
+        while True:
+            try:
+                chunk = next(self.conversation_round)
+            except Exception as err:  # pylint: disable=broad-except
+                return self._coalescer.fail(err)  # incl. StopIteration
+
+            if self._coalescer.add(chunk, time.monotonic()):
+                return self._coalescer.flush()
+
+
+class _RecordedConversationRound:
+    """
+    pass on chunks of a conversation round, recording them,
+    & hand them to ``on_end`` once the round ends normally
+
+
+    :param conversation_round:
+    :type conversation_round: Iterator[str]
+    :param on_end: called w/ all chunks of the round
+    :type on_end: Callable[[list(str)], None]
+    """
+
+    def __init__(self, conversation_round, on_end):
+        self.conversation_round = conversation_round
+        self.on_end = on_end
+        self.chunks = []
+
+    def __iter__(self):
+        return self  # make self an Iterator
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        close the wrapped round
+        """
+        self.conversation_round.close()
+
+    def __next__(self):
+        try:
+            chunk = next(self.conversation_round)
+        except StopIteration:
+            on_end, self.on_end = self.on_end, None
+            if on_end is not None:
+                on_end(self.chunks)
+            raise
+
+        self.chunks.append(chunk)
+        return chunk
+
+
+class _ReplayedConversationRound:
+    """
+    replay chunks of a cached conversation round, w/o Dify
+
+
+    :param chunks:
+    :type chunks: Iterable[str]
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def __iter__(self):
+        return self  # make self an Iterator
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        no-op, nothing to release
+        """
+
+
+class _SharedRound:
+    """
+    a single round in flight, shared by identical rounds subscribing it;
+    its chunks are kept until it ends, such that a late subscriber replays
+    them from the start
+
+    streaming chunks are pumped from Dify in a background thread, such that
+    any subscriber can detach w/o affecting others; once all detached,
+    Dify's round is closed
+
+    subscribers of async transport wait for chunks in OWU's event loop,
+    such that identical rounds never hold transport threads while waiting
+
+
+    :param table: table this round is registered in
+    :type table: _SharedRoundTable
+    :param key:
+    :type key: Hashable
+    """
+
+    def __init__(self, table, key):
+        self.table = table
+        self.key = key
+        self.chunks = []
+        self.error = None
+        self.is_ended = False
+        self.is_abandoned = False
+        self.subscribers = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []  # (event loop, Future), woken per chunk
+        self._conversation_round = None  # pumped one, if streaming
+
+    def subscribe(self, max_subscribers):
+        """
+        :return: a new subscriber, None if it's full, ended or abandoned
+        :rtype: _SharedRoundSubscriber or None
+        """
+        with self._cond:
+            if (
+                self.is_ended
+                or self.is_abandoned
+                or self.subscribers >= max_subscribers
+            ):
+                return None
+            self.subscribers += 1
+        return _SharedRoundSubscriber(self)
+
+    def unsubscribe(self):
+        """
+        detach a subscriber, abandoning the round if it's the last one
+        """
+        with self._cond:
+            self.subscribers -= 1
+            if self.is_ended:
+                return
+            self.table.counters.incr("detached")
+            if self.subscribers:
+                return
+            self.is_abandoned = True
+            conversation_round = self._conversation_round
+
+        self.table.discard(self)
+        if conversation_round is not None:
+            conversation_round.close()  # the pump then stops
+
+    def get(self, index):
+        """
+        :return: chunk ``index``, waiting for it if not yet arrived
+        :rtype: str
+        :raises StopIteration: the round ends before it
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: index < len(self.chunks) or self.is_ended
+            )
+            if index < len(self.chunks):
+                return self.chunks[index]
+            if self.error is not None:
+                raise self.error
+            raise StopIteration
+
+    async def get_async(self, index, default):
+        """
+        asyncio counterpart of ``get()``, waiting w/o blocking a thread
+
+        :return: chunk ``index``; ``default`` if the round ends before it
+        :rtype: str
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if index < len(self.chunks) or self.is_ended:
+                    break
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            await future
+
+        try:
+            return self.get(index)  # arrived, never waits
+        except StopIteration:
+            return default
+
+    def publish(self, chunk):
+        """
+        :return: False if abandoned, i.e. no one waits for chunks
+        :rtype: bool
+        """
+        with self._cond:
+            if self.is_abandoned:
+                return False
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+            self._wake_async_waiters()
+            return True
+
+    def finish(self, error=None):
+        """
+        end the round, w/ ``error`` raised to all subscribers, if any
+        """
+        with self._cond:
+            if self.is_ended:
+                return
+            self.is_ended = True
+            self.error = error
+            self._cond.notify_all()
+            self._wake_async_waiters()
+        self.table.discard(self)
+
+    def start_pump(self, conversation_round):
+        """
+        pump chunks of ``conversation_round`` to subscribers
+        in a background thread
+        """
+        with self._cond:
+            self._conversation_round = conversation_round
+        threading.Thread(
+            target=self._pump,
+            args=(conversation_round,),
+            name="dify-shared-round",
+            daemon=True,
+        ).start()
+
+    def _pump(self, conversation_round):
+        try:
+            for chunk in conversation_round:
+                if not self.publish(chunk):
+                    break  # closed by the last subscriber
+        except Exception as err:  # pylint: disable=broad-except
+            self.finish(err)
+        else:
+            self.finish()
+        finally:
+            conversation_round.close()
+
+    def _wake_async_waiters(self):
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:  # event loop closed, waiter is gone
+                continue
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+
+class _SharedRoundSubscriber:
+    """
+    iterate chunks of a shared round, from its 1st chunk
+
+
+    :param shared_round:
+    :type shared_round: _SharedRound
+    """
+
+    def __init__(self, shared_round):
+        self.shared_round = shared_round
+        self._index = 0
+        # detach once closed, or garbage-collected w/o close()
+        self._finalizer = weakref.finalize(self, shared_round.unsubscribe)
+
+    def __iter__(self):
+        return self  # make self an Iterator
+
+    def __next__(self):
+        try:
+            chunk = self.shared_round.get(self._index)
+        except BaseException:
+            self.close()
+            raise
+        self._index += 1
+        return chunk
+
+    async def next_async(self, default):
+        """
+        asyncio counterpart of ``next(self, default)``,
+        waiting for the next chunk in the running event loop
+
+        :rtype: str
+        """
+        try:
+            chunk = await self.shared_round.get_async(self._index, default)
+        except BaseException:
+            self.close()
+            raise
+        if chunk is default:
+            self.close()
+            return default
+        self._index += 1
+        return chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        detach from the shared round; no-op if closed already
+        """
+        self._finalizer()
+
+
+class _AsyncConversationRound(AsyncGenerator):
+    """
+    asyncio counterpart of ``_ConversationRound``,
+    pulling each chunk of the wrapped round in transport threads
+
+    if ``max_chars`` is set, consecutive text chunks are merged as
+    ``_CoalescedConversationRound`` does, except that merged text is
+    flushed once ``max_delay`` passed, even while Dify sends nothing
+
+
+    :param conversation_round:
+    :type conversation_round: _ConversationRound | _PrefetchedConversationRound
+    :param max_chars: 0 to disable coalescing
+    :type max_chars: int
+    :param max_delay:
+    :type max_delay: float
+    """
+
+    _EXHAUSTED = object()
+
+    def __init__(self, conversation_round, max_chars=0, max_delay=0):
+        self.conversation_round = conversation_round
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self._coalescer = _ChunkCoalescer(max_chars, max_delay)
+        self._pulling = None  # Task pulling next chunk, kept across asend()
+
+    async def asend(self, value):
+        if not self.max_chars:
+            chunk = await self._pull()
+            if chunk is self._EXHAUSTED:
+                raise StopAsyncIteration
+            return chunk
+
+        return await self._coalesce()
+
+    async def _coalesce(self):
+        coalescer = self._coalescer
+        coalescer.raise_pending_error()
+
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._pulling is None:
+                self._pulling = asyncio.ensure_future(self._pull())
+
+            # wait w/o cancelling the pull, which may outlive this flush
+            done, _ = await asyncio.wait(
+                {self._pulling}, timeout=coalescer.timeout(loop.time())
+            )
+            if not done:  # max_delay passed
+                return coalescer.flush()
+
+            pulling, self._pulling = self._pulling, None
+            try:
+                chunk = pulling.result()
+            except Exception as err:  # pylint: disable=broad-except
+                return coalescer.fail(err)
+            if chunk is self._EXHAUSTED:
+                return coalescer.fail(StopAsyncIteration())
+
+            if coalescer.add(chunk, loop.time()):
+                return coalescer.flush()
+
+    def _pull(self):
+        """
+        :return: awaitable of the next chunk of the wrapped round,
+                ``_EXHAUSTED`` once it ends
+        """
+        if isinstance(self.conversation_round, _SharedRoundSubscriber):
+            # wait for the shared round in event loop, holding no thread
+            return self.conversation_round.next_async(self._EXHAUSTED)
+        return _run_in_transport_thread(
+            next, self.conversation_round, self._EXHAUSTED
+        )
+
+    async def athrow(self, typ, val=None, tb=None):
+        # abandoned by consumer, release connection to Dify
+        await _run_in_transport_thread(self.conversation_round.close)
+        # a pull in flight fails once closed, its error is expected
+        if self._pulling is not None:
+            await asyncio.gather(self._pulling, return_exceptions=True)
+            self._pulling = None
+
+        if val is None:
+            raise typ
+        raise val.with_traceback(tb)
+
+
+class _AdmittedRound:
+    """
+    pass on chunks of a streaming round holding a slot of admission gate,
+    calling ``release`` once the round ends or is closed
+
+
+    :param conversation_round:
+    :type conversation_round: Iterator[str]
+    :param release:
+    :type release: Callable[[], None]
+    """
+
+    def __init__(self, conversation_round, release):
+        self.conversation_round = conversation_round
+        # release once, incl. garbage-collected w/o close()
+        self._finalizer = weakref.finalize(self, release)
+
+    def __iter__(self):
+        return self  # make self an Iterator
+
+    def __next__(self):
+        try:
+            return next(self.conversation_round)
+        except BaseException:
+            self._finalizer()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        close the wrapped round & release its slot
+        """
+        try:
+            self.conversation_round.close()
+        finally:
+            self._finalizer()
+
+
+class _AdmittedAsyncRound(AsyncGenerator):
+    """
+    asyncio counterpart of ``_AdmittedRound``
+
+
+    :param conversation_round:
+    :type conversation_round: AsyncGenerator
+    :param release:
+    :type release: Callable[[], None]
+    """
+
+    def __init__(self, conversation_round, release):
+        self.conversation_round = conversation_round
+        self._finalizer = weakref.finalize(self, release)
+
+    async def asend(self, value):
+        try:
+            return await self.conversation_round.asend(value)
+        except BaseException:
+            self._finalizer()
+            raise
+
+    async def athrow(self, typ, val=None, tb=None):
+        try:
+            return await self.conversation_round.athrow(typ, val, tb)
+        finally:
+            self._finalizer()
+
+
+class _ConversationIdStore:
+    """
+    bounded mapping from OWU ``chat_id`` to Dify ``conversation_id``,
+    evicting least-recently-used entries beyond ``max_entries``
+    & entries idle for more than ``idle_ttl`` seconds
+
+
+    :param max_entries:
+    :type max_entries: int
+    :param idle_ttl:
+    :type idle_ttl: float
+    """
+
+    def __init__(
+        self,
+        max_entries=CONVERSATION_ID_STORE_MAX_ENTRIES,
+        idle_ttl=CONVERSATION_ID_STORE_IDLE_TTL,
+    ):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+
+        self.counters = _Counters(
+            "hits", "misses", "lru_evictions", "ttl_evictions"
+        )
+        self._lock = threading.Lock()
+        # chat_id: (conversation_id, last_access), least-recently-used first
+        self._entries = OrderedDict()
+
+    def get(self, chat_id, default=None):
+        """
+        :return: ``conversation_id`` of ``chat_id``, ``default`` if absent
+        :rtype: str
+        """
+        opt = self._look_up(chat_id)
+        if opt is None:
+            self.counters.incr("misses")
+            return default
+
+        self.counters.incr("hits")
+        return opt
+
+    def _look_up(self, chat_id):
+        """
+        :return: value stored for ``chat_id``, refreshing its last access;
+                None if absent or idle too long
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return None
+
+            value, last_access = entry
+            if now - last_access > self.idle_ttl:
+                del self._entries[chat_id]
+                self.counters.incr("ttl_evictions")
+                return None
+
+            self._entries[chat_id] = (value, now)
+            self._entries.move_to_end(chat_id)
+            return value
+
+    def __setitem__(self, chat_id, conversation_id):
+        now = time.monotonic()
+
+        with self._lock:
+            self._entries[chat_id] = (conversation_id, now)
+            self._entries.move_to_end(chat_id)
+            self._evict(now)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def snapshot(self):
+        """
+        :return: metrics of this store
+        :rtype: dict{str: int}
+        """
+        opt = self.counters.snapshot()
+        opt["entries"] = len(self._entries)
+        return opt
+
+    def _evict(self, now):
+        entries = self._entries
+
+        # idle ones are at least-recently-used end
+        while entries:
+            _, (_, last_access) = next(iter(entries.items()))
+            if now - last_access <= self.idle_ttl:
+                break
+            entries.popitem(last=False)
+            self.counters.incr("ttl_evictions")
+
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.counters.incr("lru_evictions")
+
+
+class _SQLiteConversationIdStore(_ConversationIdStore):
+    """
+    ``_ConversationIdStore`` persisted in SQLite database shared by
+    all workers & across restarts; the in-memory store acts as read cache,
+    writes are batched by ``_SQLiteConversationDatabase``
+
+    a row in use is rewritten only once older than ``_REFRESH_TTL_FRACTION``
+    of ``idle_ttl``, such that writes grow w/ conversations, not w/ rounds;
+    ``"db_hits"`` count lookups served by the database instead of the cache
+
+
+    :param database:
+    :type database: _SQLiteConversationDatabase
+    :param namespace: identifies Dify App, as chat_id are App-specific
+    :type namespace: str
+    """
+
+    _REFRESH_TTL_FRACTION = 0.1
+
+    def __init__(self, database, namespace, **kwargs):
+        kwargs.setdefault("idle_ttl", database.idle_ttl)
+        super().__init__(**kwargs)
+        self.database = database
+        self.namespace = namespace
+        self.counters = _Counters(
+            "hits", "db_hits", "misses", "lru_evictions", "ttl_evictions"
+        )
+
+    def get(self, chat_id, default=None):
+        # cached as (conversation_id, updated_at of its row)
+        cached = self._look_up(chat_id)
+        if cached is not None:
+            self.counters.incr("hits")
+            conversation_id, updated_at = cached
+            # refresh the row now & then, such that not pruned while in use
+            if (
+                time.time() - updated_at
+                > self.idle_ttl * self._REFRESH_TTL_FRACTION
+            ):
+                self[chat_id] = conversation_id
+            return conversation_id
+
+        # not cached, e.g. set by another worker or before restart
+        row = self.database.select(self.namespace, chat_id, self.idle_ttl)
+        if row is None:
+            self.counters.incr("misses")
+            return default
+
+        self.counters.incr("db_hits")
+        super().__setitem__(chat_id, row)
+        return row[0]
+
+    def __setitem__(self, chat_id, conversation_id):
+        updated_at = self.database.enqueue(
+            self.namespace, chat_id, conversation_id
+        )
+        super().__setitem__(chat_id, (conversation_id, updated_at))
+
+    def snapshot(self):
+        opt = super().snapshot()
+        opt.update(self.database.snapshot())
+        return opt
+
+
+class _SQLiteConversationDatabase:
+    """
+    SQLite (WAL mode) database of ``conversation_id``, w/ background
+    thread flushing queued writes every ``flush_interval`` seconds
+
+    neither the thread nor the module refers to it, such that once its
+    stores are gone, e.g. the function is reloaded by OWU, it's flushed &
+    closed by a finalizer, as it is at exit
+
+
+    :param path:
+    :type path: str
+    :param flush_interval:
+    :type flush_interval: float
+    :param idle_ttl: rows idle for more than it are pruned now & then
+    :type idle_ttl: float
+    """
+
+    _PRUNE_EVERY_FLUSHES = 1000
+
+    def __init__(
+        self,
+        path,
+        flush_interval=CONVERSATION_STORE_FLUSH_INTERVAL,
+        idle_ttl=CONVERSATION_ID_STORE_IDLE_TTL,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.idle_ttl = idle_ttl
+
+        self.counters = _Counters("db_reads", "db_writes", "flushes")
+        self._lock = threading.Lock()  # guard connection
+        self._pending_lock = threading.Lock()
+        self._pending = {}  # (namespace, chat_id): (conversation_id, time)
+
+        self._connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False
+        )
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " namespace TEXT NOT NULL,"
+                " chat_id TEXT NOT NULL,"
+                " conversation_id TEXT NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, chat_id)"
+                ") WITHOUT ROWID"
+            )
+            self._connection.commit()
+
+        self._closed = threading.Event()
+        self._flush_thread = threading.Thread(
+            target=self._run_flush_thread,
+            args=(weakref.ref(self), self._closed, flush_interval),
+            name="dify-conversation-flush",
+            daemon=True,
+        )
+        self._flush_thread.start()
+        # called at exit as well
+        self._finalizer = weakref.finalize(
+            self,
+            self._close,
+            self._connection,
+            self._lock,
+            self._pending_lock,
+            self._pending,
+            self._closed,
+        )
+
+    def select(self, namespace, chat_id, idle_ttl):
+        """
+        :return: stored ``(conversation_id, updated_at)``,
+                None if absent or idle too long
+        :rtype: tuple(str, float) or None
+        """
+        with self._pending_lock:
+            pending = self._pending.get((namespace, chat_id))
+        if pending is not None:
+            return pending
+
+        self.counters.incr("db_reads")
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT conversation_id, updated_at FROM conversations"
+                " WHERE namespace = ? AND chat_id = ? AND updated_at >= ?",
+                (namespace, chat_id, time.time() - idle_ttl),
+            ).fetchone()
+        return None if row is None else tuple(row)
+
+    def enqueue(self, namespace, chat_id, conversation_id):
+        """
+        queue a write, to be flushed in next batch
+
+        :return: ``updated_at`` of the written row
+        :rtype: float
+        """
+        updated_at = time.time()
+        with self._pending_lock:
+            self._pending[(namespace, chat_id)] = (conversation_id, updated_at)
+        return updated_at
+
+    def flush(self, prunes_idle_ttl=None):
+        """
+        write all queued writes in a single transaction; no-op once closed
+
+        :param prunes_idle_ttl: also delete rows idle more than it (seconds)
+        :type prunes_idle_ttl: float or None
+        """
+        with self._lock:
+            if self._closed.is_set():
+                return
+            written = self._write(
+                self._connection,
+                self._pending_lock,
+                self._pending,
+                prunes_idle_ttl,
+            )
+
+        if written is not None:
+            self.counters.incr("db_writes", written)
+            self.counters.incr("flushes")
+
+    def close(self):
+        """
+        flush queued writes, then close database
+        """
+        self._finalizer()
+
+    def snapshot(self):
+        """
+        :return: metrics of this database
+        :rtype: dict{str: int}
+        """
+        opt = self.counters.snapshot()
+        with self._pending_lock:
+            opt["pending_writes"] = len(self._pending)
+        return opt
+
+    @staticmethod
+    def _write(connection, pending_lock, pending, prunes_idle_ttl=None):
+        """
+        write & clear ``pending``, holding the connection lock
+
+        :return: number of written rows, None if nothing to do
+        :rtype: int or None
+        """
+        with pending_lock:
+            rows = [
+                (namespace, chat_id, conversation_id, updated_at)
+                for (namespace, chat_id), (
+                    conversation_id,
+                    updated_at,
+                ) in pending.items()
+            ]
+            pending.clear()
+
+        if not rows and prunes_idle_ttl is None:
+            return None
+
+        with connection:  # transaction
+            connection.executemany(
+                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            if prunes_idle_ttl is not None:
+                connection.execute(
+                    "DELETE FROM conversations WHERE updated_at < ?",
+                    (time.time() - prunes_idle_ttl,),
+                )
+        return len(rows)
+
+    @classmethod
+    def _close(cls, connection, lock, pending_lock, pending, closed):
+        # called once, by close(), garbage collection or at exit,
+        # never refer to the database itself
+        with lock:
+            closed.set()  # stops the flush thread
+            try:
+                cls._write(connection, pending_lock, pending)
+            finally:
+                connection.close()
+
+    @classmethod
+    def _run_flush_thread(cls, database_ref, closed, flush_interval):
+        flushes = 0
+        while not closed.wait(flush_interval):
+            database = database_ref()
+            if database is None:  # garbage-collected
+                return
+
+            flushes += 1
+            prunes = flushes % cls._PRUNE_EVERY_FLUSHES == 0
+            try:
+                database.flush(database.idle_ttl if prunes else None)
+            except sqlite3.Error:  # e.g. locked, retry in next batch
+                pass
+            del database  # never hold it while waiting
+
+
+class _WorkflowResultCache:
+    """
+    bounded cache of results of Workflow rounds, by hash of request payload;
+    entries expire ``ttl`` seconds after stored, & least-recently-used ones
+    are evicted beyond ``max_entries`` or ``max_bytes`` of cached text
+
+
+    :param ttl:
+    :type ttl: float
+    :param max_entries:
+    :type max_entries: int
+    :param max_bytes:
+    :type max_bytes: int
+    """
+
+    def __init__(
+        self,
+        ttl,
+        max_entries=WORKFLOW_RESULT_CACHE_MAX_ENTRIES,
+        max_bytes=WORKFLOW_RESULT_CACHE_MAX_BYTES,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.counters = _Counters(
+            "hits",
+            "misses",
+            "stores",
+            "oversized",
+            "lru_evictions",
+            "ttl_evictions",
+        )
+        self._lock = threading.Lock()
+        # key: (reply, chunks, size, expires_at), least-recently-used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key):
+        """
+        :return: ``(reply, chunks)`` cached for ``key``, None if absent;
+                ``chunks`` is None if cached from a non-streaming round
+        :rtype: tuple(str, tuple(str) or None) or None
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.counters.incr("misses")
+                return None
+
+            reply, chunks, size, expires_at = entry
+            if now >= expires_at:
+                del self._entries[key]
+                self._bytes -= size
+                self.counters.incr("ttl_evictions")
+                self.counters.incr("misses")
+                return None
+
+            self._entries.move_to_end(key)
+            self.counters.incr("hits")
+            return reply, chunks
+
+    def put(self, key, reply, chunks=None):
+        """
+        cache ``reply`` & streamed ``chunks`` of it for ``key``;
+        a result larger than ``max_bytes`` is never cached
+        """
+        size = len(reply.encode("utf-8"))
+        if chunks is not None:
+            size += sum(len(chunk.encode("utf-8")) for chunk in chunks)
+        if size > self.max_bytes:
+            self.counters.incr("oversized")
+            return
+
+        now = time.monotonic()
+
+        with self._lock:
+            former = self._entries.pop(key, None)
+            if former is not None:
+                self._bytes -= former[2]
+
+            self._entries[key] = (reply, chunks, size, now + self.ttl)
+            self._bytes += size
+            self.counters.incr("stores")
+            self._evict(now)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def snapshot(self):
+        """
+        :return: metrics of this cache
+        :rtype: dict{str: int}
+        """
+        opt = self.counters.snapshot()
+        with self._lock:
+            opt["entries"] = len(self._entries)
+            opt["bytes"] = self._bytes
+        return opt
+
+    def _evict(self, now):
+        entries = self._entries
+
+        # all share the same ttl, expired ones are at the oldest-stored end,
+        # which is least-recently-used end unless they've been hit since
+        while entries:
+            key, (_, _, size, expires_at) = next(iter(entries.items()))
+            if now < expires_at:
+                break
+            del entries[key]
+            self._bytes -= size
+            self.counters.incr("ttl_evictions")
+
+        while len(entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, _, size, _) = entries.popitem(last=False)
+            self._bytes -= size
+            self.counters.incr("lru_evictions")
+
+
+class _SharedRoundTable:
+    """
+    identical rounds in flight of a Workflow model, by key;
+    bounded by ``max_flights`` rounds & ``max_subscribers`` of each
+
+
+    :param max_flights:
+    :type max_flights: int
+    :param max_subscribers:
+    :type max_subscribers: int
+    """
+
+    def __init__(
+        self,
+        max_flights=SHARED_ROUND_MAX_FLIGHTS,
+        max_subscribers=SHARED_ROUND_MAX_SUBSCRIBERS,
+    ):
+        self.max_flights = max_flights
+        self.max_subscribers = max_subscribers
+
+        # followers: rounds served w/o their own Dify request
+        self.counters = _Counters("leaders", "followers", "detached", "full")
+        self._lock = threading.Lock()
+        self._flights = {}  # key: _SharedRound
+
+    def join(self, key):
+        """
+        subscribe the identical round in flight, or start a new one
+
+        :return: the subscriber & whether it leads a new round, i.e.
+                must request Dify & finish it; ``(None, False)`` if full
+        :rtype: tuple(_SharedRoundSubscriber or None, bool)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                subscriber = flight.subscribe(self.max_subscribers)
+                if subscriber is not None:
+                    self.counters.incr("followers")
+                    return subscriber, False
+                if not (flight.is_ended or flight.is_abandoned):
+                    self.counters.incr("full")
+                    return None, False
+
+            elif len(self._flights) >= self.max_flights:
+                self.counters.incr("full")
+                return None, False
+
+            flight = _SharedRound(self, key)
+            self._flights[key] = flight
+            self.counters.incr("leaders")
+            return flight.subscribe(self.max_subscribers), True
+
+    def discard(self, flight):
+        """
+        unregister ``flight``, once ended or abandoned
+        """
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def __len__(self):
+        return len(self._flights)
+
+    def snapshot(self):
+        """
+        :return: metrics of this table
+        :rtype: dict{str: int}
+        """
+        opt = self.counters.snapshot()
+        opt["flights"] = len(self._flights)
+        return opt
+
+
+class _AdmissionGate:
+    """
+    bound rounds of a model requesting Dify at once to ``max_inflight``,
+    & rounds of each user to ``max_inflight_per_user``;
+    excess rounds wait in queues of priority lanes, of up to ``max_queued``
+    rounds in total, for up to ``max_wait`` seconds, otherwise they're
+    rejected at once
+
+    a slot is handed over directly once released, to a waiter of the
+    highest lane w/ waiters, such that newcomers never overtake waiters;
+    unless a waiter of a lower lane waited for ``aging_wait`` seconds, then
+    the longest-waiting one of them is served 1st, i.e. lower lanes are
+    never starved
+
+    within a lane, each user has a FIFO queue, & users are served in round
+    robin, i.e. deficit round robin of rounds of equal cost, such that a
+    user w/ many parallel rounds gets the same share as others; waiters of
+    a user at ``max_inflight_per_user`` are skipped (throttled) until a
+    round of the user ends; thread-safe, as slots of sync rounds are
+    released in any thread
+
+
+    :param max_inflight: 0 for unlimited
+    :type max_inflight: int
+    :param max_queued:
+    :type max_queued: int
+    :param max_wait:
+    :type max_wait: float
+    :param lanes: names of lanes, highest priority 1st
+    :type lanes: tuple(str)
+    :param aging_wait:
+    :type aging_wait: float
+    :param max_inflight_per_user: 0 for unlimited
+    :type max_inflight_per_user: int
+    :param max_throttled_users: users in ``"throttled_by_user"``,
+            least recently throttled ones are dropped
+    :type max_throttled_users: int
+    """
+
+    def __init__(
+        self,
+        max_inflight,
+        max_queued,
+        max_wait,
+        lanes=PRIORITY_LANES,
+        aging_wait=PRIORITY_AGING_WAIT,
+        max_inflight_per_user=0,
+        max_throttled_users=THROTTLED_USERS_MAX_REPORTED,
+    ):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.lanes = lanes
+        self.aging_wait = aging_wait
+        self.max_inflight_per_user = max_inflight_per_user
+        self.max_throttled_users = max_throttled_users
+
+        self.counters = _Counters(
+            "admitted",
+            "queued",
+            "rejected_full",
+            "rejected_timeout",
+            "aged",
+            "throttled",
+        )
+        self.inflight = 0
+        self._lock = threading.Lock()
+        # waiters by lane, by user in round-robin order, each in order
+        # [event loop, Future, whether granted, enqueued at, user]
+        self._waiters = {lane: OrderedDict() for lane in lanes}
+        self._queued = 0
+        self._inflight_by_user = {}  # user: rounds in flight, if any
+        # user: rounds throttled, least recently throttled 1st
+        self._throttled_by_user = OrderedDict()
+        self._wait_time_total = 0.0  # seconds waited by admitted waiters
+        self._wait_time_max = 0.0
+
+    async def acquire(self, lane=None, user=None):
+        """
+        :param lane: priority lane of the round, the highest one if None
+        :type lane: str
+        :param user: user of the round, q.v. ``_get_user_key()``
+        :type user: str
+        :return: whether admitted, i.e. a slot is acquired,
+                which must be released by ``release(user)``
+        :rtype: bool
+        """
+        lane = lane or self.lanes[0]
+
+        with self._lock:
+            # while a slot is free, waiters are all throttled, if any
+            is_throttled = self._is_throttled(user)
+            if not is_throttled and not self._is_full():
+                self._admit(user)
+                return True
+
+            if self._queued >= self.max_queued:
+                self.counters.incr("rejected_full")
+                return False
+
+            loop = asyncio.get_running_loop()
+            started_at = time.monotonic()
+            waiter = [loop, loop.create_future(), False, started_at, user]
+            self._waiters[lane].setdefault(user, deque()).append(waiter)
+            self._queued += 1
+            self.counters.incr("queued")
+            if is_throttled:
+                self.counters.incr("throttled")
+                self._count_throttled(user)
+
+        try:
+            await asyncio.wait({waiter[1]}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            with self._lock:
+                if not waiter[2]:
+                    self._remove_waiter(lane, waiter)
+                    raise
+            self.release(user)  # granted meanwhile, pass the slot on
+            raise
+
+        with self._lock:
+            if not waiter[2]:  # max_wait passed
+                self._remove_waiter(lane, waiter)
+                self.counters.incr("rejected_timeout")
+                return False
+
+            waited = time.monotonic() - started_at
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+            return True
+
+    def release(self, user=None):
+        """
+        release a slot of ``user``, handing it over to the next waiter not
+        throttled, if any
+        """
+        with self._lock:
+            self._inflight_by_user[user] -= 1
+            if not self._inflight_by_user[user]:
+                del self._inflight_by_user[user]
+            self.inflight -= 1
+
+            while True:
+                waiter = self._pop_next_waiter()
+                if waiter is None:
+                    return
+                loop, future, _, _, waiter_user = waiter
+                try:
+                    loop.call_soon_threadsafe(self._wake, future)
+                except RuntimeError:  # event loop closed, waiter is gone
+                    continue
+                waiter[2] = True
+                self._admit(waiter_user)
+                return
+
+    def _is_full(self):
+        return bool(self.max_inflight) and self.inflight >= self.max_inflight
+
+    def _count_throttled(self, user):
+        throttled = self._throttled_by_user
+        throttled[user] = throttled.pop(user, 0) + 1
+        if len(throttled) > self.max_throttled_users:
+            throttled.popitem(last=False)
+
+    def _is_throttled(self, user):
+        return (
+            bool(self.max_inflight_per_user)
+            and self._inflight_by_user.get(user, 0)
+            >= self.max_inflight_per_user
+        )
+
+    def _admit(self, user):
+        self.inflight += 1
+        self._inflight_by_user[user] = self._inflight_by_user.get(user, 0) + 1
+        self.counters.incr("admitted")
+
+    def _remove_waiter(self, lane, waiter):
+        users = self._waiters[lane]
+        user_waiters = users[waiter[4]]
+        user_waiters.remove(waiter)
+        if not user_waiters:
+            del users[waiter[4]]
+        self._queued -= 1
+
+    def _pop_next_waiter(self):
+        """
+        :return: the next waiter not throttled, removed from its queue;
+                None if none
+        """
+        # 1st user not throttled of each lane w/ one, by priority
+        heads = []
+        for lane, users in self._waiters.items():
+            for user in users:
+                if not self._is_throttled(user):
+                    heads.append((lane, user))
+                    break
+        if not heads:
+            return None
+
+        def enqueued_at(head):
+            lane, user = head
+            return self._waiters[lane][user][0][3]
+
+        # the longest-waiting aged waiter of lower lanes, if any
+        aged_before = time.monotonic() - self.aging_wait
+        aged = min(
+            (head for head in heads[1:] if enqueued_at(head) <= aged_before),
+            key=enqueued_at,
+            default=None,
+        )
+        if aged is not None and enqueued_at(aged) < enqueued_at(heads[0]):
+            self.counters.incr("aged")
+            lane, user = aged
+        else:
+            lane, user = heads[0]
+
+        # serve the user, then move it to the end of the round
+        users = self._waiters[lane]
+        user_waiters = users.pop(user)
+        waiter = user_waiters.popleft()
+        if user_waiters:
+            users[user] = user_waiters
+        self._queued -= 1
+        return waiter
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def snapshot(self):
+        """
+        :return: metrics of this gate, incl. current queue depth
+        :rtype: dict{str: int or float or dict}
+        """
+        opt = self.counters.snapshot()
+        with self._lock:
+            opt["inflight"] = self.inflight
+            opt["queue_depth"] = self._queued
+            opt["queue_depth_by_lane"] = {
+                lane: sum(len(waiters) for waiters in users.values())
+                for lane, users in self._waiters.items()
+            }
+            queue_depth_by_user = {}
+            for users in self._waiters.values():
+                for user, waiters in users.items():
+                    queue_depth_by_user[user] = queue_depth_by_user.get(
+                        user, 0
+                    ) + len(waiters)
+            opt["queue_depth_by_user"] = queue_depth_by_user
+            opt["inflight_by_user"] = dict(self._inflight_by_user)
+            opt["throttled_by_user"] = dict(self._throttled_by_user)
+            opt["wait_time_total"] = self._wait_time_total
+            opt["wait_time_max"] = self._wait_time_max
+        return opt
+
+
+class _AdaptiveLimiter:
+    """
+    adaptive limit of rounds in flight to a Dify App, by AIMD of latency:
+
+    - while smoothed latency is within ``tolerance`` x baseline latency,
+      each sample raises the limit by ``1 / limit``, i.e. by 1 per limit
+      samples, if the limit is utilized
+    - once beyond it, or on a congestion error, the limit is cut by
+      ``backoff``, at most once per samples in flight since the last cut
+
+    baseline is the minimal latency seen, drifting up slowly, such that it
+    follows a backend getting slower for good
+
+    rounds of OWU's event loop wait for a slot by ``acquire_async()``, never
+    holding a transport thread, which slot holders need to read replies
+
+
+    :param initial_limit:
+    :type initial_limit: int
+    :param min_limit:
+    :type min_limit: int
+    :param max_limit:
+    :type max_limit: int
+    :param tolerance:
+    :type tolerance: float
+    :param backoff:
+    :type backoff: float
+    :param max_wait: max seconds waiting for a slot
+    :type max_wait: float
+    """
+
+    _BASELINE_DRIFT = 0.001  # ratio of excess latency the baseline follows
+    _LATENCY_SMOOTHING = 0.2  # weight of a new sample in smoothed latency
+
+    def __init__(
+        self,
+        initial_limit=ADAPTIVE_CONCURRENCY_INITIAL_LIMIT,
+        min_limit=ADAPTIVE_CONCURRENCY_MIN_LIMIT,
+        max_limit=ADAPTIVE_CONCURRENCY_MAX_LIMIT,
+        tolerance=ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE,
+        backoff=ADAPTIVE_CONCURRENCY_BACKOFF,
+        max_wait=ADAPTIVE_CONCURRENCY_MAX_WAIT,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.max_wait = max_wait
+
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self.inflight = 0
+        self.baseline = None  # seconds
+        self.latency = None  # seconds, smoothed
+
+        self.counters = _Counters(
+            "acquired", "waited", "rejected", "increases", "decreases"
+        )
+        self._cond = threading.Condition()
+        self._async_waiters = deque()  # (event loop, Future), in order
+        self._created_at = time.monotonic()
+        self._last_decrease_at = self._created_at
+        # (seconds since created, limit), of latest changes
+        self._history = deque(
+            [(0.0, int(self.limit))], maxlen=ADAPTIVE_CONCURRENCY_HISTORY_SIZE
+        )
+
+    def acquire(self):
+        """
+        :return: a slot, waiting for it if the limit is reached
+        :rtype: _LimiterPermit
+        :raises ConnectionError: no slot within ``max_wait``
+        """
+        with self._cond:
+            if self.inflight >= int(self.limit):
+                self.counters.incr("waited")
+                if not self._cond.wait_for(
+                    lambda: self.inflight < int(self.limit), self.max_wait
+                ):
+                    self.counters.incr("rejected")
+                    raise self._create_overloaded_error()
+            return self._acquire_locked()
+
+    async def acquire_async(self):
+        """
+        asyncio counterpart of ``acquire()``, waiting w/o blocking a thread
+
+
+        :rtype: _LimiterPermit
+        :raises ConnectionError: no slot within ``max_wait``
+        """
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.max_wait
+        is_waiting = False
+        while True:
+            with self._cond:
+                if self.inflight < int(self.limit):
+                    return self._acquire_locked()
+                if not is_waiting:
+                    is_waiting = True
+                    self.counters.incr("waited")
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    self.counters.incr("rejected")
+                    raise self._create_overloaded_error()
+                waiter = (loop, loop.create_future())
+                self._async_waiters.append(waiter)
+
+            try:
+                await asyncio.wait({waiter[1]}, timeout=timeout)
+            except asyncio.CancelledError:
+                with self._cond:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+                    else:  # woken meanwhile, pass the wake-up on
+                        self._wake_async_waiters(1)
+                raise
+            with self._cond:
+                if waiter in self._async_waiters:  # timed out
+                    self._async_waiters.remove(waiter)
+
+    def _acquire_locked(self):
+        self.inflight += 1
+        self.counters.incr("acquired")
+        # raise the limit only if it's the bound in effect
+        is_utilized = self.inflight * 2 >= int(self.limit)
+        return _LimiterPermit(self, time.monotonic(), is_utilized)
+
+    def _create_overloaded_error(self):
+        return ConnectionError(
+            "Dify App is overloaded, {} rounds in flight for {}s".format(
+                self.inflight, self.max_wait
+            )
+        )
+
+    def _wake_async_waiters(self, count=None):
+        """
+        wake up to ``count`` async waiters, all if None, to check for a slot
+        """
+        while self._async_waiters and count != 0:
+            loop, future = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:  # event loop closed, waiter is gone
+                continue
+            if count is not None:
+                count -= 1
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def on_sample(self, permit, latency, is_congested):
+        """
+        adapt the limit by a sample of ``permit``
+        """
+        now = time.monotonic()
+        with self._cond:
+            if not is_congested:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += (
+                        latency - self.latency
+                    ) * self._LATENCY_SMOOTHING
+
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                is_congested = self.latency > self.baseline * self.tolerance
+                if not is_congested:  # never drift towards congestion
+                    self.baseline += (
+                        latency - self.baseline
+                    ) * self._BASELINE_DRIFT
+
+            former = int(self.limit)
+            if is_congested:
+                # samples sent before the last cut reflect the former limit
+                if permit.acquired_at < self._last_decrease_at:
+                    return
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_decrease_at = now
+                self.counters.incr("decreases")
+
+            elif permit.is_utilized:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.counters.incr("increases")
+
+            if int(self.limit) != former:
+                self._history.append(
+                    (round(now - self._created_at, 3), int(self.limit))
+                )
+                self._cond.notify_all()
+                self._wake_async_waiters()
+
+    def release(self):
+        """
+        release a slot acquired by ``acquire()``
+        """
+        with self._cond:
+            self.inflight -= 1
+            self._cond.notify()
+            self._wake_async_waiters(1)
+
+    def snapshot(self):
+        """
+        :return: metrics of this limiter, incl. history of the limit
+        :rtype: dict
+        """
+        opt = self.counters.snapshot()
+        with self._cond:
+            opt["limit"] = int(self.limit)
+            opt["inflight"] = self.inflight
+            opt["baseline_latency"] = self.baseline
+            opt["latency"] = self.latency
+            opt["limit_history"] = list(self._history)
+        return opt
+
+
+class _LimiterPermit:
+    """
+    a slot of ``_AdaptiveLimiter``, sampled & released at most once each
+
+
+    :param limiter:
+    :type limiter: _AdaptiveLimiter
+    :param acquired_at:
+    :type acquired_at: float
+    :param is_utilized: whether the limit is utilized once acquired
+    :type is_utilized: bool
+    """
+
+    def __init__(self, limiter, acquired_at, is_utilized):
+        self.limiter = limiter
+        self.acquired_at = acquired_at
+        self.is_utilized = is_utilized
+        # when the request is sent, latency is measured from, such that
+        # waiting for a transport thread is never sampled as Dify's latency
+        self.sent_at = acquired_at
+        self._is_sampled = False
+        self._is_released = False
+        self._lock = threading.Lock()
+
+    def sample(self, is_congested=False):
+        """
+        sample latency since sent, or congestion, once
+        """
+        with self._lock:
+            if self._is_sampled:
+                return
+            self._is_sampled = True
+        self.limiter.on_sample(
+            self, time.monotonic() - self.sent_at, is_congested
+        )
+
+    def release(self):
+        """
+        release the slot, once
+        """
+        with self._lock:
+            if self._is_released:
+                return
+            self._is_released = True
+        self.limiter.release()
+
+
+class _FirstRoundTable:
+    """
+    table of OWU chats whose 1st round is creating a Dify conversation,
+    such that other rounds of the same chat wait for its ``conversation_id``
+    instead of creating another conversation
+
+    sharded by ``chat_id`` to avoid a global bottleneck, & self-cleaning:
+    an entry lives only while its 1st round is in flight,
+    or is taken over after ``wait_timeout`` seconds
+
+    rounds of async transport wait in OWU's event loop by ``claim_async()``,
+    never in transport threads
+
+
+    :param wait_timeout:
+    :type wait_timeout: float
+    """
+
+    _SHARD_NUMBER = 64
+
+    def __init__(self, wait_timeout=FIRST_ROUND_WAIT_TIMEOUT):
+        self.wait_timeout = wait_timeout
+        self.counters = _Counters("claims", "waits", "wait_timeouts")
+        # each shard: lock,
+        # {chat_id: (Event, claimed_at, [(event loop, Future)])}
+        self._shards = [
+            (threading.Lock(), {}) for _ in range(self._SHARD_NUMBER)
+        ]
+
+    def claim(self, chat_id):
+        """
+        claim 1st round of ``chat_id``, or wait for the round claimed it
+
+        :return: True if claimed, ``release()`` must be called afterward;
+                False once the claiming round is released (or timeout)
+        :rtype: bool
+        """
+        now = time.monotonic()
+        entry = self._try_claim(chat_id, now)
+        if entry is None:
+            return True
+
+        self.counters.incr("waits")
+        if not entry[0].wait(self.wait_timeout - (now - entry[1])):
+            self.counters.incr("wait_timeouts")
+        return False
+
+    async def claim_async(self, chat_id):
+        """
+        asyncio counterpart of ``claim()``, waiting w/o blocking a thread
+
+        :rtype: bool
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        now = time.monotonic()
+        entry = self._try_claim(chat_id, now, (loop, future))
+        if entry is None:
+            return True
+
+        self.counters.incr("waits")
+        done, _ = await asyncio.wait(
+            {future}, timeout=self.wait_timeout - (now - entry[1])
+        )
+        if not done:
+            self.counters.incr("wait_timeouts")
+        return False
+
+    def _try_claim(self, chat_id, now, async_waiter=None):
+        """
+        :return: None if claimed, otherwise entry of the claiming round,
+                whose release wakes ``async_waiter``, if any
+        :rtype: tuple or None
+        """
+        lock, entries = self._shard(chat_id)
+
+        with lock:
+            entry = entries.get(chat_id)
+            if entry is None or now - entry[1] > self.wait_timeout:
+                entries[chat_id] = (threading.Event(), now, [])
+                self.counters.incr("claims")
+                return None
+            if async_waiter is not None:
+                entry[2].append(async_waiter)
+            return entry
+
+    def release(self, chat_id):
+        """
+        release claim of ``chat_id``, waking all rounds waiting for it
+        """
+        lock, entries = self._shard(chat_id)
+
+        with lock:
+            entry = entries.pop(chat_id, None)
+        if entry is None:
+            return
+        entry[0].set()
+        for loop, future in entry[2]:
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:  # event loop closed, waiter is gone
+                continue
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self._shards)
+
+    def snapshot(self):
+        """
+        :return: metrics of this table
+        :rtype: dict{str: int}
+        """
+        opt = self.counters.snapshot()
+        opt["in_flight"] = len(self)
+        return opt
+
+    def _shard(self, chat_id):
+        return self._shards[hash(chat_id) % self._SHARD_NUMBER]
+
+
+class _HTTPSessionPool:
+    """
+    process-wide pool of ``requests.Session``, one per Dify base URL,
+    such that TCP/TLS connections are kept alive & reused across rounds
+    and across all models
+
+    ``"hits"``/``"misses"`` count requests served by a reused connection
+    or by a newly opened one (paying TCP/TLS handshake) respectively
+
+
+    :param maxsize: max kept-alive connections per base URL
+    :type maxsize: int
+    :param enables_tcp_keepalive: whether send TCP keep-alive probes
+    :type enables_tcp_keepalive: bool
+    :param idle_timeout: seconds a session can stay unused before closed
+    :type idle_timeout: float
+    """
+
+    def __init__(
+        self,
+        maxsize=HTTP_POOL_MAXSIZE,
+        enables_tcp_keepalive=HTTP_POOL_ENABLES_TCP_KEEPALIVE,
+        idle_timeout=HTTP_POOL_IDLE_TIMEOUT,
+    ):
+        self.maxsize = maxsize
+        self.enables_tcp_keepalive = enables_tcp_keepalive
+        self.idle_timeout = idle_timeout
+
+        self.counters = _Counters("requests", "misses", "evictions")
+        self._lock = threading.Lock()
+        self._sessions = {}  # base_url: [session, last_used]
+
+    def session(self, base_url):
+        """
+        :return: pooled session of ``base_url``, created on first use
+        :rtype: requests.Session
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict_idle(now)
+
+            if base_url not in self._sessions:
+                self._sessions[base_url] = [self._create_session(), now]
+
+            entry = self._sessions[base_url]
+            entry[1] = now
+            return entry[0]
+
+    def close(self):
+        """
+        close all sessions, with their connections
+        """
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def snapshot(self):
+        """
+        :return: metrics of this pool
+        :rtype: dict{str: int}
+        """
+        opt = self.counters.snapshot()
+        opt["hits"] = opt["requests"] - opt["misses"]
+        with self._lock:
+            opt["sessions"] = len(self._sessions)
+        return opt
+
+    def _evict_idle(self, now):
+        for base_url, (session, last_used) in list(self._sessions.items()):
+            if now - last_used > self.idle_timeout:
+                session.close()
+                del self._sessions[base_url]
+                self.counters.incr("evictions")
+
+    def _create_session(self):
+        adapter = _CountingHTTPAdapter(
+            self.counters,
+            pool_maxsize=self.maxsize,
+            enables_tcp_keepalive=self.enables_tcp_keepalive,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """
+    ``HTTPAdapter`` counting requests & newly opened connections
+    into ``counters`` of ``_HTTPSessionPool``
+    """
+
+    def __init__(self, counters, *, enables_tcp_keepalive, **kwargs):
+        self.counters = counters
+        self.enables_tcp_keepalive = enables_tcp_keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.enables_tcp_keepalive:
+            kwargs["socket_options"] = (
+                HTTPConnection.default_socket_options
+                + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+            )
+        super().init_poolmanager(*args, **kwargs)
+
+        counters = self.counters
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            def _new_conn(self):
+                counters.incr("misses")
+                return super()._new_conn()
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            def _new_conn(self):
+                counters.incr("misses")
+                return super()._new_conn()
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, *args, **kwargs):
+        self.counters.incr("requests")
+        return super().send(request, *args, **kwargs)
+
+
+class _StdlibJSONCodec:
+    """
+    JSON codec by stdlib json
+    """
+
+    name = "json"
+
+    @staticmethod
+    def dumps(obj):
+        """
+        :return: serialized ``obj``, encoded in UTF-8
+        :rtype: bytes
+        """
+        return json.dumps(obj).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        """
+        :param data: JSON encoded in UTF-8
+        :type data: bytes
+        :raises UnicodeDecodeError:
+        :raises json.JSONDecodeError:
+        """
+        # decoding first spares json.loads() from detecting the encoding
+        return json.loads(data.decode("utf-8"))
+
+
+class _OrjsonJSONCodec:
+    """
+    JSON codec by orjson, whose ``JSONDecodeError`` subclasses stdlib's;
+    interchangeable w/ ``_StdlibJSONCodec``, except that invalid UTF-8
+    raises ``json.JSONDecodeError`` too
+    """
+
+    name = "orjson"
+
+    dumps = staticmethod(orjson.dumps) if orjson else None
+    loads = staticmethod(orjson.loads) if orjson else None
+
+
+class _AppInfoCache:
+    """
+    file-backed cache of App type & name responded by GET /info,
+    keyed by base URL & hash of App key (never storing key itself)
+
+
+    :param path: path of cache file (JSON); None to disable
+    :type path: str or None
+    """
+
+    def __init__(self, path=APP_INFO_CACHE_PATH):
+        self.path = path
+        self.counters = _Counters("hits", "misses", "revalidation_failures")
+        self._lock = threading.Lock()
+        self._entries = None  # loaded on first use
+
+    def get(self, base_url, key):
+        """
+        :return: cached App type & name, None if absent
+        :rtype: tuple(DifyAppType, str) or None
+        """
+        if self.path is None:
+            return None
+
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._read()
+            entry = self._entries.get(_hash_app_key(base_url, key))
+
+        try:
+            opt = DifyAppType(entry["mode"]), entry["name"]
+        except (TypeError, KeyError, ValueError):  # absent or malformed
+            self.counters.incr("misses")
+            return None
+
+        self.counters.incr("hits")
+        return opt
+
+    def put(self, base_url, key, app_type, name):
+        """
+        store App type & name, then write cache file
+
+        :return: whether cached entry is changed
+        :rtype: bool
+        """
+        if self.path is None:
+            return False
+
+        entry = {"mode": app_type.value, "name": name}
+        entry_key = _hash_app_key(base_url, key)
+
+        with self._lock:
+            # merge w/ entries written by other processes
+            self._entries = self._read()
+            if self._entries.get(entry_key) == entry:
+                return False
+            self._entries[entry_key] = entry
+
+            try:
+                self._write()
+            except OSError:  # cache is best-effort
+                pass
+
+        return True
+
+    def snapshot(self):
+        """
+        :return: metrics of this cache
+        :rtype: dict{str: int}
+        """
+        return self.counters.snapshot()
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                entries = json.load(file)
+        except (OSError, ValueError):  # absent or corrupted
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _write(self):
+        # write atomically, never leaving a partial file for other processes;
+        # mkstemp() creates it readable & writable by its owner only (0600)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(self._entries, file)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+
+# Pipe class required by OWU  ##################################################
+class Pipe:  # pylint: disable=missing-class-docstring
+
+    class Valves(BaseModel):
+        pass  # configuration via Python constants
+
+    def __init__(
+        self,
+        app_model_configs_override=None,
+        base_url_override=None,
+        disable_get_app_type_and_name=False,
+    ):
+        base_url = base_url_override or DIFY_BACKEND_API_BASE_URL
+        app_model_configs = app_model_configs_override or APP_MODEL_CONFIGS
+
+        _check_app_model_configs_structure(app_model_configs)
+
+        # populate containers   ------------------------------------------------
+        def create_model(config):
+            return OWUModel(
+                base_url,
+                config,
+                disable_get_app_type_and_name=disable_get_app_type_and_name,
+                defer_get_app_type_and_name=DEFERS_APP_TYPE_DISCOVERY,
+            )
+
+        if disable_get_app_type_and_name or DEFERS_APP_TYPE_DISCOVERY:
+            models = [create_model(config) for config in app_model_configs]
+        else:  # fan out GET /info probes
+            with ThreadPoolExecutor(
+                max_workers=min(
+                    STARTUP_DISCOVERY_MAX_WORKERS, len(app_model_configs)
+                ),
+                thread_name_prefix="dify-discovery",
+            ) as executor:
+                models = list(executor.map(create_model, app_model_configs))
+
+        self.model_containers = {}
+        for model in models:
+            model_id = model.model_id
+            self.model_containers[model_id] = model
+
+        # OWU background tasks  ------------------------------------------------
+        for model in models:
+            for policy in model.task_policies.values():
+                if (
+                    policy.startswith("route:")
+                    and policy[len("route:") :] not in self.model_containers
+                ):
+                    raise ValueError(
+                        "'task_policy' of model {} routes to unknown model: "
+                        "{}".format(model.model_id, policy)
+                    )
+
+        self.task_reply_cache = _WorkflowResultCache(
+            TASK_REPLY_CACHE_TTL, max_entries=TASK_REPLY_CACHE_MAX_ENTRIES
+        )
+        self.task_counters = {}  # task: _Counters, by policy applied
+        self._task_counters_lock = threading.Lock()
+
+        # latency of rounds until replied, or their streaming started
+        self.lane_latencies = {
+            lane: _LatencyRecorder(LANE_LATENCY_WINDOW)
+            for lane in PRIORITY_LANES
+        }
+
+    def pipes(self):
+        """
+        :return: all models, e.g.::
+
+            [
+                {"id": "model_id_1", "name": "First Model"},
+                {"id": "model_id_2", "name": "Second Model"},
+                {"id": "model_id_3", "name": "Third Model"},
+            ]
+
+        :rtype: list(dict)
+        """
+        return [
+            model.get_model_id_and_name()
+            for model in self.model_containers.values()
+        ]
+
+    async def pipe(self, body, __user__, __metadata__):
+        """
+        main pipe logic per round
+
+
+        :param body: message body
+        :type body: dict
+        :param __user__: user information
+        :type __user__: dict
+        :raises KeyError: missing `"model"` in `body`
+        :return: replied message by the model
+        :rtype: str
+        """
+        if DEBUG_PIPE_DIRECT_RESPONSE:
+            return """## `body`
+
+{}
+
+## `__user__`
+
+{}
+
+## `__metadata__`
+
+{}
+""".format(body, __user__, __metadata__)
+
+        if "model" not in body:
+            raise IndexError("missing entry 'model' in body")
+
+        # extract model_id from body
+        model_id = body["model"][body["model"].find(".") + 1 :]
+        model = self.model_containers[model_id]
+
+        lane = _classify_lane(body, __user__, __metadata__)
+        started_at = time.monotonic()
+        try:
+            task = _get_owu_task(body, __metadata__)
+            if task is not None:  # OWU background task, e.g. title generation
+                return await self._reply_task(
+                    task, model, body, __user__, __metadata__, lane
+                )
+
+            return await self._reply(model, body, __user__, __metadata__, lane)
+
+        finally:
+            self.lane_latencies[lane].record(time.monotonic() - started_at)
+
+    async def _reply(self, model, body, user, metadata, lane=None):
+        """
+        reply a round by Dify App of ``model``, once admitted by its
+        admission gate in priority ``lane``, fairly among users, if any;
+        BUSY_REPLY if not admitted
+
+
+        :return: the response
+        :rtype: str or Iterator or AsyncGenerator
+        """
+        gate = model.admission_gate
+        if gate is None:
+            return await self._reply_admitted(model, body, user, metadata)
+
+        user_key = _get_user_key(user)
+        if not await gate.acquire(lane, user_key):
+            return BUSY_REPLY.format(name=model.name)
+        release = functools.partial(gate.release, user_key)
+
+        try:
+            opt = await self._reply_admitted(model, body, user, metadata)
+        except BaseException:
+            release()
+            raise
+
+        # a streaming round holds its slot until it ends or is closed
+        if isinstance(opt, AsyncGenerator):
+            return _AdmittedAsyncRound(opt, release)
+        if not isinstance(opt, str):
+            return _AdmittedRound(opt, release)
+        release()
+        return opt
+
+    async def _reply_admitted(self, model, body, user, metadata):
+        if ENABLES_ASYNC_TRANSPORT:
+            return await model.reply_async(body, user, metadata)
+
+        permit = await model.acquire_concurrency_permit()
+        try:
+            # blocking OWU's event loop
+            return model.reply(body, user, metadata, permit)
+        except BaseException:
+            if permit is not None:
+                permit.release()
+            raise
+
+    async def _reply_task(self, task, model, body, user, metadata, lane):
+        """
+        serve a round of OWU background ``task`` by its policy of ``model``,
+        q.v. DEFAULT_TASK_POLICY
+
+
+        :return: the response
+        :rtype: str
+        """
+        policy = model.get_task_policy(task)
+        counters = self._get_task_counters(task)
+        # OWU never streams task replies, as it parses them as a whole
+        body = dict(body, stream=False)
+        metadata = dict(metadata, task=task)
+
+        if policy == "local":
+            counters.incr("local")
+            return _create_local_task_reply(task, body)
+
+        if policy.startswith("route:"):
+            counters.incr("routed")
+            model = self.model_containers[policy[len("route:") :]]
+            return await self._reply(model, body, user, metadata, lane)
+
+        if policy == "low_priority":
+            counters.incr("low_priority")
+            async with _get_task_round_semaphore():
+                return await self._reply(model, body, user, metadata, lane)
+
+        if policy == "cache":
+            cache_key = hashlib.sha256(
+                json.dumps(
+                    [model.model_id, task, body.get("messages")],
+                    sort_keys=True,
+                    default=str,
+                ).encode("utf-8")
+            ).hexdigest()
+            cached = self.task_reply_cache.get(cache_key)
+            if cached is not None:
+                counters.incr("cached")
+                return cached[0]
+
+            counters.incr("passed")
+            opt = await self._reply(model, body, user, metadata, lane)
+            if isinstance(opt, str):
+                self.task_reply_cache.put(cache_key, opt)
+            return opt
+
+        counters.incr("passed")
+        return await self._reply(model, body, user, metadata, lane)
+
+    def _get_task_counters(self, task):
+        with self._task_counters_lock:
+            counters = self.task_counters.get(task)
+            if counters is None:
+                counters = self.task_counters[task] = _Counters(
+                    "passed", "local", "cached", "routed", "low_priority"
+                )
+            return counters
+
+    def metrics(self):
+        """
+        :return: runtime metrics of this adapter, for diagnosis
+        :rtype: dict
+        """
+        return {
+            "json_codec": _json_codec.name,
+            "http_pool": _http_session_pool.snapshot(),
+            "streaming_rounds": _streaming_round_counters.snapshot(),
+            "app_info_cache": _app_info_cache.snapshot(),
+            "conversation_id_stores": {
+                # pylint: disable-next=protected-access
+                model_id: model._app.chat2conversation_ids.snapshot()
+                for model_id, model in self.model_containers.items()
+                if isinstance(model._app, ChatflowDifyApp)
+            },
+            "chatflow_rounds": {
+                # pylint: disable-next=protected-access
+                model_id: model._app.counters.snapshot()
+                for model_id, model in self.model_containers.items()
+                if isinstance(model._app, ChatflowDifyApp)
+            },
+            "first_rounds": {
+                # pylint: disable-next=protected-access
+                model_id: model._app.first_rounds.snapshot()
+                for model_id, model in self.model_containers.items()
+                if isinstance(model._app, ChatflowDifyApp)
+            },
+            "workflow_result_caches": {
+                # pylint: disable-next=protected-access
+                model_id: model._app.result_cache.snapshot()
+                for model_id, model in self.model_containers.items()
+                if isinstance(model._app, WorkflowDifyApp)
+                and model._app.result_cache is not None
+            },
+            "task_rounds": {
+                task: counters.snapshot()
+                for task, counters in self.task_counters.items()
+            },
+            "task_reply_cache": self.task_reply_cache.snapshot(),
+            "adaptive_limiters": {
+                model_id: _adaptive_limiters[
+                    _hash_app_key(model.base_url, model.key)
+                ].snapshot()
+                for model_id, model in self.model_containers.items()
+                if _hash_app_key(model.base_url, model.key)
+                in _adaptive_limiters
+            },
+            "lane_latencies": {
+                lane: recorder.snapshot()
+                for lane, recorder in self.lane_latencies.items()
+            },
+            "admission_gates": {
+                model_id: model.admission_gate.snapshot()
+                for model_id, model in self.model_containers.items()
+                if model.admission_gate is not None
+            },
+            "shared_rounds": {
+                # pylint: disable-next=protected-access
+                model_id: model._app.shared_rounds.snapshot()
+                for model_id, model in self.model_containers.items()
+                if isinstance(model._app, WorkflowDifyApp)
+                and model._app.shared_rounds is not None
+            },
+        }
+
+
+# helper methods  ==============================================================
+def _check_app_model_configs_structure(app_model_configs):
+    if len(app_model_configs) == 0:
+        raise ValueError(
+            "APP_MODEL_CONFIGS must contains at least one App/Model"
+        )
+
+    if any(not isinstance(config, dict) for config in app_model_configs):
+        raise ValueError("APP_MODEL_CONFIGS must contains only dicts")
+
+
+def _get_owu_task(body, metadata):
+    """
+    :return: OWU background task requesting this round,
+            e.g. ``"title_generation"``; None for rounds of user messages
+    :rtype: str or None
+    """
+    task = (metadata or {}).get("task")
+    if not task and isinstance(body.get("metadata"), dict):
+        task = body["metadata"].get("task")
+    return str(task) if task else None
+
+
+def _get_user_key(user):
+    """
+    :param user: OWU's ``__user__``
+    :type user: dict
+    :return: key of a user in fair share, by id, else email;
+            None if anonymous
+    :rtype: str
+    """
+    user = user or {}
+    return user.get("id") or user.get("email")
+
+
+def _classify_lane(body, user, metadata):
+    """
+    :return: priority lane of a round, q.v. PRIORITY_LANES
+    :rtype: str
+    """
+    metadata = metadata or {}
+    if _get_owu_task(body, metadata) is not None:
+        return "background"
+
+    user = user or {}
+    if (
+        user.get("id") in AUTOMATION_USER_IDS
+        or user.get("email") in AUTOMATION_USER_IDS
+        or not metadata.get("chat_id")
+    ):
+        return "api"
+    return "interactive"
+
+
+def _is_valid_task_policy(policy):
+    if not isinstance(policy, str):
+        return False
+    if policy.startswith("route:"):
+        return len(policy) > len("route:")
+    return policy in ("pass", "local", "cache", "low_priority")
+
+
+# 1st user message of chat history quoted in OWU's task prompts
+_TASK_PROMPT_USER_LINE_PATTERN = re.compile(r"^USER: *(.+)$", re.MULTILINE)
+_LOCAL_TITLE_MAX_WORDS = 6
+
+
+def _create_local_task_reply(task, body):
+    """
+    :return: cheap reply of OWU background ``task``, in the format OWU
+            parses, w/o requesting Dify; e.g. title from the 1st words of
+            the chat, & no tags or follow-ups
+    :rtype: str
+    """
+    if task == "title_generation":
+        prompt = ""
+        for message in body.get("messages") or ():
+            if message.get("role") == OWU_USER_ROLE and isinstance(
+                message.get("content"), str
+            ):
+                prompt = message["content"]
+        matched = _TASK_PROMPT_USER_LINE_PATTERN.search(prompt)
+        words = (matched[1] if matched else prompt).split()
+        title = " ".join(words[:_LOCAL_TITLE_MAX_WORDS]).rstrip(".,:;!?")
+        return json.dumps({"title": title}, ensure_ascii=False)
+
+    empty_replies = {
+        "tags_generation": {"tags": []},
+        "follow_up_generation": {"follow_ups": []},
+        "query_generation": {"queries": []},
+        "autocomplete_generation": {"text": ""},
+    }
+    if task in empty_replies:
+        return json.dumps(empty_replies[task])
+    return ""
+
+
+def _is_congestion_error(err):
+    """
+    :return: whether a failed request indicates Dify is congested,
+            i.e. 5xx, 429 or network errors, rather than a bad request
+    :rtype: bool
+    """
+    response = getattr(err, "response", None)
+    if response is None:
+        return True
+    return response.status_code >= 500 or response.status_code == 429
+
+
+_adaptive_limiters = {}  # hashed App key: _AdaptiveLimiter
+_adaptive_limiters_lock = threading.Lock()
+
+
+def _get_adaptive_limiter(base_url, key):
+    """
+    :return: process-wide adaptive limiter of a Dify App
+    :rtype: _AdaptiveLimiter
+    """
+    app_key = _hash_app_key(base_url, key)
+    with _adaptive_limiters_lock:
+        limiter = _adaptive_limiters.get(app_key)
+        if limiter is None:
+            limiter = _adaptive_limiters[app_key] = _AdaptiveLimiter()
+        return limiter
+
+
+def _hash_app_key(base_url, key):
+    """
+    :return: identifier of a Dify App, w/o exposing its secret key
+    :rtype: str
+    """
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return "{}#{}".format(base_url, digest[:32])
+
+
+# path: _SQLiteConversationDatabase, while any store refers to it
+_sqlite_conversation_databases = weakref.WeakValueDictionary()
+_sqlite_conversation_databases_lock = threading.Lock()
+
+
+def _create_conversation_id_store(base_url, key):
+    """
+    :return: store of ``conversation_id`` by ``CONVERSATION_STORE_BACKEND``
+    :rtype: _ConversationIdStore
+    :raises ValueError:
+    """
+    if CONVERSATION_STORE_BACKEND == "memory":
+        return _ConversationIdStore()
+
+    if CONVERSATION_STORE_BACKEND == "sqlite":
+        path = CONVERSATION_STORE_SQLITE_PATH
+        with _sqlite_conversation_databases_lock:
+            database = _sqlite_conversation_databases.get(path)
+            if database is None:
+                database = _sqlite_conversation_databases[path] = (
+                    _SQLiteConversationDatabase(path)
+                )
+        return _SQLiteConversationIdStore(
+            database, _hash_app_key(base_url, key)
+        )
+
+    raise ValueError(
+        "unknown CONVERSATION_STORE_BACKEND: {}".format(
+            CONVERSATION_STORE_BACKEND
+        )
+    )
+
+
+def _select_json_codec(backend):
+    """
+    :param backend: q.v. ``JSON_CODEC``
+    :type backend: str
+    :rtype: _StdlibJSONCodec | _OrjsonJSONCodec
+    :raises ValueError: unknown or uninstalled ``backend``
+    """
+    if backend == "auto":
+        backend = "orjson" if orjson else "json"
+
+    if backend == "json":
+        return _StdlibJSONCodec()
+
+    if backend == "orjson":
+        if orjson is None:
+            raise ValueError("JSON_CODEC is orjson, but it's not installed")
+        return _OrjsonJSONCodec()
+
+    raise ValueError("unknown JSON_CODEC: {}".format(backend))
+
+
+_json_codec = _select_json_codec(JSON_CODEC)
+_streaming_round_counters = _Counters(
+    "opened",
+    "force_closed",
+    "leaked",
+    "stop_requests",
+    "stop_failures",
+    "idle_timeouts",
+    "deadline_timeouts",
+)
+_http_session_pool = _HTTPSessionPool()
+_app_info_cache = _AppInfoCache()
+
+_transport_executor = None
+_transport_executor_lock = threading.Lock()
+_task_round_semaphores = weakref.WeakKeyDictionary()  # event loop: Semaphore
+
+
+def _get_task_round_semaphore():
+    """
+    :return: semaphore bounding "low_priority" task rounds
+            of the running event loop
+    :rtype: asyncio.Semaphore
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _task_round_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _task_round_semaphores[loop] = asyncio.Semaphore(
+            TASK_ROUNDS_MAX_CONCURRENCY
+        )
+    return semaphore
+
+
+def _get_transport_executor():
+    """
+    :return: process-wide thread pool running blocking Dify requests,
+            created on first use
+    :rtype: ThreadPoolExecutor
+    """
+    global _transport_executor  # pylint: disable=global-statement
+
+    with _transport_executor_lock:
+        if _transport_executor is None:
+            _transport_executor = ThreadPoolExecutor(
+                max_workers=ASYNC_TRANSPORT_MAX_WORKERS,
+                thread_name_prefix="dify-transport",
+            )
+        return _transport_executor
+
+
+async def _run_in_transport_thread(fx, *args):
+    """
+    run blocking ``fx(*args)`` in transport threads, without blocking
+    the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_transport_executor(), functools.partial(fx, *args)
+    )
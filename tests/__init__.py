@@ -50,3 +50,24 @@ EXAMPLE_BODY2 = {
         {"role": "user", "content": "THIRD USER MESSAGE"},
     ],
 }
+
+
+async def collect_chunks(reply):
+    """
+    :return: chunks of a streaming reply of ``Pipe.pipe()``,
+            or the reply itself if it's str
+    :rtype: list(str) or str
+    """
+    if isinstance(reply, str):
+        return reply
+    return [chunk async for chunk in reply]
+
+
+async def collect_text(reply):
+    """
+    :return: text of a reply of ``Pipe.pipe()``, streaming or not
+    :rtype: str
+    """
+    if isinstance(reply, str):
+        return reply
+    return "".join(await collect_chunks(reply))
@@ -0,0 +1,276 @@
+"""
+adaptive_limiter_test.py
+
+Unit Tests (using pytest) for: _AdaptiveLimiter
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import (
+    Pipe,
+    _AdaptiveLimiter,
+    _hash_app_key,
+)
+
+from tests import EXAMPLE_BODY1, EXAMPLE_CHATFLOW_CONFIG, collect_text
+from tests.stand_in_dify_server import StandInDifyServer
+
+
+def _sample(limiter, latency, is_congested=False):
+    permit = limiter.acquire()
+    limiter.on_sample(permit, latency, is_congested)
+    permit.release()
+
+
+class TestLimit:
+
+    def test_increase_while_healthy(_):
+        limiter = _AdaptiveLimiter(initial_limit=2)
+
+        # keep the limit utilized
+        for _i in range(20):
+            permits = [limiter.acquire() for _j in range(limiter.inflight + 2)]
+            for permit in permits:
+                limiter.on_sample(permit, 0.1, False)
+                permit.release()
+
+        print(limiter.snapshot())
+        assert limiter.snapshot()["limit"] > 2
+        assert limiter.snapshot()["decreases"] == 0
+
+    def test_decrease_by_latency(_):
+        limiter = _AdaptiveLimiter(initial_limit=10, backoff=0.5)
+        _sample(limiter, 0.1)  # baseline
+
+        _sample(limiter, 1.0)
+
+        print(limiter.snapshot())
+        assert limiter.snapshot()["limit"] == 5
+        assert limiter.snapshot()["limit_history"][-1][1] == 5
+
+    def test_decrease_by_error(_):
+        limiter = _AdaptiveLimiter(initial_limit=10, backoff=0.5)
+
+        _sample(limiter, 0.0, is_congested=True)
+
+        print(limiter.snapshot())
+        assert limiter.snapshot()["limit"] == 5
+
+    def test_once_per_window(_):
+        limiter = _AdaptiveLimiter(initial_limit=10, backoff=0.5)
+        permits = [limiter.acquire() for _i in range(3)]  # in flight
+
+        for permit in permits:
+            permit.sample(is_congested=True)
+            permit.release()
+
+        print(limiter.snapshot())
+        assert limiter.snapshot()["decreases"] == 1
+        assert limiter.snapshot()["limit"] == 5
+
+    def test_min_limit(_):
+        limiter = _AdaptiveLimiter(initial_limit=2, backoff=0.1)
+
+        _sample(limiter, 0.0, is_congested=True)
+
+        print(limiter.snapshot())
+        assert limiter.snapshot()["limit"] == 1
+
+    def test_wait_then_reject(_):
+        limiter = _AdaptiveLimiter(initial_limit=1, max_wait=0.1)
+        permit = limiter.acquire()
+
+        with pytest.raises(ConnectionError):
+            limiter.acquire()
+
+        permit.release()
+        permit.release()  # once
+
+        print(limiter.snapshot())
+        assert limiter.snapshot()["rejected"] == 1
+        assert limiter.snapshot()["inflight"] == 0
+
+    def test_wait_then_acquire(_):
+        limiter = _AdaptiveLimiter(initial_limit=1, max_wait=5)
+        permit = limiter.acquire()
+        threading.Timer(0.1, permit.release).start()
+
+        opt = limiter.acquire()
+
+        print(limiter.snapshot())
+        assert opt.limiter is limiter
+        assert limiter.snapshot()["waited"] == 1
+
+
+class TestAsync:
+
+    def test_wait_then_acquire(_):
+        limiter = _AdaptiveLimiter(initial_limit=1, max_wait=5)
+        permit = limiter.acquire()
+
+        async def run():
+            asyncio.get_running_loop().call_later(0.1, permit.release)
+            return await limiter.acquire_async()
+
+        opt = asyncio.run(run())
+
+        print(limiter.snapshot())
+        assert opt.limiter is limiter
+        assert limiter.snapshot()["waited"] == 1
+        assert limiter.snapshot()["inflight"] == 1
+
+    def test_wait_then_reject(_):
+        limiter = _AdaptiveLimiter(initial_limit=1, max_wait=0.1)
+        limiter.acquire()
+
+        with pytest.raises(ConnectionError):
+            asyncio.run(limiter.acquire_async())
+
+        print(limiter.snapshot())
+        assert limiter.snapshot()["rejected"] == 1
+
+    def test_cancelled_passes_wake_up_on(_):
+        limiter = _AdaptiveLimiter(initial_limit=1, max_wait=5)
+        permit = limiter.acquire()
+
+        async def run():
+            cancelled = asyncio.ensure_future(limiter.acquire_async())
+            waiting = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0.01)
+            permit.release()  # wakes the 1st waiter, then cancelled
+            cancelled.cancel()
+            return await asyncio.wait_for(waiting, 1)
+
+        opt = asyncio.run(run())
+
+        print(limiter.snapshot())
+        assert opt.limiter is limiter
+        assert limiter.snapshot()["inflight"] == 1
+
+
+def _create_limited_pipe(monkeypatch, server, limiter):
+    monkeypatch.setattr(
+        dify_open_webui_adapter, "ENABLES_ADAPTIVE_CONCURRENCY", True
+    )
+    monkeypatch.setattr(
+        dify_open_webui_adapter,
+        "_adaptive_limiters",
+        {
+            _hash_app_key(
+                server.base_url, EXAMPLE_CHATFLOW_CONFIG["key"]
+            ): limiter
+        },
+    )
+    return Pipe(
+        app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+        base_url_override=server.base_url,
+    )
+
+
+async def _stream(pipe, metadata=None):
+    return await collect_text(
+        await pipe.pipe(EXAMPLE_BODY1, {}, metadata or {})
+    )
+
+
+class TestPipe:
+
+    def test_waiters_never_hold_transport_threads(
+        _, monkeypatch, small_transport_pool
+    ):
+        limiter = _AdaptiveLimiter(initial_limit=2, max_limit=2, max_wait=5)
+
+        with StandInDifyServer(chunks=["O", "K"], event_delay=0.05) as server:
+            pipe = _create_limited_pipe(monkeypatch, server, limiter)
+
+            async def run():
+                return await asyncio.gather(
+                    *(_stream(pipe) for _i in range(small_transport_pool * 2))
+                )
+
+            started_at = time.monotonic()
+            opt = asyncio.run(run())
+            elapsed = time.monotonic() - started_at
+
+        print(opt, elapsed, limiter.snapshot(), server.max_active)
+        assert opt == ["OK"] * small_transport_pool * 2
+        # 4 batches of 2 rounds, each ~0.1 seconds
+        assert elapsed < 2
+        assert limiter.snapshot()["rejected"] == 0
+        assert server.max_active <= 2
+        assert limiter.snapshot()["inflight"] == 0
+
+    def test_rejected_releases_first_round(_, monkeypatch):
+        limiter = _AdaptiveLimiter(initial_limit=1, max_limit=1, max_wait=0.1)
+        permit = limiter.acquire()  # saturated
+
+        with StandInDifyServer(chunks=["OK"]) as server:
+            pipe = _create_limited_pipe(monkeypatch, server, limiter)
+            app = pipe.model_containers["example-chatflow-model"].app
+
+            with pytest.raises(ConnectionError):
+                asyncio.run(pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "A"}))
+            permit.release()
+
+            # never waits for the rejected round
+            opt = asyncio.run(_stream(pipe, {"chat_id": "A"}))
+
+        print(opt, limiter.snapshot(), app.first_rounds.snapshot())
+        assert len(app.first_rounds) == 0
+        assert app.first_rounds.snapshot()["waits"] == 0
+        assert opt == "OK"
+        assert limiter.snapshot()["rejected"] == 1
+
+
+class TestSimulation:
+    """
+    streaming clients, more than transport threads, flood a stand-in Dify,
+    which then saturates, i.e. its latency grows w/ replies in flight beyond
+    its capacity, as in an incident
+
+    replies in flight are bounded by transport threads as well, hence the
+    incident's capacity is below them, such that the limit is what bounds
+    """
+
+    CLIENTS = 16
+    ROUNDS = 6
+
+    def test_converge(_, monkeypatch, small_transport_pool):
+        limiter = _AdaptiveLimiter(initial_limit=4)
+
+        with StandInDifyServer(chunks=["OK"], response_delay=0.05) as server:
+            pipe = _create_limited_pipe(monkeypatch, server, limiter)
+
+            async def run_client():
+                return [await _stream(pipe) for _i in range(_.ROUNDS)]
+
+            async def run_phase():
+                return await asyncio.gather(
+                    *(run_client() for _i in range(_.CLIENTS))
+                )
+
+            healthy = asyncio.run(run_phase())
+            healthy_metrics = limiter.snapshot()
+
+            server.capacity = 1  # incident
+            saturated = asyncio.run(run_phase())
+            metrics = pipe.metrics()["adaptive_limiters"]
+
+        metrics = metrics["example-chatflow-model"]
+        print(healthy_metrics, metrics, server.max_active)
+        assert _.CLIENTS > small_transport_pool
+        assert all(r == "OK" for rs in healthy + saturated for r in rs)
+        assert metrics["rejected"] == 0
+        # raised while healthy
+        assert healthy_metrics["limit"] > 4
+        # cut once saturated, latency doubles at 2 x capacity, i.e. ~2,
+        # below transport threads
+        assert metrics["decreases"] > 0
+        assert 1 <= metrics["limit"] < small_transport_pool
+        assert metrics["limit"] < healthy_metrics["limit"]
+        assert metrics["inflight"] == 0
@@ -0,0 +1,219 @@
+"""
+admission_gate_test.py
+
+Unit Tests (using pytest) for: _AdmissionGate
+"""
+
+import asyncio
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import OWUModel, Pipe, _AdmissionGate
+
+from tests import (
+    EXAMPLE_BASE_URL,
+    EXAMPLE_BODY1,
+    EXAMPLE_CHATFLOW_CONFIG,
+    collect_text,
+)
+from tests.stand_in_dify_server import StandInDifyServer
+
+
+def _create_pipe(server, **config):
+    return Pipe(
+        app_model_configs_override=[dict(EXAMPLE_CHATFLOW_CONFIG, **config)],
+        base_url_override=server.base_url,
+    )
+
+
+class TestGate:
+
+    def test_admit_then_queue_in_order(_):
+        gate = _AdmissionGate(max_inflight=1, max_queued=2, max_wait=5)
+        admitted = []
+
+        async def run_round(i):
+            assert await gate.acquire()
+            admitted.append(i)
+            await asyncio.sleep(0.05)
+            gate.release()
+
+        async def run():
+            await asyncio.gather(*(run_round(i) for i in range(3)))
+
+        asyncio.run(run())
+
+        print(admitted, gate.snapshot())
+        assert admitted == [0, 1, 2]
+        assert gate.snapshot()["queued"] == 2
+        assert gate.snapshot()["inflight"] == 0
+        assert gate.snapshot()["wait_time_max"] > 0
+
+    def test_rejected_full(_):
+        gate = _AdmissionGate(max_inflight=1, max_queued=0, max_wait=5)
+
+        async def run():
+            return [await gate.acquire(), await gate.acquire()]
+
+        opt = asyncio.run(run())
+
+        print(opt, gate.snapshot())
+        assert opt == [True, False]
+        assert gate.snapshot()["rejected_full"] == 1
+
+    def test_rejected_timeout(_):
+        gate = _AdmissionGate(max_inflight=1, max_queued=1, max_wait=0.1)
+
+        async def run():
+            return [await gate.acquire(), await gate.acquire()]
+
+        opt = asyncio.run(run())
+
+        print(opt, gate.snapshot())
+        assert opt == [True, False]
+        assert gate.snapshot()["rejected_timeout"] == 1
+        assert gate.snapshot()["queue_depth"] == 0
+
+    def test_cancelled_waiter(_):
+        gate = _AdmissionGate(max_inflight=1, max_queued=1, max_wait=5)
+
+        async def run():
+            await gate.acquire()
+            waiting = asyncio.ensure_future(gate.acquire())
+            await asyncio.sleep(0.05)
+            depth = gate.snapshot()["queue_depth"]
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+            gate.release()
+            return depth
+
+        opt = asyncio.run(run())
+
+        print(opt, gate.snapshot())
+        assert opt == 1
+        assert gate.snapshot()["queue_depth"] == 0
+        assert gate.snapshot()["inflight"] == 0
+
+
+class TestConfig:
+
+    def test_unlimited_by_default(_):
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            EXAMPLE_CHATFLOW_CONFIG,
+            disable_get_app_type_and_name=True,
+        )
+
+        opt = model.admission_gate
+
+        print(opt)
+        assert opt is None
+
+    @pytest.mark.parametrize(
+        "config",
+        [
+            {"max_inflight_rounds": -1},
+            {"max_inflight_rounds": 1.5},
+            {"max_queued_rounds": True},
+            {"max_queue_wait": "10"},
+        ],
+    )
+    def test_invalid(_, config):
+        with pytest.raises(TypeError):
+            OWUModel(
+                EXAMPLE_BASE_URL,
+                dict(EXAMPLE_CHATFLOW_CONFIG, **config),
+                disable_get_app_type_and_name=True,
+            )
+
+
+class TestPipe:
+
+    def test_busy(_):
+        with StandInDifyServer(chunks=["A", "B"], event_delay=0.2) as server:
+            pipe = _create_pipe(
+                server, max_inflight_rounds=1, max_queued_rounds=0
+            )
+
+            async def run_round(chat_id):
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": chat_id})
+                return await collect_text(opt)
+
+            async def run():
+                return await asyncio.gather(run_round("c1"), run_round("c2"))
+
+            opt = asyncio.run(run())
+            metrics = pipe.metrics()["admission_gates"]
+
+        print(opt, metrics)
+        assert sorted(opt) == sorted(
+            [
+                "AB",
+                "Example Chatflow Model/App is busy, please retry in a moment.",
+            ]
+        )
+        assert metrics["example-chatflow-model"]["rejected_full"] == 1
+
+    def test_queued(_):
+        with StandInDifyServer(chunks=["A", "B"], event_delay=0.1) as server:
+            pipe = _create_pipe(server, max_inflight_rounds=1)
+
+            async def run_round(chat_id):
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": chat_id})
+                return await collect_text(opt)
+
+            async def run():
+                return await asyncio.gather(
+                    *(run_round("c{}".format(i)) for i in range(3))
+                )
+
+            opt = asyncio.run(run())
+            metrics = pipe.metrics()["admission_gates"]
+
+        print(opt, metrics)
+        assert opt == ["AB"] * 3
+        assert metrics["example-chatflow-model"]["queued"] == 2
+        assert metrics["example-chatflow-model"]["inflight"] == 0
+
+    def test_released_once_closed(_):
+        with StandInDifyServer(chunks=["A", "B"], event_delay=0.1) as server:
+            pipe = _create_pipe(
+                server, max_inflight_rounds=1, max_queued_rounds=0
+            )
+
+            async def run():
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "c1"})
+                await opt.__anext__()
+                await opt.aclose()
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "c2"})
+                return await collect_text(opt)
+
+            opt = asyncio.run(run())
+
+        print(opt)
+        assert opt == "AB"
+
+    def test_sync_transport(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "ENABLES_ASYNC_TRANSPORT", False
+        )
+
+        with StandInDifyServer(chunks=["A", "B"]) as server:
+            pipe = _create_pipe(
+                server, max_inflight_rounds=1, max_queued_rounds=0
+            )
+
+            async def run():
+                opts = []
+                for chat_id in ("c1", "c2"):
+                    opt = await pipe.pipe(
+                        EXAMPLE_BODY1, {}, {"chat_id": chat_id}
+                    )
+                    opts.append("".join(opt))
+                return opts
+
+            opt = asyncio.run(run())
+
+        print(opt)
+        assert opt == ["AB", "AB"]
@@ -4,11 +4,25 @@ app_chatflow_test.py
 Unit Tests (using pytest) for: ChatflowDifyApp
 """
 
-from dify_open_webui_adapter import OWUModel, DifyAppType
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dify_open_webui_adapter import (
+    OWUModel,
+    DifyAppType,
+    Pipe,
+    _FirstRoundTable,
+)
 from tests import (
     EXAMPLE_BASE_URL,
+    EXAMPLE_BODY1,
     EXAMPLE_CHATFLOW_CONFIG,
+    collect_text,
 )
+from tests.stand_in_dify_server import StandInDifyServer
 
 
 class TestEndpointUrl:
@@ -43,3 +57,197 @@ class TestEndpointUrl:
         print(opt)
         assert isinstance(opt, str)
         assert opt == "http://11.22.33.44:1234/v1/chat-messages"
+
+
+class TestConcurrentRounds:  # rounds of different chats on the same app
+
+    def test_interleaved(_):
+        with StandInDifyServer() as server:
+            model = OWUModel(server.base_url, EXAMPLE_CHATFLOW_CONFIG)
+            app = model.app
+
+            # 1st rounds of chat A & B overlap
+            context_a = app.create_round_context({}, {"chat_id": "A"}, True)
+            context_b = app.create_round_context({}, {"chat_id": "B"}, True)
+            round_a = app.reply("A1", context_a)
+            round_b = app.reply("B1", context_b)
+            list(round_b)
+            list(round_a)
+
+            # 2nd rounds
+            for chat_id in ("A", "B"):
+                context = app.create_round_context(
+                    {}, {"chat_id": chat_id}, True
+                )
+                list(app.reply(chat_id + "2", context))
+
+        opt = {
+            payload["query"]: payload["conversation_id"]
+            for payload in server.posts()
+        }
+
+        print(opt)
+        assert opt["A1"] == opt["B1"] == ""
+        assert opt["A2"] == context_a.conversation_id
+        assert opt["B2"] == context_b.conversation_id
+        assert opt["A2"] != opt["B2"]
+
+
+class TestFirstRound:  # concurrent rounds of the same new chat
+
+    def test_wait_for_conversation(_):
+        with StandInDifyServer(event_delay=0.2) as server:
+            model = OWUModel(server.base_url, EXAMPLE_CHATFLOW_CONFIG)
+            app = model.app
+
+            context1 = app.create_round_context({}, {"chat_id": "A"}, True)
+            round1 = app.reply("A1", context1)
+
+            # e.g. a retry, arriving before conversation_id is known
+            with ThreadPoolExecutor() as executor:
+                future = executor.submit(
+                    app.create_round_context, {}, {"chat_id": "A"}, True
+                )
+                list(round1)
+                context2 = future.result(timeout=5)
+
+        print(context1, context2, app.first_rounds.snapshot())
+        assert context1.claims_first_round is False  # released
+        assert context2.conversation_id == context1.conversation_id
+        assert context2.claims_first_round is False
+        assert server.conversations == 1
+        assert len(app.first_rounds) == 0
+        assert app.first_rounds.snapshot()["waits"] == 1
+
+    def test_failed_first_round(_):
+        model = OWUModel(
+            "http://127.0.0.1:9/v1",  # discard port, refused
+            EXAMPLE_CHATFLOW_CONFIG,
+            disable_get_app_type_and_name=True,
+            app_type_override=DifyAppType.CHATFLOW,
+        )
+        app = model.app
+
+        context1 = app.create_round_context({}, {"chat_id": "A"}, False)
+        with pytest.raises(ConnectionError):
+            app.reply("A1", context1)
+        context2 = app.create_round_context({}, {"chat_id": "A"}, False)
+
+        print(context1, context2)
+        assert context2.claims_first_round is True  # claim was released
+        assert len(app.first_rounds) == 1
+
+
+class TestFirstRoundTable:
+
+    def test_timeout(_):
+        table = _FirstRoundTable(wait_timeout=0.1)
+
+        opt = [table.claim("A"), table.claim("A"), table.claim("A")]
+
+        print(opt, table.snapshot())
+        assert opt == [True, False, True]  # stale claim is taken over
+        assert table.snapshot()["wait_timeouts"] == 1
+        table.release("A")
+        assert len(table) == 0
+
+    def test_async_wait_then_release(_):
+        table = _FirstRoundTable(wait_timeout=5)
+        table.claim("A")
+
+        async def run():
+            asyncio.get_running_loop().call_later(0.1, table.release, "A")
+            return await table.claim_async("A")
+
+        opt = asyncio.run(run())
+
+        print(opt, table.snapshot())
+        assert opt is False
+        assert table.snapshot()["waits"] == 1
+        assert table.snapshot()["wait_timeouts"] == 0
+        assert len(table) == 0
+
+    def test_async_timeout(_):
+        table = _FirstRoundTable(wait_timeout=0.1)
+        table.claim("A")
+
+        opt = [asyncio.run(table.claim_async("A")) for _i in range(2)]
+
+        print(opt, table.snapshot())
+        assert opt == [False, True]  # stale claim is taken over
+        assert table.snapshot()["wait_timeouts"] == 1
+
+
+class TestTransportThreads:
+    """
+    rounds of a new chat, more than transport threads, wait for its 1st
+    round w/o holding transport threads, which the 1st round needs
+    """
+
+    def test_never_stall(_, small_transport_pool):
+        with StandInDifyServer(chunks=["O", "K"], event_delay=0.1) as server:
+            pipe = Pipe(
+                app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+                base_url_override=server.base_url,
+            )
+
+            async def run_round():
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "A"})
+                return await collect_text(opt)
+
+            async def run():
+                return await asyncio.gather(
+                    *(run_round() for _i in range(small_transport_pool * 2))
+                )
+
+            started_at = time.monotonic()
+            opt = asyncio.run(run())
+            elapsed = time.monotonic() - started_at
+            conversations = server.conversations
+
+        app = pipe.model_containers["example-chatflow-model"].app
+        print(opt, elapsed, app.first_rounds.snapshot())
+        assert opt == ["OK"] * small_transport_pool * 2
+        # far below FIRST_ROUND_WAIT_TIMEOUT
+        assert elapsed < 5
+        assert conversations == 1
+        assert app.first_rounds.snapshot()["waits"] > 0
+        assert app.first_rounds.snapshot()["wait_timeouts"] == 0
+
+
+class TestEphemeral:  # rounds w/o OWU chat_id
+
+    def test_not_remembered(_):
+        with StandInDifyServer() as server:
+            model = OWUModel(server.base_url, EXAMPLE_CHATFLOW_CONFIG)
+            app = model.app
+
+            contexts = []
+            for stream in (False, True, False):
+                context = app.create_round_context({}, {}, stream)
+                opt = app.reply("HELLO", context)
+                if stream:
+                    list(opt)
+                contexts.append(context)
+
+        print(contexts, app.counters.snapshot())
+        assert all(context.is_ephemeral for context in contexts)
+        assert all(context.conversation_id for context in contexts)
+        assert server.conversations == 3
+        assert len(app.chat2conversation_ids) == 0
+        assert len(app.first_rounds) == 0
+        assert app.counters.snapshot() == {"rounds": 3, "ephemeral_rounds": 3}
+
+    def test_not_ephemeral(_):
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            EXAMPLE_CHATFLOW_CONFIG,
+            disable_get_app_type_and_name=True,
+            app_type_override=DifyAppType.CHATFLOW,
+        )
+
+        opt = model.app.create_round_context({}, {"chat_id": "A"}, True)
+
+        print(opt)
+        assert opt.is_ephemeral is False
+        assert opt.chat_id == "A"
@@ -0,0 +1,156 @@
+"""
+coalesced_round_test.py
+
+Unit Tests (using pytest) for: _CoalescedConversationRound, _ChunkCoalescer
+"""
+
+import time
+
+import pytest
+
+from dify_open_webui_adapter import (
+    _ChunkCoalescer,
+    _CoalescedConversationRound,
+)
+
+
+def _slow_chunks(chunks, delay):
+    for chunk in chunks:
+        time.sleep(delay)
+        yield chunk
+
+
+class TestCoalesce:
+
+    def test_first_chunk(_):
+        coalesced = _CoalescedConversationRound(iter("ABCDEF"), 100, 10)
+
+        opt = next(coalesced)
+
+        print(opt)
+        assert opt == "A"
+
+    def test_max_chars(_):
+        coalesced = _CoalescedConversationRound(iter("ABCDEFG"), 3, 10)
+
+        opt = list(coalesced)
+
+        print(opt)
+        assert opt == ["A", "BCD", "EFG"]
+
+    def test_flush_at_end(_):
+        coalesced = _CoalescedConversationRound(iter("ABCDE"), 3, 10)
+
+        opt = list(coalesced)
+
+        print(opt)
+        assert opt == ["A", "BCD", "E"]
+
+    def test_max_delay(_):
+        coalesced = _CoalescedConversationRound(
+            _slow_chunks("ABCDE", 0.05), 100, 0.08
+        )
+
+        opt = list(coalesced)
+
+        print(opt)
+        assert opt[0] == "A"
+        assert "".join(opt) == "ABCDE"
+        assert all(len(chunk) <= 3 for chunk in opt)
+
+    def test_empty(_):
+        coalesced = _CoalescedConversationRound(iter(()), 3, 10)
+
+        opt = list(coalesced)
+
+        print(opt)
+        assert opt == []
+
+
+class TestError:
+
+    def test_flush_before_error(_):
+        def chunks():
+            yield from "ABC"
+            raise ValueError("broken stream")
+
+        coalesced = _CoalescedConversationRound(chunks(), 100, 10)
+
+        opt = [next(coalesced), next(coalesced)]
+
+        print(opt)
+        assert opt == ["A", "BC"]
+        with pytest.raises(ValueError):
+            next(coalesced)
+
+    def test_never_pull_ended(_):
+        class Round:  # raise if pulled after its end, as a closed response
+            def __init__(self):
+                self.chunks = iter("ABC")
+                self.is_ended = False
+
+            def __next__(self):
+                assert not self.is_ended
+                try:
+                    return next(self.chunks)
+                except StopIteration:
+                    self.is_ended = True
+                    raise
+
+        coalesced = _CoalescedConversationRound(Round(), 100, 10)
+
+        opt = list(coalesced)
+
+        print(opt)
+        assert opt == ["A", "BC"]
+
+
+class TestCoalescer:
+
+    def test_due(_):
+        coalescer = _ChunkCoalescer(max_chars=4, max_delay=1)
+
+        first = coalescer.add("A", 0.0)  # 1st of the round
+        coalescer.flush()
+
+        opt = [
+            coalescer.add("BC", 0.0),
+            coalescer.add("D", 0.5),
+            coalescer.add("EF", 0.6),  # max_chars
+        ]
+
+        print(opt)
+        assert first
+        assert opt == [False, False, True]
+        assert coalescer.flush() == "BCDEF"
+
+    def test_timeout(_):
+        coalescer = _ChunkCoalescer(max_chars=100, max_delay=1)
+        coalescer.add("A", 0.0)
+        coalescer.flush()
+        assert coalescer.timeout(0.0) is None
+
+        coalescer.add("B", 10.0)
+
+        opt = coalescer.timeout(10.25)
+
+        print(opt)
+        assert opt == 0.75
+        assert not coalescer.add("C", 10.5)
+        assert coalescer.add("D", 11.0)  # max_delay
+        assert coalescer.flush() == "BCD"
+
+    def test_fail(_):
+        coalescer = _ChunkCoalescer(max_chars=100, max_delay=1)
+        coalescer.add("A", 0.0)
+        coalescer.flush()
+        coalescer.add("B", 0.0)
+
+        opt = coalescer.fail(KeyError("answer"))
+
+        print(opt)
+        assert opt == "B"
+        with pytest.raises(KeyError):
+            coalescer.raise_pending_error()
+        with pytest.raises(StopIteration):
+            coalescer.fail(StopIteration())
@@ -0,0 +1,27 @@
+import pytest
+
+import dify_open_webui_adapter
+
+
+@pytest.fixture(autouse=True)
+def isolated_app_info_cache(tmp_path, monkeypatch):
+    # never read/write App info cache file of the real deployment
+    cache = dify_open_webui_adapter._AppInfoCache(
+        str(tmp_path / "app_info.json")
+    )
+    monkeypatch.setattr(dify_open_webui_adapter, "_app_info_cache", cache)
+    return cache
+
+
+@pytest.fixture(name="small_transport_pool")
+def fixture_small_transport_pool(monkeypatch):
+    """
+    transport threads fewer than concurrent rounds
+    """
+    monkeypatch.setattr(
+        dify_open_webui_adapter, "ASYNC_TRANSPORT_MAX_WORKERS", 4
+    )
+    monkeypatch.setattr(dify_open_webui_adapter, "_transport_executor", None)
+    yield 4
+    if dify_open_webui_adapter._transport_executor is not None:
+        dify_open_webui_adapter._transport_executor.shutdown()
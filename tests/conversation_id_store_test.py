@@ -0,0 +1,86 @@
+"""
+conversation_id_store_test.py
+
+Unit Tests (using pytest) for: _ConversationIdStore
+"""
+
+from dify_open_webui_adapter import (
+    OWUModel,
+    DifyAppType,
+    _ConversationIdStore,
+)
+
+from tests import EXAMPLE_BASE_URL, EXAMPLE_CHATFLOW_CONFIG
+
+
+class TestGetSet:
+
+    def test_absent(_):
+        store = _ConversationIdStore()
+
+        opt = store.get("chat-1", "")
+
+        print(opt)
+        assert opt == ""
+        assert len(store) == 0
+
+    def test_present(_):
+        store = _ConversationIdStore()
+        store["chat-1"] = "conv-1"
+
+        opt = store.get("chat-1")
+
+        print(opt)
+        assert opt == "conv-1"
+        assert store.snapshot()["hits"] == 1
+
+
+class TestEviction:
+
+    def test_lru(_):
+        store = _ConversationIdStore(max_entries=2)
+        store["chat-1"] = "conv-1"
+        store["chat-2"] = "conv-2"
+        store.get("chat-1")  # chat-2 becomes least-recently-used
+        store["chat-3"] = "conv-3"
+
+        opt = [store.get(c) for c in ("chat-1", "chat-2", "chat-3")]
+
+        print(opt, store.snapshot())
+        assert opt == ["conv-1", None, "conv-3"]
+        assert len(store) == 2
+        assert store.snapshot()["lru_evictions"] == 1
+
+    def test_ttl(_):
+        store = _ConversationIdStore(idle_ttl=-1)
+        store["chat-1"] = "conv-1"
+
+        opt = store.get("chat-1")
+
+        print(opt, store.snapshot())
+        assert opt is None
+        assert len(store) == 0
+        assert store.snapshot()["ttl_evictions"] == 1
+
+
+class TestChatflow:
+
+    def test_new_chat_not_stored(_):
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            EXAMPLE_CHATFLOW_CONFIG,
+            disable_get_app_type_and_name=True,
+            app_type_override=DifyAppType.CHATFLOW,
+        )
+        app = model.app
+        context = app.create_round_context({}, {"chat_id": "chat-1"}, True)
+
+        opt = context.conversation_id
+
+        print(opt)
+        assert opt == ""
+        assert len(app.chat2conversation_ids) == 0
+
+        app.set_conversation_id(context, "conv-1")
+        opt = app.create_round_context({}, {"chat_id": "chat-1"}, True)
+        assert opt.conversation_id == "conv-1"
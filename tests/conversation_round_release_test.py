@@ -0,0 +1,184 @@
+"""
+conversation_round_release_test.py
+
+Unit Tests (using pytest) for: releasing connection of abandoned
+_ConversationRound
+"""
+
+import asyncio
+import gc
+import time
+
+import pytest
+
+from dify_open_webui_adapter import (
+    Pipe,
+    _ConversationRound,
+    _streaming_round_counters,
+)
+
+from tests import EXAMPLE_BODY1, EXAMPLE_CHATFLOW_CONFIG
+from tests.stand_in_dify_server import StandInDifyServer
+
+CHUNKS = list("ABCDEFGHIJKLMNOPQRST")
+
+
+def _wait_for(predicate, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def _create_model(server):
+    pipe = Pipe(
+        app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+        base_url_override=server.base_url,
+    )
+    return pipe.model_containers[EXAMPLE_CHATFLOW_CONFIG["model_id"]]
+
+
+class TestAbandon:
+
+    def test_close(_):
+        before = _streaming_round_counters.snapshot()
+
+        with StandInDifyServer(chunks=CHUNKS, event_delay=0.05) as server:
+            conversation_round = _create_model(server).reply(
+                EXAMPLE_BODY1, {}, {"chat_id": "c1"}
+            )
+            assert next(conversation_round) == "A"
+
+            conversation_round.close()
+            conversation_round.close()  # idempotent
+
+            # Dify side sees the socket closed, w/o reading other chunks
+            assert _wait_for(lambda: server.aborted == 1)
+
+        opt = _streaming_round_counters.snapshot()
+        print(opt)
+        assert opt["force_closed"] - before["force_closed"] == 1
+        assert opt["leaked"] == before["leaked"]
+
+    def test_context_manager(_):
+        with StandInDifyServer(chunks=CHUNKS, event_delay=0.05) as server:
+            model = _create_model(server)
+
+            with model.reply(
+                EXAMPLE_BODY1, {}, {"chat_id": "c1"}
+            ) as conversation_round:
+                opt = next(conversation_round)
+
+            assert _wait_for(lambda: server.aborted == 1)
+
+        print(opt)
+        assert opt == "A"
+
+    def test_garbage_collected(_):
+        before = _streaming_round_counters.snapshot()
+
+        with StandInDifyServer(chunks=CHUNKS, event_delay=0.05) as server:
+            conversation_round = _create_model(server).reply(
+                EXAMPLE_BODY1, {}, {"chat_id": "c1"}
+            )
+            next(conversation_round)
+
+            del conversation_round  # dropped by the consumer
+            gc.collect()
+
+            assert _wait_for(lambda: server.aborted == 1)
+
+        opt = _streaming_round_counters.snapshot()
+        print(opt)
+        assert opt["leaked"] - before["leaked"] == 1
+
+    def test_async_aclose(_):
+        with StandInDifyServer(chunks=CHUNKS, event_delay=0.05) as server:
+            pipe = Pipe(
+                app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+                base_url_override=server.base_url,
+            )
+
+            async def run():
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "c1"})
+                first = await opt.__anext__()
+                await opt.aclose()  # e.g. stop pressed in OWU
+                return first
+
+            opt = asyncio.run(run())
+
+            assert _wait_for(lambda: server.aborted == 1)
+
+        print(opt)
+        assert opt == "A"
+
+    def test_async_aclose_mid_pull(_, caplog):
+        config = dict(
+            EXAMPLE_CHATFLOW_CONFIG,
+            coalesce_max_chars=100,
+            coalesce_max_delay=0.05,
+        )
+
+        with StandInDifyServer(chunks=CHUNKS, event_delay=0.2) as server:
+            pipe = Pipe(
+                app_model_configs_override=[config],
+                base_url_override=server.base_url,
+            )
+
+            async def run():
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "c1"})
+                chunks = [await opt.__anext__(), await opt.__anext__()]
+                await opt.aclose()  # while pulling the 3rd chunk
+                return chunks
+
+            opt = asyncio.run(run())
+            gc.collect()
+
+            assert _wait_for(lambda: server.aborted == 1)
+
+        print(opt, caplog.records)
+        assert opt == ["A", "B"]
+        assert not caplog.records
+
+    def test_end_of_round(_):
+        before = _streaming_round_counters.snapshot()
+
+        with StandInDifyServer(chunks=["A", "B"]) as server:
+            conversation_round = _create_model(server).reply(
+                EXAMPLE_BODY1, {}, {"chat_id": "c1"}
+            )
+            opt = list(conversation_round)
+
+        print(opt)
+        assert opt == ["A", "B"]
+        assert conversation_round._finalizer.alive is False
+        assert _streaming_round_counters["force_closed"] == (
+            before["force_closed"]
+        )
+
+
+class TestError:
+
+    def test_closed_on_error(_):
+        closes = []
+        sim_response = type(
+            "simulated response",
+            (),
+            {
+                "iter_content": lambda self, chunk_size=None: iter(
+                    [b'data: {"event": "message"}\n\n']  # missing answer
+                ),
+                "close": lambda self: closes.append(True),
+            },
+        )()
+        sim_app = type(
+            "simulated app",
+            (),
+            {"_open_reply_response": lambda _a, _b: sim_response},
+        )
+
+        with pytest.raises(KeyError):
+            next(_ConversationRound(sim_app, None))
+
+        print(closes)
+        assert closes == [True]
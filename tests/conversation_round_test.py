@@ -22,15 +22,19 @@ from .testee_conversation_round import (
     CHATFLOW_DATA3,
     CHATFLOW_ANSWER3,
 )
-from dify_open_webui_adapter import _ConversationRound
+import dify_open_webui_adapter
+from dify_open_webui_adapter import _ConversationRound, _StdlibJSONCodec
 
 
 def _create_simulated_app(text_streams):
+    # each line is sent as a single event
     sim_response = type(
         "simulated response",
         (),
         {
-            "iter_lines": lambda self: text_streams,
+            "iter_content": lambda self, chunk_size=None: (
+                bytes(line) + b"\n\n" for line in text_streams
+            ),
             "close": lambda self: None,
         },
     )()
@@ -233,9 +237,16 @@ class TestExhaust:
 
 class TestUnicode:
 
-    def test_workflow1(_):
+    def test_workflow1(_, monkeypatch):
+        # decoded by stdlib json, as orjson reports JSONDecodeError instead
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "_json_codec", _StdlibJSONCodec
+        )
         lines = convert_lines_from_data_dicts(WORKFLOW_DATA1)
-        bytes_obj = [bytearray(line, "utf_16") for line in lines]
+        bytes_obj = [
+            bytearray(line, "utf-8").replace(b"FIRST", b"FIRST\xff")
+            for line in lines
+        ]
         text_streams = iter(bytes_obj)
 
         with pytest.raises(UnicodeDecodeError) as exec_info:
@@ -246,16 +257,20 @@ class TestUnicode:
         opt = exec_info.value.args[0]
 
         print(opt)
-        assert (
-            opt
-            == "fail to decode text/event-stream: "
-            "'utf-8' codec can't decode byte 0xff in position 0: "
-            "invalid start byte"
+        assert opt.startswith(
+            "fail to decode text/event-stream: "
+            "'utf-8' codec can't decode byte 0xff in position "
         )
 
-    def test_chatflow1(_):
+    def test_chatflow1(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "_json_codec", _StdlibJSONCodec
+        )
         lines = convert_lines_from_data_dicts(CHATFLOW_DATA1)
-        bytes_obj = [bytearray(line, "utf_16") for line in lines]
+        bytes_obj = [
+            bytearray(line, "utf-8").replace(b"FIRST", b"FIRST\xff")
+            for line in lines
+        ]
         text_streams = iter(bytes_obj)
 
         with pytest.raises(UnicodeDecodeError) as exec_info:
@@ -265,12 +280,30 @@ class TestUnicode:
                 pass
         opt = exec_info.value.args[0]
 
+        print(opt)
+        assert opt.startswith(
+            "fail to decode text/event-stream: "
+            "'utf-8' codec can't decode byte 0xff in position "
+        )
+
+    def test_unknown_fields(_):
+        lines = convert_lines_from_data_dicts(CHATFLOW_DATA1)
+        bytes_obj = [bytearray(line, "utf_16") for line in lines]
+        text_streams = iter(bytes_obj)
+
+        # lines of unknown fields, ignored w/o decoding, as SSE spec says
+        with pytest.raises(ValueError) as exec_info:
+            for _ in _ConversationRound(
+                _create_simulated_app(text_streams), None
+            ):
+                pass
+        opt = exec_info.value.args[0]
+
         print(opt)
         assert (
             opt
-            == "fail to decode text/event-stream: "
-            "'utf-8' codec can't decode byte 0xff in position 0: "
-            "invalid start byte"
+            == "exhaust text/event-stream "
+            "but detect no events indicating finishing"
         )
 
 
@@ -0,0 +1,224 @@
+"""
+fair_share_test.py
+
+Unit Tests (using pytest) for: per-user fair share of _AdmissionGate
+"""
+
+import asyncio
+
+import pytest
+
+from dify_open_webui_adapter import (
+    OWUModel,
+    Pipe,
+    _AdmissionGate,
+    _get_user_key,
+)
+
+from tests import (
+    EXAMPLE_BASE_URL,
+    EXAMPLE_BODY1,
+    EXAMPLE_CHATFLOW_CONFIG,
+    collect_text,
+)
+from tests.stand_in_dify_server import StandInDifyServer
+
+
+def _admit_in_order(gate, users):
+    """
+    :return: users of waiters in order admitted, while a slot is held
+    """
+    admitted = []
+
+    async def wait(user):
+        assert await gate.acquire(user=user)
+        admitted.append(user)
+        gate.release(user)
+
+    async def run():
+        await gate.acquire(user="holder")
+        waiting = []
+        for user in users:
+            waiting.append(asyncio.ensure_future(wait(user)))
+            await asyncio.sleep(0.01)
+        gate.release("holder")
+        await asyncio.gather(*waiting)
+
+    asyncio.run(run())
+    return admitted
+
+
+class TestGetUserKey:
+
+    @pytest.mark.parametrize(
+        "user, expected",
+        [
+            ({"id": "u1", "email": "a@x"}, "u1"),
+            ({"email": "a@x"}, "a@x"),
+            ({}, None),
+            (None, None),
+        ],
+    )
+    def test_key(_, user, expected):
+        opt = _get_user_key(user)
+
+        print(opt)
+        assert opt == expected
+
+
+class TestGate:
+
+    def test_round_robin(_):
+        gate = _AdmissionGate(max_inflight=1, max_queued=8, max_wait=5)
+
+        opt = _admit_in_order(gate, ["heavy", "heavy", "heavy", "light"])
+
+        print(opt, gate.snapshot())
+        assert opt == ["heavy", "light", "heavy", "heavy"]
+
+    def test_cap_per_user(_):
+        gate = _AdmissionGate(
+            max_inflight=0, max_queued=8, max_wait=5, max_inflight_per_user=1
+        )
+
+        async def run():
+            assert await gate.acquire(user="a")
+            waiting = asyncio.ensure_future(gate.acquire(user="a"))
+            await asyncio.sleep(0.01)
+            assert await gate.acquire(user="b")  # not throttled by "a"
+            throttled = gate.snapshot()
+            gate.release("b")
+            await asyncio.sleep(0.01)
+            assert not waiting.done()  # only a round of "a" frees its slot
+            gate.release("a")
+            assert await waiting
+            gate.release("a")
+            return throttled
+
+        opt = asyncio.run(run())
+
+        print(opt, gate.snapshot())
+        assert opt["throttled"] == 1
+        assert opt["throttled_by_user"] == {"a": 1}
+        assert opt["queue_depth_by_user"] == {"a": 1}
+        assert opt["inflight_by_user"] == {"a": 1, "b": 1}
+        assert gate.snapshot()["inflight"] == 0
+        assert gate.snapshot()["inflight_by_user"] == {}
+
+    def test_throttled_skipped(_):
+        gate = _AdmissionGate(
+            max_inflight=2, max_queued=8, max_wait=5, max_inflight_per_user=1
+        )
+
+        async def run():
+            assert await gate.acquire(user="a")
+            assert await gate.acquire(user="b")
+            waiting_a = asyncio.ensure_future(gate.acquire(user="a"))
+            await asyncio.sleep(0.01)
+            waiting_c = asyncio.ensure_future(gate.acquire(user="c"))
+            await asyncio.sleep(0.01)
+            gate.release("b")  # "a" still at its cap, "c" served
+            await asyncio.sleep(0.01)
+            opt = [waiting_a.done(), waiting_c.done()]
+            gate.release("a")
+            assert await waiting_a
+            gate.release("a")
+            gate.release("c")
+            return opt
+
+        opt = asyncio.run(run())
+
+        print(opt, gate.snapshot())
+        assert opt == [False, True]
+        assert gate.snapshot()["inflight"] == 0
+
+    def test_throttled_users_bounded(_):
+        gate = _AdmissionGate(
+            max_inflight=0,
+            max_queued=8,
+            max_wait=0.01,
+            max_inflight_per_user=1,
+            max_throttled_users=2,
+        )
+
+        async def run():
+            for user in ("a", "b", "a", "c"):
+                assert await gate.acquire(user=user)
+                assert not await gate.acquire(user=user)  # throttled
+                gate.release(user)
+
+        asyncio.run(run())
+
+        print(gate.snapshot())
+        assert gate.snapshot()["throttled"] == 4
+        # least recently throttled "b" is dropped
+        assert gate.snapshot()["throttled_by_user"] == {"a": 2, "c": 1}
+
+
+class TestConfig:
+
+    def test_cap_only(_):
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            dict(EXAMPLE_CHATFLOW_CONFIG, max_inflight_rounds_per_user=2),
+            disable_get_app_type_and_name=True,
+        )
+
+        opt = model.admission_gate
+
+        print(opt)
+        assert opt.max_inflight == 0
+        assert opt.max_inflight_per_user == 2
+
+    def test_invalid(_):
+        with pytest.raises(TypeError):
+            OWUModel(
+                EXAMPLE_BASE_URL,
+                dict(EXAMPLE_CHATFLOW_CONFIG, max_inflight_rounds_per_user=-1),
+                disable_get_app_type_and_name=True,
+            )
+
+
+class TestPipe:
+
+    def test_heavy_user_throttled(_):
+        with StandInDifyServer(chunks=["A", "B"], event_delay=0.2) as server:
+            pipe = Pipe(
+                app_model_configs_override=[
+                    dict(
+                        EXAMPLE_CHATFLOW_CONFIG,
+                        max_inflight_rounds_per_user=1,
+                        max_queue_wait=0.1,
+                    )
+                ],
+                base_url_override=server.base_url,
+            )
+
+            async def run_round(user_id, chat_id):
+                opt = await pipe.pipe(
+                    EXAMPLE_BODY1, {"id": user_id}, {"chat_id": chat_id}
+                )
+                return await collect_text(opt)
+
+            async def run():
+                return await asyncio.gather(
+                    run_round("heavy", "c1"),
+                    run_round("heavy", "c2"),
+                    run_round("light", "c3"),
+                )
+
+            opt = asyncio.run(run())
+            metrics = pipe.metrics()["admission_gates"]
+
+        print(opt, metrics)
+        assert sorted(opt) == sorted(
+            [
+                "AB",
+                "AB",
+                "Example Chatflow Model/App is busy, please retry in a moment.",
+            ]
+        )
+        assert opt[2] == "AB"
+        assert metrics["example-chatflow-model"]["throttled_by_user"] == {
+            "heavy": 1
+        }
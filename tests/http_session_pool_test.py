@@ -0,0 +1,61 @@
+"""
+http_session_pool_test.py
+
+Unit Tests (using pytest) for: _HTTPSessionPool
+"""
+
+from dify_open_webui_adapter import OWUModel, _HTTPSessionPool
+import dify_open_webui_adapter
+
+from tests import EXAMPLE_CHATFLOW_CONFIG, EXAMPLE_CHATFLOW2_CONFIG
+from tests.stand_in_dify_server import StandInDifyServer
+
+
+class TestSession:
+
+    def test_shared_per_base_url(_):
+        pool = _HTTPSessionPool()
+
+        opt1 = pool.session("http://11.22.33.44:1234/v1")
+        opt2 = pool.session("http://11.22.33.44:1234/v1")
+        opt3 = pool.session("https://api.dify.ai/v1")
+
+        print(opt1, opt2, opt3)
+        assert opt1 is opt2
+        assert opt1 is not opt3
+
+    def test_idle_eviction(_):
+        pool = _HTTPSessionPool(idle_timeout=-1)
+
+        opt1 = pool.session("http://11.22.33.44:1234/v1")
+        opt2 = pool.session("http://11.22.33.44:1234/v1")
+
+        print(pool.snapshot())
+        assert opt1 is not opt2
+        assert pool.snapshot()["evictions"] == 1
+
+
+class TestHitsMisses:
+
+    def test_reuse_across_models(_, monkeypatch):
+        pool = _HTTPSessionPool()
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "_http_session_pool", pool
+        )
+
+        with StandInDifyServer() as server:
+            model1 = OWUModel(server.base_url, EXAMPLE_CHATFLOW_CONFIG)
+            model2 = OWUModel(server.base_url, EXAMPLE_CHATFLOW2_CONFIG)
+            for model in (model1, model2):
+                context = model.app.create_round_context(
+                    {}, {"chat_id": "c1"}, False
+                )
+                model.app.reply("HELLO", context)
+
+        opt = pool.snapshot()
+
+        print(opt)
+        assert model1.http_session is model2.http_session
+        assert opt["requests"] == 4  # 2 GET /info, 2 POST /chat-messages
+        assert opt["misses"] == 1
+        assert opt["hits"] == 3
@@ -0,0 +1,172 @@
+"""
+json_codec_test.py
+
+Unit Tests (using pytest) for: _StdlibJSONCodec, _OrjsonJSONCodec
+"""
+
+import json
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import (
+    _ConversationRound,
+    _RoundContext,
+    _StdlibJSONCodec,
+    _OrjsonJSONCodec,
+    _select_json_codec,
+    WorkflowDifyApp,
+    ChatflowDifyApp,
+    orjson,
+)
+
+from .testee_conversation_round import (
+    convert_lines_from_data_dicts,
+    convert_bytes_generator_from_lines,
+    WORKFLOW_DATA1,
+    WORKFLOW_DATA2,
+    WORKFLOW_DATA3,
+    WORKFLOW_DATA4,
+    WORKFLOW_ANSWER4,
+    CHATFLOW_DATA1,
+    CHATFLOW_DATA2,
+    CHATFLOW_DATA3,
+)
+from .conversation_round_test import _create_simulated_app
+
+ALL_DATA = [
+    data
+    for data_dicts in (
+        WORKFLOW_DATA1,
+        WORKFLOW_DATA2,
+        WORKFLOW_DATA3,
+        WORKFLOW_DATA4,
+        CHATFLOW_DATA1,
+        CHATFLOW_DATA2,
+        CHATFLOW_DATA3,
+    )
+    for data in data_dicts
+]
+
+requires_orjson = pytest.mark.skipif(
+    orjson is None, reason="orjson not installed"
+)
+
+
+class TestSelect:
+
+    def test_auto(_):
+        opt = _select_json_codec("auto")
+
+        print(opt.name)
+        assert opt.name == ("orjson" if orjson else "json")
+
+    def test_json(_):
+        opt = _select_json_codec("json")
+
+        print(opt.name)
+        assert isinstance(opt, _StdlibJSONCodec)
+
+    def test_unknown(_):
+        with pytest.raises(ValueError) as exec_info:
+            _select_json_codec("simdjson")
+
+        print(exec_info.value)
+        assert str(exec_info.value) == "unknown JSON_CODEC: simdjson"
+
+
+@requires_orjson
+class TestEquivalence:
+
+    def test_loads_fixtures(_):
+        for data in ALL_DATA:
+            raw = json.dumps(data).encode("utf-8")
+
+            opt = _OrjsonJSONCodec.loads(raw)
+
+            assert opt == _StdlibJSONCodec.loads(raw) == data
+
+    def test_dumps_fixtures(_):
+        for data in ALL_DATA:
+            opt = _OrjsonJSONCodec.dumps(data)
+
+            assert isinstance(opt, bytes)
+            assert json.loads(opt) == json.loads(_StdlibJSONCodec.dumps(data))
+
+    def test_dumps_unicode(_):
+        payload = {"query": '你好   "quoted" \\ 😀', "inputs": {}}
+
+        opt = _OrjsonJSONCodec.dumps(payload)
+
+        print(opt)
+        assert _StdlibJSONCodec.loads(opt) == payload
+        assert _OrjsonJSONCodec.loads(_StdlibJSONCodec.dumps(payload)) == (
+            payload
+        )
+
+    def test_decode_error(_):
+        for codec in (_StdlibJSONCodec, _OrjsonJSONCodec):
+            with pytest.raises(json.JSONDecodeError):
+                codec.loads(b'{"text": "value')
+
+
+def _reply(codec, monkeypatch, data_dicts):
+    monkeypatch.setattr(dify_open_webui_adapter, "_json_codec", codec)
+    text_streams = convert_bytes_generator_from_lines(
+        convert_lines_from_data_dicts(data_dicts)
+    )
+    return list(_ConversationRound(_create_simulated_app(text_streams), None))
+
+
+@requires_orjson
+class TestConversationRound:
+
+    def test_workflow(_, monkeypatch):
+        opts = [
+            _reply(codec(), monkeypatch, WORKFLOW_DATA4)
+            for codec in (_StdlibJSONCodec, _OrjsonJSONCodec)
+        ]
+
+        print(opts)
+        assert opts[0] == opts[1] == WORKFLOW_ANSWER4
+
+    def test_chatflow(_, monkeypatch):
+        opts = [
+            _reply(codec(), monkeypatch, CHATFLOW_DATA2)
+            for codec in (_StdlibJSONCodec, _OrjsonJSONCodec)
+        ]
+
+        print(opts)
+        assert opts[0] == opts[1]
+
+
+class TestPayload:
+
+    def test_workflow(_):
+        app = WorkflowDifyApp.__new__(WorkflowDifyApp)
+        app.query_identifier = "query"
+        app.input_fields = {"lang": "日本語"}
+
+        opt = app._create_post_request_payload(
+            "你好", _RoundContext(enable_stream=True)
+        )
+
+        print(opt)
+        assert isinstance(opt, bytes)
+        assert json.loads(opt) == {
+            "inputs": {"query": "你好", "lang": "日本語"},
+            "response_mode": "streaming",
+            "user": "user",
+        }
+
+    def test_chatflow(_):
+        app = ChatflowDifyApp.__new__(ChatflowDifyApp)
+        context = _RoundContext(enable_stream=False, conversation_id="conv-1")
+
+        opt = app._create_post_request_payload("你好", context)
+
+        print(opt)
+        assert isinstance(opt, bytes)
+        assert json.loads(opt)["query"] == "你好"
+        assert json.loads(opt)["conversation_id"] == "conv-1"
+        assert json.loads(opt)["response_mode"] == "blocking"
@@ -0,0 +1,145 @@
+"""
+model_app_info_cache_test.py
+
+Unit Tests (using pytest) for: OWUModel w/ _AppInfoCache
+"""
+
+import json
+import os
+import stat
+
+from dify_open_webui_adapter import (
+    OWUModel,
+    ChatflowDifyApp,
+    WorkflowDifyApp,
+    _AppInfoCache,
+)
+
+from tests import EXAMPLE_WORKFLOW_CONFIG
+from tests.stand_in_dify_server import StandInDifyServer
+
+
+class TestColdStart:
+
+    def test_miss(_, isolated_app_info_cache):
+        with StandInDifyServer(mode="workflow") as server:
+            model = OWUModel(server.base_url, EXAMPLE_WORKFLOW_CONFIG)
+            opt = isolated_app_info_cache.get(
+                server.base_url, EXAMPLE_WORKFLOW_CONFIG["key"]
+            )
+
+        print(opt)
+        assert isinstance(model.app, WorkflowDifyApp)
+        assert len(server.received) == 1
+        assert opt == (WorkflowDifyApp.app_type, "Stand-in App")
+
+    def test_hit(_, isolated_app_info_cache):
+        with StandInDifyServer(mode="workflow") as server:
+            isolated_app_info_cache.put(
+                server.base_url,
+                EXAMPLE_WORKFLOW_CONFIG["key"],
+                WorkflowDifyApp.app_type,
+                "Stand-in App",
+            )
+            model = OWUModel(server.base_url, EXAMPLE_WORKFLOW_CONFIG)
+            opt = model._app_info_revalidation.result(timeout=5)
+
+        print(model, opt)
+        assert isinstance(model.app, WorkflowDifyApp)
+        assert model.name == "Stand-in App"
+        assert opt is False  # revalidated, unchanged
+        assert isolated_app_info_cache.snapshot()["hits"] == 1
+
+
+class TestRevalidate:
+
+    def test_changed(_, isolated_app_info_cache):
+        with StandInDifyServer(
+            mode="advanced-chat", name="Renamed App"
+        ) as server:
+            isolated_app_info_cache.put(
+                server.base_url,
+                EXAMPLE_WORKFLOW_CONFIG["key"],
+                WorkflowDifyApp.app_type,
+                "Stale App",
+            )
+            model = OWUModel(server.base_url, EXAMPLE_WORKFLOW_CONFIG)
+            app_at_startup = model.app
+            opt = model._app_info_revalidation.result(timeout=5)
+
+        print(model, opt)
+        assert isinstance(app_at_startup, WorkflowDifyApp)
+        assert opt is True
+        assert isinstance(model.app, ChatflowDifyApp)
+        assert model.name == "Renamed App"
+
+    def test_unreachable(_, isolated_app_info_cache):
+        base_url = "http://127.0.0.1:9/v1"  # discard port, refused
+        isolated_app_info_cache.put(
+            base_url,
+            EXAMPLE_WORKFLOW_CONFIG["key"],
+            WorkflowDifyApp.app_type,
+            "Cached App",
+        )
+
+        model = OWUModel(base_url, EXAMPLE_WORKFLOW_CONFIG)
+        opt = model._app_info_revalidation.result(timeout=30)
+
+        print(model, opt)
+        assert opt is False
+        assert isinstance(model.app, WorkflowDifyApp)
+        assert model.name == "Cached App"
+        assert isolated_app_info_cache.snapshot()["revalidation_failures"] == 1
+
+
+class TestCacheFile:
+
+    def test_key_is_hashed(_, tmp_path):
+        path = str(tmp_path / "cache.json")
+        cache = _AppInfoCache(path)
+        cache.put(
+            "https://api.dify.ai/v1", "SECRET", WorkflowDifyApp.app_type, "A"
+        )
+
+        with open(path, encoding="utf-8") as file:
+            content = file.read()
+
+        print(content)
+        assert "SECRET" not in content
+        assert json.loads(content)
+
+        # read by another process
+        opt = _AppInfoCache(path).get("https://api.dify.ai/v1", "SECRET")
+        assert opt == (WorkflowDifyApp.app_type, "A")
+
+    def test_corrupted(_, tmp_path):
+        path = tmp_path / "cache.json"
+        path.write_text("{not json")
+
+        opt = _AppInfoCache(str(path)).get("https://api.dify.ai/v1", "KEY")
+
+        print(opt)
+        assert opt is None
+
+    def test_owner_only(_, tmp_path):
+        path = tmp_path / "cache.json"
+        cache = _AppInfoCache(str(path))
+        cache.put(
+            "https://api.dify.ai/v1", "KEY", WorkflowDifyApp.app_type, "A"
+        )
+
+        opt = stat.S_IMODE(os.stat(path).st_mode)
+
+        print(oct(opt))
+        assert opt == 0o600
+
+    def test_disabled_by_default(_):
+        cache = _AppInfoCache()
+        cache.put(
+            "https://api.dify.ai/v1", "KEY", WorkflowDifyApp.app_type, "A"
+        )
+
+        opt = cache.get("https://api.dify.ai/v1", "KEY")
+
+        print(opt)
+        assert opt is None
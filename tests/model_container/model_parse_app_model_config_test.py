@@ -211,6 +211,62 @@ class TestStream:  #  ==========================================================
         )
 
 
+class TestCoalesce:  #  ========================================================
+
+    def test_max_chars_type(_):
+        config = EXAMPLE_CHATFLOW_CONFIG.copy()
+        config["coalesce_max_chars"] = -1
+
+        with pytest.raises(TypeError) as exec_info:
+            OWUModel(
+                EXAMPLE_BASE_URL,
+                config,
+                disable_get_app_type_and_name=True,
+            )
+
+        opt = str(exec_info.value)
+        print(opt)
+
+        assert opt == (
+            "entry in APP_MODEL_CONFIGS, "
+            + "value of 'coalesce_max_chars' must be non-negative int: -1"
+        )
+
+    def test_max_delay_type(_):
+        config = EXAMPLE_CHATFLOW_CONFIG.copy()
+        config["coalesce_max_delay"] = "0.1"
+
+        with pytest.raises(TypeError) as exec_info:
+            OWUModel(
+                EXAMPLE_BASE_URL,
+                config,
+                disable_get_app_type_and_name=True,
+            )
+
+        opt = str(exec_info.value)
+        print(opt)
+
+        assert opt == (
+            "entry in APP_MODEL_CONFIGS, "
+            + "value of 'coalesce_max_delay' must be non-negative number: 0.1"
+        )
+
+    def test_set(_):
+        config = EXAMPLE_CHATFLOW_CONFIG.copy()
+        config["coalesce_max_chars"] = 64
+        config["coalesce_max_delay"] = 0.2
+
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            config,
+            disable_get_app_type_and_name=True,
+        )
+
+        print(model.coalesce_max_chars, model.coalesce_max_delay)
+        assert model.coalesce_max_chars == 64
+        assert model.coalesce_max_delay == 0.2
+
+
 # pass cases  ##################################################################
 class TestPass:
 
@@ -220,3 +276,20 @@ class TestPass:
             EXAMPLE_CHATFLOW_CONFIG,
             disable_get_app_type_and_name=True,
         )
+
+    def test_parsed_by_name(_):
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            EXAMPLE_CHATFLOW_CONFIG,
+            disable_get_app_type_and_name=True,
+        )
+
+        opt = model._parse_app_model_config_arg(
+            dict(EXAMPLE_CHATFLOW_CONFIG, max_inflight_rounds_per_user=2)
+        )
+
+        print(opt)
+        assert opt.key == EXAMPLE_CHATFLOW_CONFIG["key"]
+        assert opt.model_id == EXAMPLE_CHATFLOW_CONFIG["model_id"]
+        assert opt.max_inflight_rounds == 0
+        assert opt.max_inflight_rounds_per_user == 2
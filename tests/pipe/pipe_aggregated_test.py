@@ -0,0 +1,109 @@
+"""
+pipe_aggregated_test.py
+
+Unit Tests (using pytest) for: Pipe.pipe() w/ AGGREGATES_BLOCKING_ROUNDS
+"""
+
+import asyncio
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import Pipe
+from tests import (
+    EXAMPLE_BODY1,
+    EXAMPLE_CHATFLOW_CONFIG,
+    EXAMPLE_WORKFLOW_CONFIG,
+)
+from tests.stand_in_dify_server import StandInDifyServer
+
+BLOCKING_BODY = dict(EXAMPLE_BODY1, stream=False)
+
+
+@pytest.fixture(name="aggregates")
+def fixture_aggregates(monkeypatch):
+    monkeypatch.setattr(
+        dify_open_webui_adapter, "AGGREGATES_BLOCKING_ROUNDS", True
+    )
+
+
+def _create_pipe(server, config=EXAMPLE_CHATFLOW_CONFIG):
+    return Pipe(
+        app_model_configs_override=[config],
+        base_url_override=server.base_url,
+    )
+
+
+def _response_modes(server):
+    return [payload["response_mode"] for payload in server.posts()]
+
+
+class TestAggregated:
+
+    def test_chatflow(_, aggregates):
+        with StandInDifyServer(chunks=["HELLO ", "WORLD"]) as server:
+            pipe = _create_pipe(server)
+            opt = asyncio.run(pipe.pipe(BLOCKING_BODY, {}, {"chat_id": "c1"}))
+            opt2 = asyncio.run(pipe.pipe(BLOCKING_BODY, {}, {"chat_id": "c1"}))
+
+            response_modes = _response_modes(server)
+            conversation_ids = [
+                payload["conversation_id"] for payload in server.posts()
+            ]
+
+        print(opt, response_modes, conversation_ids)
+        assert opt == opt2 == "HELLO WORLD"
+        assert response_modes == ["streaming", "streaming"]
+        assert conversation_ids == ["", "conv-1"]  # conversation continued
+
+    def test_workflow(_, aggregates):
+        body = dict(
+            BLOCKING_BODY,
+            model="dify_open_webui_adapter.example-workflow-model",
+        )
+
+        with StandInDifyServer(
+            mode="workflow", chunks=["HELLO ", "WORLD"]
+        ) as server:
+            pipe = _create_pipe(server, EXAMPLE_WORKFLOW_CONFIG)
+            opt = asyncio.run(pipe.pipe(body, {}, {"chat_id": "c1"}))
+
+            response_modes = _response_modes(server)
+
+        print(opt, response_modes)
+        assert opt == "HELLO WORLD"
+        assert response_modes == ["streaming"]
+
+    def test_sync(_, aggregates, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "ENABLES_ASYNC_TRANSPORT", False
+        )
+
+        with StandInDifyServer(chunks=["HELLO ", "WORLD"]) as server:
+            pipe = _create_pipe(server)
+            opt = asyncio.run(pipe.pipe(BLOCKING_BODY, {}, {"chat_id": "c1"}))
+
+        print(opt)
+        assert opt == "HELLO WORLD"
+
+    def test_long_round(_, aggregates, monkeypatch):
+        # longer than REQUEST_TIMEOUT, yet never idle
+        monkeypatch.setattr(dify_open_webui_adapter, "REQUEST_TIMEOUT", 0.3)
+
+        with StandInDifyServer(chunks=list("ABCD"), event_delay=0.2) as server:
+            pipe = _create_pipe(server)
+            opt = asyncio.run(pipe.pipe(BLOCKING_BODY, {}, {"chat_id": "c1"}))
+
+        print(opt)
+        assert opt == "ABCD"
+
+    def test_disabled(_):
+        with StandInDifyServer(chunks=["HELLO ", "WORLD"]) as server:
+            pipe = _create_pipe(server)
+            opt = asyncio.run(pipe.pipe(BLOCKING_BODY, {}, {"chat_id": "c1"}))
+
+            response_modes = _response_modes(server)
+
+        print(opt, response_modes)
+        assert opt == "HELLO WORLD"
+        assert response_modes == ["blocking"]
@@ -0,0 +1,118 @@
+"""
+pipe_async_test.py
+
+Unit Tests (using pytest) for: Pipe.pipe() w/ async transport
+"""
+
+import asyncio
+import time
+
+from dify_open_webui_adapter import Pipe
+from tests import EXAMPLE_BODY1, EXAMPLE_CHATFLOW_CONFIG, collect_text
+from tests.stand_in_dify_server import StandInDifyServer
+
+
+def _create_pipe(server):
+    return Pipe(
+        app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+        base_url_override=server.base_url,
+    )
+
+
+class TestReply:
+
+    def test_streaming(_):
+        with StandInDifyServer(chunks=["HELLO ", "WORLD"]) as server:
+            pipe = _create_pipe(server)
+
+            async def run():
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "c1"})
+                return await collect_text(opt)
+
+            opt = asyncio.run(run())
+
+        print(opt)
+        assert opt == "HELLO WORLD"
+
+    def test_blocking(_):
+        body = EXAMPLE_BODY1.copy()
+        body["stream"] = False
+
+        with StandInDifyServer(chunks=["HELLO ", "WORLD"]) as server:
+            pipe = _create_pipe(server)
+            opt = asyncio.run(pipe.pipe(body, {}, {"chat_id": "c1"}))
+
+        print(opt)
+        assert opt == "HELLO WORLD"
+
+
+class TestConcurrency:
+
+    def test_concurrent_rounds(_):
+        n = 8
+        event_delay = 0.1
+
+        with StandInDifyServer(
+            chunks=["A", "B", "C"], event_delay=event_delay
+        ) as server:
+            pipe = _create_pipe(server)
+
+            async def run():
+                async def one_round(i):
+                    opt = await pipe.pipe(
+                        EXAMPLE_BODY1, {}, {"chat_id": "c{}".format(i)}
+                    )
+                    return await collect_text(opt)
+
+                return await asyncio.gather(*(one_round(i) for i in range(n)))
+
+            start = time.perf_counter()
+            opt = asyncio.run(run())
+            elapsed = time.perf_counter() - start
+
+        print(opt, elapsed)
+        assert opt == ["ABC"] * n
+        # serial rounds would take n * 3 * event_delay
+        assert elapsed < n * 3 * event_delay / 2
+
+
+class TestCoalescing:
+
+    def _stream(_, server, coalesce_max_chars, coalesce_max_delay):
+        config = dict(
+            EXAMPLE_CHATFLOW_CONFIG,
+            coalesce_max_chars=coalesce_max_chars,
+            coalesce_max_delay=coalesce_max_delay,
+        )
+        pipe = Pipe(
+            app_model_configs_override=[config],
+            base_url_override=server.base_url,
+        )
+
+        async def run():
+            start = time.perf_counter()
+            opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "c1"})
+            return [
+                (chunk, time.perf_counter() - start) async for chunk in opt
+            ]
+
+        return asyncio.run(run())
+
+    def test_max_chars(self):
+        with StandInDifyServer(chunks=list("ABCDEFG")) as server:
+            opt = self._stream(server, 3, 10)
+
+        print(opt)
+        assert [chunk for chunk, _ in opt] == ["A", "BCD", "EFG"]
+
+    def test_max_delay(self):
+        # Dify sends a chunk every 0.3s, merged text waits at most 0.1s
+        with StandInDifyServer(
+            chunks=["A", "B", "C"], event_delay=0.3
+        ) as server:
+            opt = self._stream(server, 100, 0.1)
+
+        print(opt)
+        assert [chunk for chunk, _ in opt] == ["A", "B", "C"]
+        # "B" arrives at 0.6s, flushed before "C" arrives at 0.9s
+        assert opt[1][1] < 0.85
@@ -4,6 +4,8 @@ pipe_fx_test.py
 Unit Tests (using pytest) for: Pipe.pipe()
 """
 
+import asyncio
+
 import pytest
 
 from tests import EXAMPLE_CONFIGS
@@ -27,7 +29,7 @@ class TestBadBody:  # bug fail bad body test
         }
 
         with pytest.raises(IndexError) as exec_info:
-            pipe.pipe(bad_body, {}, {})
+            asyncio.run(pipe.pipe(bad_body, {}, {}))
 
         opt = str(exec_info.value)
         print(opt)
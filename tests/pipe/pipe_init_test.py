@@ -4,10 +4,20 @@ pipe_init_test.py
 Unit Tests (using pytest) for: class Pipe initialization
 """
 
+import asyncio
+import time
+
 import pytest
 
-from dify_open_webui_adapter import Pipe
-from tests import EXAMPLE_CHATFLOW_CONFIG, EXAMPLE_CONFIGS
+import dify_open_webui_adapter
+from dify_open_webui_adapter import Pipe, WorkflowDifyApp
+from tests import (
+    EXAMPLE_BODY1,
+    EXAMPLE_CHATFLOW_CONFIG,
+    EXAMPLE_CONFIGS,
+    EXAMPLE_WORKFLOW_CONFIG,
+)
+from tests.stand_in_dify_server import StandInDifyServer
 
 
 def test_verify_app_model_config():
@@ -67,3 +77,63 @@ class TestContainers:  # test populating self.containers
         assert chatflow.key == "YIFpPns6"
         assert chatflow.model_id == "example-chatflow-model-2"
         assert chatflow.name == "Aux Example Chatflow Model/App"
+
+
+class TestStartupDiscovery:  # test GET /info probes at startup
+
+    def test_concurrent(_):
+        n = 8
+        info_delay = 0.2
+        configs = [
+            {"key": "key-{}".format(i), "model_id": "model-{}".format(i)}
+            for i in range(n)
+        ]
+
+        with StandInDifyServer(
+            mode="workflow", info_delay=info_delay
+        ) as server:
+            start = time.perf_counter()
+            pipe = Pipe(
+                app_model_configs_override=configs,
+                base_url_override=server.base_url,
+            )
+            elapsed = time.perf_counter() - start
+
+        print(elapsed)
+        assert list(pipe.model_containers) == [c["model_id"] for c in configs]
+        assert all(
+            isinstance(model.app, WorkflowDifyApp)
+            for model in pipe.model_containers.values()
+        )
+        assert all(
+            model.name == "Stand-in App"
+            for model in pipe.model_containers.values()
+        )
+        # serial probes would take n * info_delay
+        assert elapsed < n * info_delay / 2
+
+    def test_deferred(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "DEFERS_APP_TYPE_DISCOVERY", True
+        )
+
+        with StandInDifyServer(mode="workflow") as server:
+            pipe = Pipe(
+                app_model_configs_override=[EXAMPLE_WORKFLOW_CONFIG],
+                base_url_override=server.base_url,
+            )
+            model = pipe.model_containers["example-workflow-model"]
+            received_at_startup = list(server.received)
+            name_at_startup = model.name
+
+            body = EXAMPLE_BODY1.copy()
+            body["stream"] = False
+            body["model"] = "dify_open_webui_adapter.example-workflow-model"
+            opt = asyncio.run(pipe.pipe(body, {}, {}))
+
+        print(received_at_startup, server.received)
+        assert received_at_startup == []
+        assert name_at_startup == "example-workflow-model"
+        assert isinstance(model.app, WorkflowDifyApp)
+        assert model.name == "Stand-in App"
+        assert opt == "FIRST RESPONSE MESSAGESECOND RESPONSE MESSAGE"
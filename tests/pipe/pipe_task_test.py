@@ -0,0 +1,231 @@
+"""
+pipe_task_test.py
+
+Unit Tests (using pytest) for: Pipe.pipe() of OWU background tasks
+"""
+
+import asyncio
+import json
+import time
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import Pipe, _get_owu_task
+from tests import (
+    EXAMPLE_BODY1,
+    EXAMPLE_CHATFLOW_CONFIG,
+    EXAMPLE_CHATFLOW2_CONFIG,
+)
+from tests.stand_in_dify_server import StandInDifyServer
+
+TITLE_PROMPT = """### Task:
+Generate a concise, 3-5 word title summarizing the chat history.
+### Chat History:
+<chat_history>
+USER: How do I bake sourdough bread at home?
+ASSISTANT: Start with an active starter.
+</chat_history>"""
+
+TASK_BODY = {
+    "stream": False,
+    "model": "dify_open_webui_adapter.example-chatflow-model",
+    "messages": [{"role": "user", "content": TITLE_PROMPT}],
+}
+TASK_METADATA = {"chat_id": "c1", "task": "title_generation"}
+
+
+def _create_pipe(server, task_policy, *configs):
+    return Pipe(
+        app_model_configs_override=[
+            dict(EXAMPLE_CHATFLOW_CONFIG, task_policy=task_policy),
+            *configs,
+        ],
+        base_url_override=server.base_url,
+    )
+
+
+class TestGetOWUTask:
+
+    @pytest.mark.parametrize(
+        "body, metadata, expected",
+        [
+            ({}, {"task": "title_generation"}, "title_generation"),
+            ({"metadata": {"task": "tags_generation"}}, {}, "tags_generation"),
+            ({}, {"chat_id": "c1"}, None),
+            ({}, None, None),
+        ],
+    )
+    def test_task(_, body, metadata, expected):
+        opt = _get_owu_task(body, metadata)
+
+        print(opt)
+        assert opt == expected
+
+
+class TestPass:
+
+    def test_never_continues_conversation(_):
+        with StandInDifyServer(chunks=["REPLY"]) as server:
+            pipe = _create_pipe(server, "pass")
+
+            async def run():
+                user_round = dict(EXAMPLE_BODY1, stream=False)
+                await pipe.pipe(user_round, {}, {"chat_id": "c1"})
+                await pipe.pipe(TASK_BODY, {}, TASK_METADATA)
+                await pipe.pipe(user_round, {}, {"chat_id": "c1"})
+
+            asyncio.run(run())
+            conversation_ids = [p["conversation_id"] for p in server.posts()]
+            metrics = pipe.metrics()["task_rounds"]
+
+        print(conversation_ids, metrics)
+        assert conversation_ids == ["", "", "conv-1"]
+        assert metrics["title_generation"]["passed"] == 1
+
+
+class TestLocal:
+
+    def test_title(_):
+        with StandInDifyServer() as server:
+            pipe = _create_pipe(server, "local")
+            opt = asyncio.run(pipe.pipe(TASK_BODY, {}, TASK_METADATA))
+            posts = server.posts()
+            metrics = pipe.metrics()["task_rounds"]
+
+        print(opt, metrics)
+        assert json.loads(opt) == {"title": "How do I bake sourdough bread"}
+        assert posts == []
+        assert metrics["title_generation"]["local"] == 1
+
+    @pytest.mark.parametrize(
+        "task, expected",
+        [
+            ("tags_generation", {"tags": []}),
+            ("follow_up_generation", {"follow_ups": []}),
+            ("query_generation", {"queries": []}),
+        ],
+    )
+    def test_empty(_, task, expected):
+        with StandInDifyServer() as server:
+            pipe = _create_pipe(server, {task: "local"})
+            opt = asyncio.run(
+                pipe.pipe(TASK_BODY, {}, dict(TASK_METADATA, task=task))
+            )
+
+        print(opt)
+        assert json.loads(opt) == expected
+
+    def test_other_tasks_pass(_):
+        with StandInDifyServer(chunks=["REPLY"]) as server:
+            pipe = _create_pipe(server, {"tags_generation": "local"})
+            opt = asyncio.run(pipe.pipe(TASK_BODY, {}, TASK_METADATA))
+
+        print(opt)
+        assert opt == "REPLY"
+
+
+class TestRoute:
+
+    def test_route(_):
+        with StandInDifyServer() as server:
+            pipe = _create_pipe(
+                server,
+                "route:example-chatflow-model-2",
+                EXAMPLE_CHATFLOW2_CONFIG,
+            )
+            routed = []
+
+            async def reply_async(body, user, metadata):
+                routed.append(metadata)
+                return "ROUTED"
+
+            pipe.model_containers["example-chatflow-model-2"].reply_async = (
+                reply_async
+            )
+            opt = asyncio.run(pipe.pipe(TASK_BODY, {}, TASK_METADATA))
+            metrics = pipe.metrics()["task_rounds"]
+
+        print(opt, routed, metrics)
+        assert opt == "ROUTED"
+        assert routed == [TASK_METADATA]
+        assert metrics["title_generation"]["routed"] == 1
+
+    def test_unknown_model(_):
+        with pytest.raises(ValueError):
+            Pipe(
+                app_model_configs_override=[
+                    dict(EXAMPLE_CHATFLOW_CONFIG, task_policy="route:absent")
+                ],
+                disable_get_app_type_and_name=True,
+            )
+
+
+class TestCache:
+
+    def test_cache(_):
+        with StandInDifyServer(chunks=["REPLY"]) as server:
+            pipe = _create_pipe(server, "cache")
+
+            async def run():
+                return [
+                    await pipe.pipe(TASK_BODY, {}, TASK_METADATA)
+                    for _ in range(3)
+                ]
+
+            opt = asyncio.run(run())
+            posts = server.posts()
+            metrics = pipe.metrics()["task_rounds"]
+
+        print(opt, metrics)
+        assert opt == ["REPLY"] * 3
+        assert len(posts) == 1
+        assert metrics["title_generation"]["cached"] == 2
+
+
+class TestLowPriority:
+
+    def test_bounded(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "TASK_ROUNDS_MAX_CONCURRENCY", 1
+        )
+
+        with StandInDifyServer(chunks=["REPLY"], response_delay=0.2) as server:
+            pipe = _create_pipe(server, "low_priority")
+
+            async def run():
+                return await asyncio.gather(
+                    *(
+                        pipe.pipe(TASK_BODY, {}, TASK_METADATA)
+                        for _ in range(3)
+                    )
+                )
+
+            started_at = time.monotonic()
+            opt = asyncio.run(run())
+            elapsed = time.monotonic() - started_at
+
+        print(opt, elapsed)
+        assert opt == ["REPLY"] * 3
+        assert elapsed >= 0.55  # one after another
+
+
+class TestConfig:
+
+    @pytest.mark.parametrize(
+        "task_policy, err_type",
+        [
+            ("drop", ValueError),
+            ("route:", ValueError),
+            ({"title_generation": "drop"}, ValueError),
+            (["local"], TypeError),
+        ],
+    )
+    def test_invalid(_, task_policy, err_type):
+        with pytest.raises(err_type):
+            Pipe(
+                app_model_configs_override=[
+                    dict(EXAMPLE_CHATFLOW_CONFIG, task_policy=task_policy)
+                ],
+                disable_get_app_type_and_name=True,
+            )
@@ -0,0 +1,211 @@
+"""
+prefetched_round_test.py
+
+Unit Tests (using pytest) for: _PrefetchedConversationRound
+"""
+
+import asyncio
+import gc
+import threading
+import time
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import (
+    Pipe,
+    _PrefetchedConversationRound,
+    _streaming_round_counters,
+)
+
+from tests import EXAMPLE_BODY1, EXAMPLE_CHATFLOW_CONFIG, collect_text
+from tests.stand_in_dify_server import StandInDifyServer
+
+
+class _SimulatedRound:
+    """
+    stand-in of _ConversationRound counting pulled chunks; once exhausted,
+    hangs till closed if ``hangs``, or raises ``error`` if given
+    """
+
+    def __init__(self, chunks, hangs=False, error=None):
+        self.chunks = iter(chunks)
+        self.hangs = hangs
+        self.error = error
+        self.pulls = 0
+        self.is_closed = threading.Event()
+
+    def __next__(self):
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            if self.hangs:
+                self.is_closed.wait()
+                raise ValueError("closed") from None
+            if self.error:
+                raise self.error from None
+            raise
+        self.pulls += 1
+        return chunk
+
+    def close(self):
+        self.is_closed.set()
+
+
+def _wait_for(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class TestPrefetch:
+
+    def test_chunks(_):
+        prefetched = _PrefetchedConversationRound(
+            _SimulatedRound(["A", "B", "C"]), 2
+        )
+
+        opt = list(prefetched)
+
+        print(opt)
+        assert opt == ["A", "B", "C"]
+
+    def test_read_ahead(_):
+        conversation_round = _SimulatedRound(["A", "B", "C"])
+        _PrefetchedConversationRound(conversation_round, 8)
+
+        _wait_for(lambda: conversation_round.pulls == 3)
+
+        print(conversation_round.pulls)
+        assert conversation_round.pulls == 3  # w/o any pull by consumer
+
+    def test_backpressure(_):
+        conversation_round = _SimulatedRound(list("ABCDEFGH"))
+        prefetched = _PrefetchedConversationRound(conversation_round, 2)
+
+        time.sleep(0.2)
+        opt = conversation_round.pulls
+
+        print(opt)
+        # 2 buffered + 1 waiting for room
+        assert opt == 3
+        assert list(prefetched) == list("ABCDEFGH")
+
+    def test_error(_):
+        prefetched = _PrefetchedConversationRound(
+            _SimulatedRound(["A"], error=KeyError("answer")), 2
+        )
+
+        assert next(prefetched) == "A"
+        with pytest.raises(KeyError):
+            next(prefetched)
+        with pytest.raises(StopIteration):
+            next(prefetched)
+
+
+class TestClose:
+
+    def test_full_buffer(_):
+        conversation_round = _SimulatedRound(list("ABCDEFGH"))
+        prefetched = _PrefetchedConversationRound(conversation_round, 2)
+        _wait_for(lambda: conversation_round.pulls == 3)
+
+        prefetched.close()
+        prefetched._reader.join(timeout=2)
+
+        print(conversation_round.pulls)
+        assert not prefetched._reader.is_alive()
+        assert conversation_round.is_closed.is_set()
+        with pytest.raises(StopIteration):
+            next(prefetched)
+
+    def test_reading(_):
+        conversation_round = _SimulatedRound(["A"], hangs=True)
+        prefetched = _PrefetchedConversationRound(conversation_round, 2)
+        assert next(prefetched) == "A"
+
+        prefetched.close()
+        prefetched._reader.join(timeout=2)
+
+        assert not prefetched._reader.is_alive()
+
+
+class TestLeaked:
+
+    def test_ended_then_dropped(_):
+        before = _streaming_round_counters.snapshot()
+        prefetched = _PrefetchedConversationRound(
+            _SimulatedRound(["A", "B"]), 2
+        )
+        list(prefetched)  # fully read, never closed, as by OWU
+
+        del prefetched
+        gc.collect()
+
+        opt = _streaming_round_counters.snapshot()
+        print(opt)
+        assert opt["leaked"] == before["leaked"]
+
+    def test_failed_then_dropped(_):
+        before = _streaming_round_counters.snapshot()
+        prefetched = _PrefetchedConversationRound(
+            _SimulatedRound(["A"], error=KeyError("answer")), 2
+        )
+        try:
+            list(prefetched)
+        except KeyError as err:
+            err.__traceback__ = None  # its frames refer to the round
+
+        del prefetched
+        gc.collect()
+
+        opt = _streaming_round_counters.snapshot()
+        print(opt)
+        assert opt["leaked"] == before["leaked"]
+
+
+class TestPipe:
+
+    def test_streaming(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "STREAM_PREFETCH_MAX_CHUNKS", 4
+        )
+
+        with StandInDifyServer(chunks=["HELLO ", "WORLD"]) as server:
+            pipe = Pipe(
+                app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+                base_url_override=server.base_url,
+            )
+
+            async def run():
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "c1"})
+                return await collect_text(opt)
+
+            opt = asyncio.run(run())
+
+        print(opt)
+        assert opt == "HELLO WORLD"
+
+    def test_abandoned(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "STREAM_PREFETCH_MAX_CHUNKS", 1
+        )
+
+        with StandInDifyServer(chunks=list("ABCDEFGH")) as server:
+            pipe = Pipe(
+                app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+                base_url_override=server.base_url,
+            )
+
+            async def run():
+                opt = await pipe.pipe(EXAMPLE_BODY1, {}, {"chat_id": "c1"})
+                first = await opt.__anext__()
+                await opt.aclose()
+                return first, opt.conversation_round
+
+            first, prefetched = asyncio.run(run())
+            prefetched._reader.join(timeout=2)
+
+        print(first)
+        assert first == "A"
+        assert not prefetched._reader.is_alive()
@@ -0,0 +1,166 @@
+"""
+priority_lane_test.py
+
+Unit Tests (using pytest) for: priority lanes of _AdmissionGate
+"""
+
+import asyncio
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import (
+    Pipe,
+    _AdmissionGate,
+    _LatencyRecorder,
+    _classify_lane,
+)
+
+from tests import EXAMPLE_BODY1, EXAMPLE_CHATFLOW_CONFIG
+from tests.stand_in_dify_server import StandInDifyServer
+
+
+def _admit_in_order(gate, lanes, enqueue_delay=0.01):
+    """
+    :return: lanes of waiters in order admitted, while a slot is held
+    """
+    admitted = []
+
+    async def wait(lane):
+        assert await gate.acquire(lane)
+        admitted.append(lane)
+        gate.release()
+
+    async def run():
+        await gate.acquire()  # held
+        waiting = []
+        for lane in lanes:
+            waiting.append(asyncio.ensure_future(wait(lane)))
+            await asyncio.sleep(enqueue_delay)
+        gate.release()
+        await asyncio.gather(*waiting)
+
+    asyncio.run(run())
+    return admitted
+
+
+class TestClassifyLane:
+
+    @pytest.mark.parametrize(
+        "user, metadata, expected",
+        [
+            ({"id": "u1"}, {"chat_id": "c1"}, "interactive"),
+            ({"id": "u1"}, {}, "api"),
+            ({"id": "u1"}, None, "api"),
+            (
+                {"id": "u1"},
+                {"chat_id": "c1", "task": "title_generation"},
+                "background",
+            ),
+            ({"id": "bot", "email": "b@x"}, {"chat_id": "c1"}, "api"),
+        ],
+    )
+    def test_lane(_, monkeypatch, user, metadata, expected):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "AUTOMATION_USER_IDS", ("b@x",)
+        )
+
+        opt = _classify_lane(EXAMPLE_BODY1, user, metadata)
+
+        print(opt)
+        assert opt == expected
+
+
+class TestGate:
+
+    def test_priority(_):
+        gate = _AdmissionGate(max_inflight=1, max_queued=8, max_wait=5)
+
+        opt = _admit_in_order(
+            gate, ["background", "api", "interactive", "api"]
+        )
+
+        print(opt, gate.snapshot())
+        assert opt == ["interactive", "api", "api", "background"]
+        assert gate.snapshot()["aged"] == 0
+
+    def test_aging(_):
+        gate = _AdmissionGate(
+            max_inflight=1, max_queued=8, max_wait=5, aging_wait=0.1
+        )
+
+        opt = _admit_in_order(
+            gate, ["background", "interactive"], enqueue_delay=0.15
+        )
+
+        print(opt, gate.snapshot())
+        assert opt == ["background", "interactive"]
+        assert gate.snapshot()["aged"] == 1
+
+    def test_queue_depth_by_lane(_):
+        gate = _AdmissionGate(max_inflight=1, max_queued=8, max_wait=5)
+
+        async def run():
+            await gate.acquire()
+            waiting = asyncio.ensure_future(gate.acquire("api"))
+            await asyncio.sleep(0.01)
+            opt = gate.snapshot()
+            gate.release()
+            await waiting
+            gate.release()
+            return opt
+
+        opt = asyncio.run(run())
+
+        print(opt)
+        assert opt["queue_depth"] == 1
+        assert opt["queue_depth_by_lane"] == {
+            "interactive": 0,
+            "api": 1,
+            "background": 0,
+        }
+
+
+class TestLatencyRecorder:
+
+    def test_percentiles(_):
+        recorder = _LatencyRecorder(window=100)
+        for latency in range(200, 0, -1):  # only latest 100 kept
+            recorder.record(latency)
+
+        opt = recorder.snapshot()
+
+        print(opt)
+        assert opt == {"count": 200, "p50": 50, "p90": 90, "p99": 99}
+
+    def test_empty(_):
+        opt = _LatencyRecorder(window=100).snapshot()
+
+        print(opt)
+        assert opt == {"count": 0, "p50": None, "p90": None, "p99": None}
+
+
+class TestPipe:
+
+    def test_lane_latencies(_):
+        body = dict(EXAMPLE_BODY1, stream=False)
+
+        with StandInDifyServer(chunks=["OK"]) as server:
+            pipe = Pipe(
+                app_model_configs_override=[
+                    dict(EXAMPLE_CHATFLOW_CONFIG, task_policy="local")
+                ],
+                base_url_override=server.base_url,
+            )
+
+            async def run():
+                await pipe.pipe(body, {}, {"chat_id": "c1"})
+                await pipe.pipe(body, {}, {})
+                await pipe.pipe(body, {}, {"task": "tags_generation"})
+
+            asyncio.run(run())
+            opt = pipe.metrics()["lane_latencies"]
+
+        print(opt)
+        assert [opt[lane]["count"] for lane in opt] == [1, 1, 1]
+        assert opt["interactive"]["p50"] > 0
@@ -0,0 +1,367 @@
+"""
+shared_round_test.py
+
+Unit Tests (using pytest) for: _SharedRoundTable & _SharedRound
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from dify_open_webui_adapter import (
+    OWUModel,
+    DifyAppType,
+    Pipe,
+    _SharedRoundTable,
+)
+
+from tests import EXAMPLE_BASE_URL, EXAMPLE_WORKFLOW_CONFIG, collect_chunks
+from tests.stand_in_dify_server import StandInDifyServer
+
+SHARED_WORKFLOW_CONFIG = dict(
+    EXAMPLE_WORKFLOW_CONFIG, shares_inflight_rounds=True
+)
+
+
+class _FakeRound:
+    """
+    conversation round yielding chunks once released
+    """
+
+    def __init__(self, chunks, error=None):
+        self.chunks = list(chunks)
+        self.error = error
+        self.released = threading.Event()
+        self.is_closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.released.wait(5)
+        if self.is_closed:
+            raise ValueError("closed")
+        if self.chunks:
+            return self.chunks.pop(0)
+        if self.error is not None:
+            raise self.error
+        raise StopIteration
+
+    def close(self):
+        self.is_closed = True
+        self.released.set()
+
+
+def _create_body(content, stream=True):
+    return {
+        "stream": stream,
+        "model": "dify_open_webui_adapter.example-workflow-model",
+        "messages": [{"role": "user", "content": content}],
+    }
+
+
+def _run_concurrently(server, bodies, detaches=0):
+    pipe = Pipe(
+        app_model_configs_override=[SHARED_WORKFLOW_CONFIG],
+        base_url_override=server.base_url,
+    )
+
+    async def run_round(body, detaches):
+        opt = await pipe.pipe(body, {}, {})
+        if isinstance(opt, str):
+            return opt
+        if detaches:
+            chunk = await opt.__anext__()
+            await opt.aclose()
+            return [chunk]
+        return await collect_chunks(opt)
+
+    async def run():
+        return await asyncio.gather(
+            *(run_round(body, i < detaches) for i, body in enumerate(bodies))
+        )
+
+    return asyncio.run(run()), pipe.metrics()["shared_rounds"]
+
+
+class TestTable:
+
+    def test_leader_follower(_):
+        table = _SharedRoundTable()
+
+        leader, is_leader = table.join("k1")
+        follower, is_follower_leader = table.join("k1")
+        other, is_other_leader = table.join("k2")
+
+        print(table.snapshot())
+        assert is_leader and not is_follower_leader and is_other_leader
+        assert follower.shared_round is leader.shared_round
+        assert other.shared_round is not leader.shared_round
+        assert table.snapshot()["followers"] == 1
+        assert table.snapshot()["flights"] == 2
+
+    def test_max_subscribers(_):
+        table = _SharedRoundTable(max_subscribers=2)
+        subscribers = [table.join("k1"), table.join("k1")]  # kept joined
+
+        opt = table.join("k1")
+
+        print(opt, subscribers, table.snapshot())
+        assert opt == (None, False)
+        assert table.snapshot()["full"] == 1
+
+    def test_max_flights(_):
+        table = _SharedRoundTable(max_flights=1)
+        subscriber, _ = table.join("k1")  # kept joined
+
+        opt = table.join("k2")
+
+        print(opt, subscriber)
+        assert opt == (None, False)
+
+    def test_new_flight_once_ended(_):
+        table = _SharedRoundTable()
+        leader, _ = table.join("k1")
+        leader.shared_round.publish("A")
+        leader.shared_round.finish()
+
+        opt, is_leader = table.join("k1")
+
+        print(table.snapshot())
+        assert is_leader
+        assert opt.shared_round is not leader.shared_round
+        assert len(table) == 1
+
+
+class TestFanOut:
+
+    def test_all_subscribers(_):
+        table = _SharedRoundTable()
+        leader, _ = table.join("k1")
+        follower, _ = table.join("k1")
+        conversation_round = _FakeRound(["A", "B"])
+        leader.shared_round.start_pump(conversation_round)
+        conversation_round.released.set()
+
+        opt = list(leader), list(follower)
+
+        print(opt)
+        assert opt == (["A", "B"], ["A", "B"])
+        assert len(table) == 0
+
+    def test_late_subscriber_replays(_):
+        table = _SharedRoundTable()
+        leader, _ = table.join("k1")
+        leader.shared_round.publish("A")
+        late, _ = table.join("k1")
+        leader.shared_round.publish("B")
+        leader.shared_round.finish()
+
+        opt = list(late)
+
+        print(opt)
+        assert opt == ["A", "B"]
+
+    def test_error(_):
+        table = _SharedRoundTable()
+        leader, _ = table.join("k1")
+        follower, _ = table.join("k1")
+        conversation_round = _FakeRound(["A"], TimeoutError("stalls"))
+        leader.shared_round.start_pump(conversation_round)
+        conversation_round.released.set()
+
+        print(next(follower))
+        with pytest.raises(TimeoutError):
+            next(follower)
+
+
+class TestDetach:
+
+    def test_follower_never_kills_leader(_):
+        table = _SharedRoundTable()
+        leader, _ = table.join("k1")
+        follower, _ = table.join("k1")
+        conversation_round = _FakeRound(["A", "B"])
+        leader.shared_round.start_pump(conversation_round)
+
+        follower.close()
+        conversation_round.released.set()
+        opt = list(leader)
+
+        print(opt, table.snapshot())
+        assert opt == ["A", "B"]
+        assert table.snapshot()["detached"] == 1
+
+    def test_all_detached(_):
+        table = _SharedRoundTable()
+        leader, _ = table.join("k1")
+        follower, _ = table.join("k1")
+        conversation_round = _FakeRound(["A", "B"])
+        leader.shared_round.start_pump(conversation_round)
+
+        leader.close()
+        follower.close()
+
+        print(table.snapshot())
+        assert conversation_round.is_closed
+        assert len(table) == 0
+
+
+class TestConfig:
+
+    @pytest.mark.parametrize(
+        "config, expected",
+        [(EXAMPLE_WORKFLOW_CONFIG, False), (SHARED_WORKFLOW_CONFIG, True)],
+    )
+    def test_opt_in(_, config, expected):
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            config,
+            disable_get_app_type_and_name=True,
+            app_type_override=DifyAppType.WORKFLOW,
+        )
+
+        opt = model.app
+
+        print(opt.input_fields)
+        assert (opt.shared_rounds is not None) == expected
+        assert "shares_inflight_rounds" not in opt.input_fields
+
+    def test_invalid(_):
+        with pytest.raises(TypeError):
+            OWUModel(
+                EXAMPLE_BASE_URL,
+                dict(EXAMPLE_WORKFLOW_CONFIG, shares_inflight_rounds=1),
+                disable_get_app_type_and_name=True,
+                app_type_override=DifyAppType.WORKFLOW,
+            )
+
+    def test_invalid_once_loaded(_):
+        # reported by config, even if the app is created at 1st round
+        with pytest.raises(TypeError):
+            OWUModel(
+                EXAMPLE_BASE_URL,
+                dict(EXAMPLE_WORKFLOW_CONFIG, shares_inflight_rounds=1),
+                defer_get_app_type_and_name=True,
+            )
+
+
+class TestPipe:
+
+    def test_streaming(_):
+        with StandInDifyServer(
+            mode="workflow", chunks=["A", "B", "C"], event_delay=0.1
+        ) as server:
+            opt, metrics = _run_concurrently(
+                server, [_create_body("LOOK UP")] * 5
+            )
+            posts = len(server.posts())
+
+        print(opt, metrics)
+        assert opt == [["A", "B", "C"]] * 5
+        assert posts == 1
+        assert metrics["example-workflow-model"]["followers"] == 4
+
+    def test_blocking(_):
+        with StandInDifyServer(
+            mode="workflow", chunks=["A", "B"], response_delay=0.3
+        ) as server:
+            opt, metrics = _run_concurrently(
+                server, [_create_body("LOOK UP", False)] * 3
+            )
+            posts = len(server.posts())
+
+        print(opt, metrics)
+        assert opt == ["AB"] * 3
+        assert posts == 1
+
+    def test_different_queries(_):
+        with StandInDifyServer(
+            mode="workflow", chunks=["A", "B"], event_delay=0.1
+        ) as server:
+            opt, _metrics = _run_concurrently(
+                server, [_create_body("LOOK UP"), _create_body("DOWN")]
+            )
+            posts = len(server.posts())
+
+        print(opt)
+        assert posts == 2
+
+    def test_detached_subscriber(_):
+        with StandInDifyServer(
+            mode="workflow", chunks=["A", "B", "C"], event_delay=0.1
+        ) as server:
+            opt, metrics = _run_concurrently(
+                server, [_create_body("LOOK UP")] * 3, detaches=1
+            )
+            aborted = server.aborted
+
+        print(opt, metrics)
+        assert opt == [["A"], ["A", "B", "C"], ["A", "B", "C"]]
+        assert aborted == 0
+        assert metrics["example-workflow-model"]["detached"] == 1
+
+    def test_all_detached(_):
+        with StandInDifyServer(
+            mode="workflow", chunks=["A", "B", "C", "D"], event_delay=0.2
+        ) as server:
+            opt, _metrics = _run_concurrently(
+                server, [_create_body("LOOK UP")] * 2, detaches=2
+            )
+            deadline = time.monotonic() + 3
+            while not server.aborted and time.monotonic() < deadline:
+                time.sleep(0.05)
+            aborted = server.aborted
+
+        print(opt)
+        assert opt == [["A"], ["A"]]
+        assert aborted == 1
+
+
+class TestTransportThreads:
+    """
+    identical rounds, more than transport threads, wait for their leader
+    w/o holding transport threads, such that other rounds are still served
+    """
+
+    @pytest.mark.parametrize("stream", [True, False])
+    def test_other_round_served(_, small_transport_pool, stream):
+        with StandInDifyServer(
+            mode="workflow",
+            chunks=["A", "B"],
+            response_delay=0.5,
+            event_delay=0.1,
+        ) as server:
+            pipe = Pipe(
+                app_model_configs_override=[SHARED_WORKFLOW_CONFIG],
+                base_url_override=server.base_url,
+            )
+
+            async def run_round(body):
+                started_at = time.monotonic()
+                opt = await collect_chunks(await pipe.pipe(body, {}, {}))
+                return opt, time.monotonic() - started_at
+
+            async def run():
+                identical = [
+                    asyncio.ensure_future(
+                        run_round(_create_body("LOOK UP", stream))
+                    )
+                    for _i in range(small_transport_pool * 4)
+                ]
+                await asyncio.sleep(0.1)  # all identical rounds wait
+                other = await run_round(_create_body("DOWN", stream))
+                return await asyncio.gather(*identical), other
+
+            identical, other = asyncio.run(run())
+            posts = len(server.posts())
+
+        print(identical, other, posts)
+        expected = ["A", "B"] if stream else "AB"
+        assert all(opt == expected for opt, _ in identical)
+        assert other[0] == expected
+        # requested at once, not after the identical rounds
+        assert other[1] < 0.9
+        assert posts == 2
@@ -0,0 +1,276 @@
+"""
+sqlite_conversation_store_test.py
+
+Unit Tests (using pytest) for: _SQLiteConversationIdStore
+"""
+
+import gc
+import time
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import (
+    OWUModel,
+    DifyAppType,
+    _SQLiteConversationDatabase,
+    _SQLiteConversationIdStore,
+)
+
+from tests import EXAMPLE_BASE_URL, EXAMPLE_CHATFLOW_CONFIG
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    return str(tmp_path / "conversations.sqlite3")
+
+
+def _create_database(path):
+    # flush only when asked
+    return _SQLiteConversationDatabase(path, flush_interval=3600)
+
+
+class TestWriteBehind:
+
+    def test_pending_until_flush(_, database_path):
+        database = _create_database(database_path)
+        store = _SQLiteConversationIdStore(database, "app")
+        store["chat-1"] = "conv-1"
+
+        opt_before = database.snapshot()
+        database.flush()
+        opt_after = database.snapshot()
+        database.close()
+
+        print(opt_before, opt_after)
+        assert opt_before["pending_writes"] == 1
+        assert opt_before["db_writes"] == 0
+        assert opt_after["pending_writes"] == 0
+        assert opt_after["db_writes"] == 1
+        assert opt_after["flushes"] == 1
+
+    def test_batched(_, database_path):
+        database = _create_database(database_path)
+        store = _SQLiteConversationIdStore(database, "app")
+        for i in range(100):
+            store["chat-{}".format(i)] = "conv-{}".format(i)
+
+        database.flush()
+        opt = database.snapshot()
+        database.close()
+
+        print(opt)
+        assert opt["db_writes"] == 100
+        assert opt["flushes"] == 1
+
+
+class TestSharedAcrossWorkers:
+
+    def test_another_worker(_, database_path):
+        database1 = _create_database(database_path)
+        database2 = _create_database(database_path)  # as another worker
+        store1 = _SQLiteConversationIdStore(database1, "app")
+        store2 = _SQLiteConversationIdStore(database2, "app")
+
+        store1["chat-1"] = "conv-1"
+        database1.flush()
+
+        opt = store2.get("chat-1")
+        database1.close()
+        database2.close()
+
+        print(opt)
+        assert opt == "conv-1"
+
+    def test_restart(_, database_path):
+        database = _create_database(database_path)
+        _SQLiteConversationIdStore(database, "app")["chat-1"] = "conv-1"
+        database.close()  # flush on close
+
+        database = _create_database(database_path)
+        opt = _SQLiteConversationIdStore(database, "app").get("chat-1")
+        database.close()
+
+        print(opt)
+        assert opt == "conv-1"
+
+    def test_namespace(_, database_path):
+        database = _create_database(database_path)
+        _SQLiteConversationIdStore(database, "app1")["chat-1"] = "conv-1"
+        database.flush()
+
+        opt = _SQLiteConversationIdStore(database, "app2").get("chat-1")
+        database.close()
+
+        print(opt)
+        assert opt is None
+
+    def test_read_cache(_, database_path):
+        database = _create_database(database_path)
+        store = _SQLiteConversationIdStore(database, "app")
+        store["chat-1"] = "conv-1"
+        database.flush()
+
+        for _ in range(10):
+            store.get("chat-1")
+        opt = database.snapshot()
+        database.close()
+
+        print(opt)
+        assert opt["db_reads"] == 0
+        assert opt["pending_writes"] == 0  # hits never rewrite fresh rows
+
+    def test_db_hits(_, database_path):
+        database = _create_database(database_path)
+        _SQLiteConversationIdStore(database, "app")["chat-1"] = "conv-1"
+        database.flush()
+        store = _SQLiteConversationIdStore(database, "app")  # as restarted
+
+        opt = [store.get("chat-1"), store.get("chat-1"), store.get("chat-2")]
+        database.close()
+
+        print(opt, store.snapshot())
+        assert opt == ["conv-1", "conv-1", None]
+        assert store.snapshot()["db_hits"] == 1
+        assert store.snapshot()["hits"] == 1
+        assert store.snapshot()["misses"] == 1
+
+
+class TestRefresh:
+
+    def test_stale_row_rewritten(_, database_path):
+        database = _create_database(database_path)
+        # rewritten once older than 0.1 x idle_ttl, i.e. 0.1 seconds
+        store = _SQLiteConversationIdStore(database, "app", idle_ttl=1)
+        store["chat-1"] = "conv-1"
+        database.flush()
+
+        store.get("chat-1")
+        fresh = database.snapshot()["pending_writes"]
+        time.sleep(0.15)
+        store.get("chat-1")
+        store.get("chat-1")
+        opt = database.snapshot()["pending_writes"]
+        database.close()
+
+        print(fresh, opt)
+        assert fresh == 0
+        assert opt == 1
+
+    def test_pruned_by_idle_ttl(_, database_path, monkeypatch):
+        monkeypatch.setattr(
+            _SQLiteConversationDatabase, "_PRUNE_EVERY_FLUSHES", 1
+        )
+        database = _SQLiteConversationDatabase(
+            database_path, flush_interval=0.01, idle_ttl=0.05
+        )
+        store = _SQLiteConversationIdStore(database, "app")
+        store["chat-1"] = "conv-1"
+
+        time.sleep(0.3)  # flushed, then pruned
+        opt = database.select("app", "chat-1", 3600)
+        database.close()
+
+        print(opt)
+        assert store.idle_ttl == 0.05
+        assert opt is None
+
+
+class TestReload:
+
+    def test_dropped_then_closed(_, database_path, monkeypatch):
+        # as by a reload of the function in OWU, dropping former stores
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "CONVERSATION_STORE_BACKEND", "sqlite"
+        )
+        monkeypatch.setattr(
+            dify_open_webui_adapter,
+            "CONVERSATION_STORE_SQLITE_PATH",
+            database_path,
+        )
+        store = dify_open_webui_adapter._create_conversation_id_store(
+            EXAMPLE_BASE_URL, "key"
+        )
+        store["chat-1"] = "conv-1"
+        flush_thread = store.database._flush_thread
+
+        del store
+        gc.collect()
+        flush_thread.join(timeout=2)
+
+        database = _create_database(database_path)
+        opt = _SQLiteConversationIdStore(
+            database,
+            dify_open_webui_adapter._hash_app_key(EXAMPLE_BASE_URL, "key"),
+        ).get("chat-1")
+        database.close()
+
+        print(opt)
+        assert not flush_thread.is_alive()
+        assert database_path not in (
+            dify_open_webui_adapter._sqlite_conversation_databases
+        )
+        assert opt == "conv-1"  # flushed once closed
+
+    def test_shared_by_path(_, database_path, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "CONVERSATION_STORE_BACKEND", "sqlite"
+        )
+        monkeypatch.setattr(
+            dify_open_webui_adapter,
+            "CONVERSATION_STORE_SQLITE_PATH",
+            database_path,
+        )
+
+        stores = [
+            dify_open_webui_adapter._create_conversation_id_store(
+                EXAMPLE_BASE_URL, key
+            )
+            for key in ("key1", "key2")
+        ]
+
+        print(stores)
+        assert stores[0].database is stores[1].database
+        stores[0].database.close()
+
+
+class TestBackend:
+
+    def test_chatflow(_, database_path, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "CONVERSATION_STORE_BACKEND", "sqlite"
+        )
+        monkeypatch.setattr(
+            dify_open_webui_adapter,
+            "CONVERSATION_STORE_SQLITE_PATH",
+            database_path,
+        )
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            EXAMPLE_CHATFLOW_CONFIG,
+            disable_get_app_type_and_name=True,
+            app_type_override=DifyAppType.CHATFLOW,
+        )
+
+        opt = model.app.chat2conversation_ids
+
+        print(opt)
+        assert isinstance(opt, _SQLiteConversationIdStore)
+        opt.database.close()
+
+    def test_unknown(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "CONVERSATION_STORE_BACKEND", "redis"
+        )
+
+        with pytest.raises(ValueError) as exec_info:
+            OWUModel(
+                EXAMPLE_BASE_URL,
+                EXAMPLE_CHATFLOW_CONFIG,
+                disable_get_app_type_and_name=True,
+                app_type_override=DifyAppType.CHATFLOW,
+            )
+
+        opt = str(exec_info.value)
+        print(opt)
+        assert opt == "unknown CONVERSATION_STORE_BACKEND: redis"
@@ -0,0 +1,102 @@
+"""
+sse_parser_test.py
+
+Unit Tests (using pytest) for: _SSEParser
+"""
+
+import pytest
+
+from dify_open_webui_adapter import _SSEParser
+
+STREAM = (
+    b": comment\n"
+    b"data: first\n"
+    b"\n"
+    b"event: ping\n"
+    b"\n"
+    b"event: ping\n"
+    b"data:\n"
+    b"\n"
+    b"id: 42\n"
+    b"data: multi\n"
+    b"data:line\n"
+    b"\n"
+)
+
+EVENTS = [
+    (b"message", b"first"),
+    (b"ping", b""),
+    (b"message", b"multi\nline"),
+]
+
+
+def _feed_all(parser, chunks):
+    opt = []
+    for chunk in chunks:
+        opt.extend(parser.feed(chunk))
+    return opt
+
+
+class TestFields:
+
+    def test1(_):
+        parser = _SSEParser()
+
+        opt = parser.feed(STREAM)
+
+        print(opt)
+        assert opt == EVENTS
+        assert parser.last_event_id == b"42"
+
+    def test_no_dispatch_wo_blank_line(_):
+        parser = _SSEParser()
+
+        opt = parser.feed(b"data: incomplete\n")
+
+        print(opt)
+        assert opt == []
+
+    def test_no_dispatch_wo_data(_):  # e.g. Dify's ping
+        parser = _SSEParser()
+
+        opt = parser.feed(b"event: ping\n\n")
+
+        print(opt)
+        assert opt == []
+
+
+class TestLineEnding:
+
+    @pytest.mark.parametrize("ending", [b"\r\n", b"\r"])
+    def test_crlf_cr(_, ending):
+        parser = _SSEParser()
+
+        opt = parser.feed(STREAM.replace(b"\n", ending))
+
+        print(opt)
+        assert opt == EVENTS
+
+    @pytest.mark.parametrize("ending", [b"\n", b"\r\n", b"\r"])
+    def test_split_everywhere(_, ending):
+        stream = STREAM.replace(b"\n", ending)
+        parser = _SSEParser()
+
+        opt = _feed_all(
+            parser, (stream[i : i + 1] for i in range(len(stream)))
+        )
+
+        print(opt)
+        assert opt == EVENTS
+
+
+class TestUnknownField:
+
+    def test_ignored_undecoded(_):
+        parser = _SSEParser()
+
+        opt = parser.feed(
+            "data: x\n".encode("utf_16") + b"\nfoo: \xff\ndata: y\n\n"
+        )
+
+        print(opt)
+        assert opt == [(b"message", b"y")]
@@ -0,0 +1,256 @@
+"""
+provide a local stand-in of Dify Backend API for tests & benchmarks
+which need a real socket, e.g.::
+
+    with StandInDifyServer(chunks=["HELLO", "WORLD"]) as server:
+        pipe = Pipe(base_url_override=server.base_url, ...)
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandInDifyServer:
+    """
+    serve ``GET /info``, ``POST /chat-messages`` & ``POST /workflows/run``
+    in both blocking & streaming mode, with canned replies
+
+
+    :param mode: App type responded by ``/info``
+    :type mode: str
+    :param chunks: text chunks of every reply
+    :type chunks: list(str)
+    :param info_delay: seconds slept before responding ``/info``
+    :type info_delay: float
+    :param response_delay: seconds slept before responding headers
+    :type response_delay: float
+    :param event_delay: seconds slept before each streamed event
+    :type event_delay: float
+    :param ping_interval: seconds between ``event: ping`` sent while
+            sleeping ``event_delay``, as Dify does; None to never ping
+    :type ping_interval: float
+    :param capacity: replies served at once w/o slowing down; beyond it,
+            ``response_delay`` is scaled by replies in flight / capacity,
+            as a saturated Dify does; None for unlimited
+    :type capacity: int
+    """
+
+    def __init__(
+        self,
+        mode="advanced-chat",
+        name="Stand-in App",
+        chunks=("FIRST RESPONSE MESSAGE", "SECOND RESPONSE MESSAGE"),
+        info_delay=0.0,
+        response_delay=0.0,
+        event_delay=0.0,
+        ping_interval=None,
+        capacity=None,
+    ):
+        self.mode = mode
+        self.name = name
+        self.chunks = list(chunks)
+        self.info_delay = info_delay
+        self.response_delay = response_delay
+        self.event_delay = event_delay
+        self.ping_interval = ping_interval
+        self.capacity = capacity
+
+        self.received = []  # (method, path, payload) of every request
+        self.conversations = 0  # number of created conversations
+        self.aborted = 0  # number of streams disconnected by the client
+        self.active = 0  # replies in flight
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.stand_in = self
+        self._thread = None
+
+    @property
+    def base_url(self):  # pylint: disable=missing-function-docstring
+        return "http://127.0.0.1:{}/v1".format(self._httpd.server_port)
+
+    def start(self):  # pylint: disable=missing-function-docstring
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):  # pylint: disable=missing-function-docstring
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def record(self, method, path, payload):
+        with self._lock:
+            self.received.append((method, path, payload))
+
+    def posts(self):
+        """
+        :return: payloads of received POST requests, in order
+        :rtype: list(dict)
+        """
+        with self._lock:
+            return [
+                payload
+                for method, _, payload in self.received
+                if method == "POST"
+            ]
+
+    def record_abort(self):
+        with self._lock:
+            self.aborted += 1
+
+    def enter_reply(self):
+        """
+        :return: seconds to sleep before responding headers
+        """
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            if self.capacity is None:
+                return self.response_delay
+            return self.response_delay * max(1, self.active / self.capacity)
+
+    def exit_reply(self):
+        with self._lock:
+            self.active -= 1
+
+    def create_conversation_id(self):
+        with self._lock:
+            self.conversations += 1
+            return "conv-{}".format(self.conversations)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, *_):  # silence
+        pass
+
+    @property
+    def stand_in(self):
+        return self.server.stand_in
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.stand_in.record("GET", self.path, None)
+
+        if self.path.endswith("/info"):
+            time.sleep(self.stand_in.info_delay)
+            self._send_json(
+                {"mode": self.stand_in.mode, "name": self.stand_in.name}
+            )
+        else:
+            self._send_json({"message": "not found"}, 404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        self.stand_in.record("POST", self.path, payload)
+
+        if self.path.endswith("/stop"):
+            self._send_json({"result": "success"})
+            return
+
+        try:
+            time.sleep(self.stand_in.enter_reply())
+            self._reply(payload)
+        finally:
+            self.stand_in.exit_reply()
+
+    def _reply(self, payload):
+        is_chatflow = self.path.endswith("/chat-messages")
+        conversation_id = payload.get("conversation_id")
+        if is_chatflow and not conversation_id:
+            conversation_id = self.stand_in.create_conversation_id()
+
+        if payload.get("response_mode") != "streaming":
+            text = "".join(self.stand_in.chunks)
+            if is_chatflow:
+                reply = {"answer": text, "conversation_id": conversation_id}
+            else:
+                reply = {"data": {"outputs": {"answer": text}}}
+            self._send_json(reply)
+            return
+
+        # streaming, by chunked transfer encoding  -----------------------------
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        try:
+            for text in self.stand_in.chunks:
+                self._sleep_pinging(self.stand_in.event_delay)
+                if is_chatflow:
+                    event = {
+                        "event": "message",
+                        "task_id": "task-stand-in",
+                        "conversation_id": conversation_id,
+                        "answer": text,
+                    }
+                else:
+                    event = {
+                        "event": "text_chunk",
+                        "task_id": "task-stand-in",
+                        "data": {"text": text},
+                    }
+                self._send_chunk(event)
+
+            self._send_chunk(
+                {
+                    "event": (
+                        "message_end" if is_chatflow else "workflow_finished"
+                    ),
+                    "task_id": "task-stand-in",
+                    "conversation_id": conversation_id,
+                    "data": (
+                        {}
+                        if is_chatflow
+                        else {
+                            "outputs": {
+                                "answer": "".join(self.stand_in.chunks)
+                            }
+                        }
+                    ),
+                }
+            )
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        except (BrokenPipeError, ConnectionResetError):
+            self.stand_in.record_abort()
+            self.close_connection = True
+
+    def _sleep_pinging(self, delay):
+        interval = self.stand_in.ping_interval
+        while interval and delay > interval:
+            time.sleep(interval)
+            delay -= interval
+            self._send_raw(b"event: ping\n\n")
+        time.sleep(delay)
+
+    def _send_chunk(self, event):
+        self._send_raw(
+            "data: {}\n\n".format(json.dumps(event)).encode("utf-8")
+        )
+
+    def _send_raw(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send_json(self, obj, status=200):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,163 @@
+"""
+stop_task_test.py
+
+Unit Tests (using pytest) for: stopping Dify task of abandoned
+_ConversationRound
+"""
+
+import time
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import (
+    Pipe,
+    _ConversationRound,
+    _streaming_round_counters,
+)
+
+from tests import (
+    EXAMPLE_BODY1,
+    EXAMPLE_CHATFLOW_CONFIG,
+    EXAMPLE_WORKFLOW_CONFIG,
+)
+from tests.stand_in_dify_server import StandInDifyServer
+from .conversation_round_test import _create_simulated_app
+from .testee_conversation_round import convert_bytes_generator_from_lines
+
+CHUNKS = list("ABCDEFGHIJ")
+
+
+def _wait_for(predicate, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def _stop_requests(server):
+    return [
+        (path, payload)
+        for method, path, payload in server.received
+        if method == "POST" and path.endswith("/stop")
+    ]
+
+
+def _abandon(server, config, chat_id="c1"):
+    pipe = Pipe(
+        app_model_configs_override=[config],
+        base_url_override=server.base_url,
+    )
+    body = dict(
+        EXAMPLE_BODY1,
+        model="dify_open_webui_adapter.{}".format(config["model_id"]),
+    )
+    model = pipe.model_containers[config["model_id"]]
+
+    conversation_round = model.reply(body, {}, {"chat_id": chat_id})
+    first = next(conversation_round)
+    conversation_round.close()
+    return first
+
+
+class TestStop:
+
+    def test_chatflow(_):
+        with StandInDifyServer(chunks=CHUNKS, event_delay=0.05) as server:
+            _abandon(server, EXAMPLE_CHATFLOW_CONFIG)
+
+            assert _wait_for(lambda: _stop_requests(server))
+            opt = _stop_requests(server)
+
+        print(opt)
+        assert opt == [
+            ("/v1/chat-messages/task-stand-in/stop", {"user": "user"})
+        ]
+
+    def test_workflow(_):
+        with StandInDifyServer(
+            mode="workflow", chunks=CHUNKS, event_delay=0.05
+        ) as server:
+            _abandon(server, EXAMPLE_WORKFLOW_CONFIG)
+
+            assert _wait_for(lambda: _stop_requests(server))
+            opt = _stop_requests(server)
+
+        print(opt)
+        assert opt == [
+            ("/v1/workflows/tasks/task-stand-in/stop", {"user": "user"})
+        ]
+
+    def test_ended(_):
+        with StandInDifyServer(chunks=["A", "B"]) as server:
+            pipe = Pipe(
+                app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+                base_url_override=server.base_url,
+            )
+            model = pipe.model_containers[EXAMPLE_CHATFLOW_CONFIG["model_id"]]
+            conversation_round = model.reply(
+                EXAMPLE_BODY1, {}, {"chat_id": "c1"}
+            )
+            list(conversation_round)
+            conversation_round.close()
+            time.sleep(0.1)
+
+            opt = _stop_requests(server)
+
+        print(opt)
+        assert opt == []
+
+    def test_disabled(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "STOPS_ABANDONED_TASKS", False
+        )
+
+        with StandInDifyServer(chunks=CHUNKS, event_delay=0.05) as server:
+            _abandon(server, EXAMPLE_CHATFLOW_CONFIG)
+            time.sleep(0.2)
+
+            opt = _stop_requests(server)
+
+        print(opt)
+        assert opt == []
+
+    def test_failure(_):
+        before = _streaming_round_counters.snapshot()
+
+        with StandInDifyServer(chunks=CHUNKS, event_delay=0.05) as server:
+            pipe = Pipe(
+                app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+                base_url_override=server.base_url,
+            )
+            model = pipe.model_containers[EXAMPLE_CHATFLOW_CONFIG["model_id"]]
+            conversation_round = model.reply(
+                EXAMPLE_BODY1, {}, {"chat_id": "c1"}
+            )
+            next(conversation_round)
+
+        # Dify is gone before the round is abandoned
+        conversation_round.close()
+
+        assert _wait_for(
+            lambda: _streaming_round_counters["stop_failures"]
+            > before["stop_failures"]
+        )
+
+
+class TestTaskId:
+
+    def test_skipped_event(_):
+        # task_id of an irrelevant event, e.g. node_started
+        lines = [
+            'data: {"event": "node_started", "task_id": "04db", '
+            '"data": {"inputs": "' + "x" * 1000 + '"}}',
+            'data: {"event": "text_chunk", "data": {"text": "A"}}',
+        ]
+        conversation_round = _ConversationRound(
+            _create_simulated_app(convert_bytes_generator_from_lines(lines)),
+            None,
+        )
+
+        next(conversation_round)
+
+        opt = conversation_round.context.task_id
+        print(opt)
+        assert opt == "04db"
@@ -0,0 +1,132 @@
+"""
+stream_timeout_test.py
+
+Unit Tests (using pytest) for: STREAM_IDLE_TIMEOUT & STREAM_TOTAL_DEADLINE
+of _ConversationRound
+"""
+
+import time
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import (
+    Pipe,
+    _ConversationRound,
+    _streaming_round_counters,
+)
+
+from tests import EXAMPLE_BODY1, EXAMPLE_CHATFLOW_CONFIG
+from tests.stand_in_dify_server import StandInDifyServer
+
+
+def _reply(server):
+    pipe = Pipe(
+        app_model_configs_override=[EXAMPLE_CHATFLOW_CONFIG],
+        base_url_override=server.base_url,
+    )
+    model = pipe.model_containers[EXAMPLE_CHATFLOW_CONFIG["model_id"]]
+    return model.reply(EXAMPLE_BODY1, {}, {"chat_id": "c1"})
+
+
+def _create_trickling_app(chunks, delay):
+    def iter_content(_, chunk_size=None):
+        for chunk in chunks:
+            time.sleep(delay)
+            yield chunk
+
+    sim_response = type(
+        "simulated response",
+        (),
+        {"iter_content": iter_content, "close": lambda self: None},
+    )()
+    return type(
+        "simulated app",
+        (),
+        {"_open_reply_response": lambda _a, _b: sim_response},
+    )
+
+
+class TestIdleTimeout:
+
+    def test_stalled(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "STREAM_IDLE_TIMEOUT", 0.3
+        )
+        before = _streaming_round_counters.snapshot()
+
+        with StandInDifyServer(chunks=["A", "B"], event_delay=2) as server:
+            start = time.perf_counter()
+            with pytest.raises(TimeoutError) as exec_info:
+                list(_reply(server))
+            elapsed = time.perf_counter() - start
+
+        opt = str(exec_info.value)
+        print(opt, elapsed)
+        assert opt == "text/event-stream stalls, no events for 0.3s"
+        assert elapsed < 1.5  # fail fast, w/o waiting for the event
+        assert _streaming_round_counters["idle_timeouts"] == (
+            before["idle_timeouts"] + 1
+        )
+
+    def test_ping_is_liveness(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "STREAM_IDLE_TIMEOUT", 0.3
+        )
+
+        with StandInDifyServer(
+            chunks=["A", "B"], event_delay=0.6, ping_interval=0.1
+        ) as server:
+            opt = list(_reply(server))
+
+        print(opt)
+        assert opt == ["A", "B"]
+
+    def test_trickling(_, monkeypatch):
+        # bytes of an event w/o ever completing it
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "STREAM_IDLE_TIMEOUT", 0.2
+        )
+        app = _create_trickling_app([b"data: {"] + [b" "] * 100, 0.05)
+
+        with pytest.raises(TimeoutError):
+            list(_ConversationRound(app, None))
+
+
+class TestDeadline:
+
+    def test_exceed(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "STREAM_TOTAL_DEADLINE", 0.5
+        )
+        before = _streaming_round_counters.snapshot()
+
+        with StandInDifyServer(
+            chunks=list("ABCDEFGHIJ"), event_delay=0.1
+        ) as server:
+            opt = []
+            with pytest.raises(TimeoutError) as exec_info:
+                for chunk in _reply(server):
+                    opt.append(chunk)
+
+        print(opt, exec_info.value)
+        assert 0 < len(opt) < 10
+        assert str(exec_info.value) == "round exceeds deadline of 0.5s"
+        assert _streaming_round_counters["deadline_timeouts"] == (
+            before["deadline_timeouts"] + 1
+        )
+
+    def test_disabled(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "STREAM_TOTAL_DEADLINE", None
+        )
+        app = _create_trickling_app(
+            [b'data: {"event": "text_chunk", "data": {"text": "A"}}\n\n']
+            + [b'data: {"event": "workflow_finished", "data": {}}\n\n'],
+            0.01,
+        )
+
+        opt = list(_ConversationRound(app, None))
+
+        print(opt)
+        assert opt == ["A"]
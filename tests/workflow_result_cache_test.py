@@ -0,0 +1,266 @@
+"""
+workflow_result_cache_test.py
+
+Unit Tests (using pytest) for: _WorkflowResultCache
+"""
+
+import asyncio
+
+import pytest
+
+import dify_open_webui_adapter
+from dify_open_webui_adapter import (
+    OWUModel,
+    DifyAppType,
+    Pipe,
+    _WorkflowResultCache,
+)
+
+from tests import EXAMPLE_BASE_URL, EXAMPLE_WORKFLOW_CONFIG, collect_chunks
+from tests.stand_in_dify_server import StandInDifyServer
+
+CACHED_WORKFLOW_CONFIG = dict(EXAMPLE_WORKFLOW_CONFIG, result_cache_ttl=60)
+
+
+def _create_body(content, stream=True):
+    return {
+        "stream": stream,
+        "model": "dify_open_webui_adapter.example-workflow-model",
+        "messages": [{"role": "user", "content": content}],
+    }
+
+
+def _run_rounds(server, bodies, config=CACHED_WORKFLOW_CONFIG):
+    pipe = Pipe(
+        app_model_configs_override=[config],
+        base_url_override=server.base_url,
+    )
+
+    async def run():
+        return [
+            await collect_chunks(await pipe.pipe(body, {}, {}))
+            for body in bodies
+        ]
+
+    return asyncio.run(run()), pipe.metrics()["workflow_result_caches"]
+
+
+class TestGetPut:
+
+    def test_absent(_):
+        cache = _WorkflowResultCache(60)
+
+        opt = cache.get("k1")
+
+        print(opt)
+        assert opt is None
+        assert cache.snapshot()["misses"] == 1
+
+    def test_present(_):
+        cache = _WorkflowResultCache(60)
+        cache.put("k1", "AB", ("A", "B"))
+
+        opt = cache.get("k1")
+
+        print(opt, cache.snapshot())
+        assert opt == ("AB", ("A", "B"))
+        assert cache.snapshot()["hits"] == 1
+        assert cache.snapshot()["bytes"] == 4
+
+
+class TestEviction:
+
+    def test_lru(_):
+        cache = _WorkflowResultCache(60, max_entries=2)
+        cache.put("k1", "v1")
+        cache.put("k2", "v2")
+        cache.get("k1")  # k2 becomes least-recently-used
+        cache.put("k3", "v3")
+
+        opt = [cache.get(k) for k in ("k1", "k2", "k3")]
+
+        print(opt, cache.snapshot())
+        assert opt == [("v1", None), None, ("v3", None)]
+        assert cache.snapshot()["lru_evictions"] == 1
+
+    def test_ttl(_):
+        cache = _WorkflowResultCache(-1)
+        cache.put("k1", "v1")
+
+        opt = cache.get("k1")
+
+        print(opt, cache.snapshot())
+        assert opt is None
+        assert cache.snapshot()["ttl_evictions"] == 1
+        assert cache.snapshot()["bytes"] == 0
+
+    def test_max_bytes(_):
+        cache = _WorkflowResultCache(60, max_bytes=10)
+        cache.put("k1", "12345")
+        cache.put("k2", "12345")
+        cache.put("k3", "é")  # 2 bytes in UTF-8, evicting k1
+
+        opt = [cache.get(k) for k in ("k1", "k2", "k3")]
+
+        print(opt, cache.snapshot())
+        assert opt == [None, ("12345", None), ("é", None)]
+        assert cache.snapshot()["bytes"] == 7
+
+    def test_oversized(_):
+        cache = _WorkflowResultCache(60, max_bytes=4)
+        cache.put("k1", "12345")
+
+        opt = cache.get("k1")
+
+        print(opt, cache.snapshot())
+        assert opt is None
+        assert cache.snapshot()["oversized"] == 1
+        assert len(cache) == 0
+
+
+class TestConfig:
+
+    def test_disabled_by_default(_):
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            EXAMPLE_WORKFLOW_CONFIG,
+            disable_get_app_type_and_name=True,
+            app_type_override=DifyAppType.WORKFLOW,
+        )
+
+        opt = model.app.result_cache
+
+        print(opt)
+        assert opt is None
+
+    def test_not_input_field(_):
+        model = OWUModel(
+            EXAMPLE_BASE_URL,
+            CACHED_WORKFLOW_CONFIG,
+            disable_get_app_type_and_name=True,
+            app_type_override=DifyAppType.WORKFLOW,
+        )
+
+        opt = model.app
+
+        print(opt.input_fields)
+        assert opt.result_cache.ttl == 60
+        assert "result_cache_ttl" not in opt.input_fields
+
+    @pytest.mark.parametrize("ttl", [-1, "60", True])
+    def test_invalid(_, ttl):
+        with pytest.raises(TypeError):
+            OWUModel(
+                EXAMPLE_BASE_URL,
+                dict(EXAMPLE_WORKFLOW_CONFIG, result_cache_ttl=ttl),
+                disable_get_app_type_and_name=True,
+                app_type_override=DifyAppType.WORKFLOW,
+            )
+
+    def test_invalid_once_loaded(_):
+        # reported by config, even if the app is created at 1st round
+        with pytest.raises(TypeError):
+            OWUModel(
+                EXAMPLE_BASE_URL,
+                dict(EXAMPLE_WORKFLOW_CONFIG, result_cache_ttl=-1),
+                defer_get_app_type_and_name=True,
+            )
+
+
+class TestPipe:
+
+    def test_streaming_replayed(_):
+        body = _create_body("LOOK UP")
+
+        with StandInDifyServer(mode="workflow", chunks=["A", "B"]) as server:
+            opt, metrics = _run_rounds(server, [body, body])
+            posts = len(server.posts())
+
+        print(opt, metrics)
+        assert opt == [["A", "B"], ["A", "B"]]
+        assert posts == 1
+        assert metrics["example-workflow-model"]["hits"] == 1
+
+    def test_blocking_from_streaming(_):
+        with StandInDifyServer(mode="workflow", chunks=["A", "B"]) as server:
+            opt, _ = _run_rounds(
+                server,
+                [_create_body("LOOK UP"), _create_body("LOOK UP", False)],
+            )
+            posts = len(server.posts())
+
+        print(opt)
+        assert opt == [["A", "B"], "AB"]
+        assert posts == 1
+
+    def test_streaming_from_blocking(_):
+        with StandInDifyServer(mode="workflow", chunks=["A", "B"]) as server:
+            opt, _ = _run_rounds(
+                server,
+                [_create_body("LOOK UP", False), _create_body("LOOK UP")],
+            )
+            posts = len(server.posts())
+
+        print(opt)
+        assert opt == ["AB", ["AB"]]
+        assert posts == 1
+
+    def test_aggregated(_, monkeypatch):
+        monkeypatch.setattr(
+            dify_open_webui_adapter, "AGGREGATES_BLOCKING_ROUNDS", True
+        )
+        body = _create_body("LOOK UP", False)
+
+        with StandInDifyServer(mode="workflow", chunks=["A", "B"]) as server:
+            opt, _ = _run_rounds(server, [body, body])
+            posts = len(server.posts())
+
+        print(opt)
+        assert opt == ["AB", "AB"]
+        assert posts == 1
+
+    def test_different_queries(_):
+        with StandInDifyServer(mode="workflow", chunks=["A", "B"]) as server:
+            opt, metrics = _run_rounds(
+                server, [_create_body("LOOK UP"), _create_body("LOOK DOWN")]
+            )
+            posts = len(server.posts())
+
+        print(opt, metrics)
+        assert posts == 2
+        assert metrics["example-workflow-model"]["misses"] == 2
+
+    def test_abandoned_never_cached(_):
+        body = _create_body("LOOK UP")
+
+        with StandInDifyServer(mode="workflow", chunks=["A", "B"]) as server:
+            pipe = Pipe(
+                app_model_configs_override=[CACHED_WORKFLOW_CONFIG],
+                base_url_override=server.base_url,
+            )
+
+            async def run():
+                opt = await pipe.pipe(body, {}, {})
+                first = await opt.__anext__()
+                await opt.aclose()
+                return first
+
+            opt = asyncio.run(run())
+            metrics = pipe.metrics()["workflow_result_caches"]
+
+        print(opt, metrics)
+        assert opt == "A"
+        assert metrics["example-workflow-model"]["entries"] == 0
+
+    def test_disabled(_):
+        body = _create_body("LOOK UP")
+
+        with StandInDifyServer(mode="workflow", chunks=["A", "B"]) as server:
+            opt, metrics = _run_rounds(
+                server, [body, body], config=EXAMPLE_WORKFLOW_CONFIG
+            )
+            posts = len(server.posts())
+
+        print(opt, metrics)
+        assert posts == 2
+        assert metrics == {}